@@ -146,6 +146,7 @@ class Muse(object):
         import subprocess
         import muse_redux_line as ex 
         import muse_redux_cubex as cx 
+        import muse_index as idx
         import multiprocessing
         import numpy as np
 
@@ -176,7 +177,7 @@ class Muse(object):
         #loop over OBs
         for oob in range(nobs):
             #count how many science exposures
-            nsci=len(glob.glob("../OB{}/Proc/OBJECT_RED_0*.fits*".format(oob+1)))
+            nsci=idx.nexposures('OB{}'.format(oob+1),topdir=topdir)
             #reconstruct names 
             for ll in range(nsci):
                 fl1.write('../OB{}/Proc/DATACUBE_FINAL_LINEWCS_EXP{}_skysub2.fits\n'.format(oob+1,ll+1))
@@ -202,7 +203,7 @@ class Muse(object):
         #loop over OBs
         for oob in range(nobs):
             #count how many science exposures
-            nsci=len(glob.glob("../OB{}/Proc/OBJECT_RED_0*.fits*".format(oob+1)))
+            nsci=idx.nexposures('OB{}'.format(oob+1),topdir=topdir)
             #reconstruct names 
             for ll in range(nsci):
                 fl1.write('../OB{}/Proc/DATACUBE_FINAL_LINEWCS_EXP{}_skysubhsn.fits\n'.format(oob+1,ll+1))
@@ -259,7 +260,8 @@ class Muse(object):
         print('All done!')
         
 
-    def line_process(self,skymode='internal',refpath='./esocombine/',skymask=None,lmin=4900,lmax=9000):
+    def line_process(self,skymode='internal',refpath='./esocombine/',skymask=None,lmin=4900,lmax=9000,
+                     compress=False,quantize=16.):
 
         """
 
@@ -273,6 +275,8 @@ class Muse(object):
         skymask -> a skymask to be used for identify good regions for skysubtraction
         skymode -> internal: use good pixels (i.e. not containing sources or defined in skymask) to perform 
                    skysubtraction
+        compress -> if True, write the intermediate cubes tile-compressed 
+        quantize -> quantisation level for DATA/STAT of compressed cubes [see muse_utils.writecube]
 
         """
 
@@ -294,11 +298,11 @@ class Muse(object):
         ex.make_ifumasks(listob,refpath=refpath)
 
         #compute illumination correction 
-        ex.make_illcorr(listob)
+        ex.make_illcorr(listob,compress=compress,quantize=quantize)
         
         #now do background subtraction
         if('internal' in skymode):
-            ex.internalskysub(listob,skymask)
+            ex.internalskysub(listob,skymask,compress=compress,quantize=quantize)
         else:
             print ("Sky subtraction mode {} not supported".format(skymode))
         
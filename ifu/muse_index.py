@@ -0,0 +1,238 @@
+"""
+A SQLite index of the products in a reduction tree [OB*/Proc and the
+combine folders], with the header information that the drivers need,
+so that files are found and described without globbing and re-opening headers
+
+   from mypython.ifu import muse_index as idx
+   idx.scan()
+   cubes=idx.getfiles(ob='OB1',kind='cube',pattern='DATACUBE_FINAL_LINEWCS_EXP%')
+
+Re-scanning is incremental: only new files, or files whose size or mtime
+have changed, are opened. Files that have disappeared are dropped, and so
+are the OB folders that have disappeared on a scan of the whole tree.
+
+"""
+
+#default name of the index, in the top level of the reduction tree
+INDEXNAME='muse_index.db'
+
+#columns stored for each file, with their sqlite type
+COLUMNS=[('path','TEXT PRIMARY KEY'),('ob','TEXT'),('name','TEXT'),('kind','TEXT'),
+         ('expid','INTEGER'),('size','INTEGER'),('mtime','REAL'),
+         ('naxis1','INTEGER'),('naxis2','INTEGER'),('naxis3','INTEGER'),
+         ('crval1','REAL'),('crval2','REAL'),('crpix1','REAL'),('crpix2','REAL'),
+         ('crval3','REAL'),('cd3_3','REAL'),('posang','REAL'),('exptime','REAL'),
+         ('dateobs','TEXT'),('object','TEXT')]
+
+def opendb(topdir='./',dbname=INDEXNAME):
+
+    """ Open (and create if needed) the index of the tree in topdir """
+
+    import os
+    import sqlite3
+
+    db=sqlite3.connect(os.path.join(topdir,dbname))
+    db.row_factory=sqlite3.Row
+    db.execute('CREATE TABLE IF NOT EXISTS files ({})'.format(
+        ','.join(['{} {}'.format(col,ctype) for col,ctype in COLUMNS])))
+    db.execute('CREATE INDEX IF NOT EXISTS files_ob ON files (ob,kind)')
+
+    return db
+
+def filekind(name):
+
+    """ Classify a product from its name """
+
+    if(name.startswith('OBJECT_RED')):
+        return 'exposure'
+    if(name.startswith('DATACUBE') or ('CUBE' in name)):
+        return 'cube'
+    if(name.startswith('PIXTABLE')):
+        return 'pixtable'
+    if(name.startswith('IMAGE')):
+        return 'image'
+    return 'other'
+
+def fileexpid(name):
+
+    """ Exposure number from OBJECT_RED_0001 or *_EXP1* names, or None """
+
+    import re
+
+    match=re.search(r'OBJECT_RED_(\d+)',name)
+    if(match is None):
+        match=re.search(r'_EXP(\d+)',name)
+    if(match is None):
+        return None
+    return int(match.group(1))
+
+def readheader(filename):
+
+    """
+    Return a dictionary of the header keywords indexed for a file:
+    geometry and wcs from the first image extension, exposure
+    information from the primary header
+
+    """
+
+    from astropy.io import fits
+
+    keys={}
+    hdul=fits.open(filename,memmap=True)
+    primary=hdul[0].header
+
+    #first hdu with an image
+    image=primary
+    for hdu in hdul:
+        if((hdu.is_image) and (hdu.header.get('NAXIS',0) > 0)):
+            image=hdu.header
+            break
+
+    for key in ['NAXIS1','NAXIS2','NAXIS3','CRVAL1','CRVAL2','CRPIX1','CRPIX2','CRVAL3','CD3_3']:
+        keys[key.lower()]=image.get(key,None)
+    keys['posang']=primary.get('HIERARCH ESO INS DROT POSANG',None)
+    keys['exptime']=primary.get('EXPTIME',None)
+    keys['dateobs']=primary.get('DATE-OBS',None)
+    keys['object']=primary.get('OBJECT',None)
+    hdul.close()
+
+    return keys
+
+def scan(topdir='./',dbname=INDEXNAME,obs=None,verbose=True):
+
+    """
+    Scan a reduction tree and update its index. Headers are read only
+    for new or modified files
+
+    topdir  -> top level of the reduction [with the OB* folders]
+    dbname  -> name of the index in topdir
+    obs     -> list of folders to scan, relative to topdir; by default
+               all OB*/Proc folders and the *combine folders, and the 
+               files of folders no longer in the tree are removed
+    verbose -> print a summary
+
+    Return the number of files (re)indexed and removed
+
+    """
+
+    import os
+    import glob
+
+    db=opendb(topdir,dbname)
+
+    if(obs is None):
+        folders=sorted(glob.glob(os.path.join(topdir,'OB*','Proc')))+\
+            sorted(glob.glob(os.path.join(topdir,'*combine')))
+    else:
+        folders=[]
+        for ob in obs:
+            if(os.path.isdir(os.path.join(topdir,ob,'Proc'))):
+                folders.append(os.path.join(topdir,ob,'Proc'))
+            else:
+                folders.append(os.path.join(topdir,ob))
+
+    nnew=0
+    nold=0
+    scanned=set()
+    for folder in folders:
+        ob=os.path.relpath(folder,topdir).split(os.sep)[0]
+        scanned.add(ob)
+        known={}
+        for row in db.execute('SELECT path,size,mtime FROM files WHERE ob=?',(ob,)):
+            known[row['path']]=(row['size'],row['mtime'])
+
+        #a folder that has been removed has no files left
+        if(os.path.isdir(folder)):
+            names=sorted(os.listdir(folder))
+        else:
+            names=[]
+
+        for name in names:
+            if('.fits' not in name):
+                continue
+            filename=os.path.join(folder,name)
+            path=os.path.relpath(filename,topdir)
+            fstat=os.stat(filename)
+            if(known.pop(path,None) == (fstat.st_size,fstat.st_mtime)):
+                continue
+            try:
+                keys=readheader(filename)
+            except Exception as error:
+                print('Cannot index {}: {}'.format(filename,error))
+                continue
+            keys.update({'path':path,'ob':ob,'name':name,'kind':filekind(name),
+                         'expid':fileexpid(name),'size':fstat.st_size,'mtime':fstat.st_mtime})
+            cols=[col for col,ctype in COLUMNS]
+            db.execute('INSERT OR REPLACE INTO files ({}) VALUES ({})'.format(
+                ','.join(cols),','.join(['?']*len(cols))),[keys[col] for col in cols])
+            nnew+=1
+
+        #files no longer on disk
+        for path in known:
+            db.execute('DELETE FROM files WHERE path=?',(path,))
+            nold+=1
+
+    #on a full scan, drop the folders that are no longer in the tree
+    if(obs is None):
+        for row in db.execute('SELECT DISTINCT ob FROM files').fetchall():
+            if(row['ob'] not in scanned):
+                nold+=db.execute('DELETE FROM files WHERE ob=?',(row['ob'],)).rowcount
+
+    db.commit()
+    db.close()
+
+    if(verbose):
+        print('Indexed {} files, removed {}'.format(nnew,nold))
+
+    return nnew, nold
+
+def getfiles(topdir='./',dbname=INDEXNAME,ob=None,kind=None,pattern=None,expid=None):
+
+    """
+    Query the index of a reduction tree
+
+    ob      -> OB folder (e.g. 'OB1'), or None for all
+    kind    -> 'exposure', 'cube', 'pixtable', 'image', 'other' or None for all
+    pattern -> sql LIKE pattern on the file name, e.g. 'DATACUBE_FINAL_LINEWCS_EXP%'
+    expid   -> exposure number
+
+    Return a list of rows [accessed as dictionaries, with path relative
+    to topdir], sorted by OB, exposure and name
+
+    """
+
+    db=opendb(topdir,dbname)
+
+    query=[]
+    values=[]
+    for col,value in [('ob',ob),('kind',kind),('expid',expid)]:
+        if(value is not None):
+            query.append('{}=?'.format(col))
+            values.append(value)
+    if(pattern is not None):
+        query.append('name LIKE ?')
+        values.append(pattern)
+
+    sql='SELECT * FROM files'
+    if(len(query) > 0):
+        sql=sql+' WHERE '+' AND '.join(query)
+    rows=db.execute(sql+' ORDER BY ob,expid,name',values).fetchall()
+    db.close()
+
+    return rows
+
+def nexposures(ob,topdir='./',dbname=INDEXNAME,update=True):
+
+    """
+    Number of science exposures (OBJECT_RED) in an OB, as used by the drivers
+
+    ob     -> OB folder name
+    update -> if True, first re-scan this OB [cheap, headers are read only
+              for new or modified files]
+
+    """
+
+    if(update):
+        scan(topdir=topdir,dbname=dbname,obs=[ob],verbose=False)
+
+    return len(getfiles(topdir=topdir,dbname=dbname,ob=ob,kind='exposure'))
@@ -119,6 +119,7 @@ def cubex_driver(listob,last=False,highsn=None):
     
     import os
     import glob
+    import muse_index as idx
     import subprocess
     import multiprocessing
     import numpy as np
@@ -133,9 +134,8 @@ def cubex_driver(listob,last=False,highsn=None):
         os.chdir(ob+'/Proc/')
         print('Processing {} with cubex '.format(ob))
 
-        #Search how many exposures are there
-        scils=glob.glob("OBJECT_RED_0*.fits*")
-        nsci=len(scils)
+        #Search how many exposures are there [from the index of the tree]
+        nsci=idx.nexposures(ob,topdir=topdir)
         
         #this is the final pass with highsn cube
         if(last):
@@ -21,6 +21,7 @@ def individual_skysub(listob,nproc=12):
     
     import os
     import glob
+    import muse_index as idx
     import subprocess
 
     #grab top dir
@@ -33,9 +34,8 @@ def individual_skysub(listob,nproc=12):
         os.chdir(ob+'/Proc/')
         print('Processing {} for sky subtraction'.format(ob))
         
-        #Search how many exposures are there
-        scils=glob.glob("OBJECT_RED_0*.fits*")
-        nsci=len(scils)
+        #Search how many exposures are there [from the index of the tree]
+        nsci=idx.nexposures(ob,topdir=topdir)
 
         #loop on exposures and reduce frame with sky subtraction 
         for exp in range(nsci):
@@ -21,6 +21,7 @@ def individual_resample(listob,refpath='./',nproc=24):
       
     import os
     import glob
+    import muse_index as idx
     import subprocess
     import shutil
     from astropy.io import fits
@@ -37,9 +38,8 @@ def individual_resample(listob,refpath='./',nproc=24):
         os.chdir(ob+'/Proc/')
         print('Processing {} for resampling on reference cube'.format(ob))
  
-        #Search how many exposures are there
-        scils=glob.glob("OBJECT_RED_0*.fits*")
-        nsci=len(scils)
+        #Search how many exposures are there [from the index of the tree]
+        nsci=idx.nexposures(ob,topdir=topdir)
 
         #loop on exposures and reduce frame with sky subtraction 
         for exp in range(nsci):
@@ -145,6 +145,7 @@ def make_ifumasks(listob,refpath='./',nproc=24):
       
     import os
     import glob
+    import muse_index as idx
     import subprocess
     import shutil
     from astropy.io import fits
@@ -161,9 +162,8 @@ def make_ifumasks(listob,refpath='./',nproc=24):
         os.chdir(ob+'/Proc/')
         print('Processing {} for IFU mask'.format(ob))
  
-        #Search how many exposures are there
-        scils=glob.glob("OBJECT_RED_0*.fits*")
-        nsci=len(scils)
+        #Search how many exposures are there [from the index of the tree]
+        nsci=idx.nexposures(ob,topdir=topdir)
 
         #loop on exposures and reduce frame with sky subtraction 
         for exp in range(nsci):
@@ -226,15 +226,19 @@ def make_ifumasks(listob,refpath='./',nproc=24):
         #back to top
         os.chdir(topdir)
 
-def make_illcorr(listob):
+def make_illcorr(listob,compress=False,quantize=16.):
 
     """    
     Wrapper function for illumination correction
 
+    compress -> if True, write tile-compressed cubes and masks (see muse_utils.writecube)
+    quantize -> quantisation level for DATA/STAT of compressed cubes 
+
     """
 
     import os
     import glob
+    import muse_index as idx
  
     #grab top dir
     topdir=os.getcwd()
@@ -250,9 +254,8 @@ def make_illcorr(listob):
         os.chdir(ob+'/Proc/')
         print('Processing {} for illumination correction'.format(ob))
  
-        #Search how many exposures are there
-        scils=glob.glob("OBJECT_RED_0*.fits*")
-        nsci=len(scils)
+        #Search how many exposures are there [from the index of the tree]
+        nsci=idx.nexposures(ob,topdir=topdir)
 
         #loop on exposures and reduce frame with sky subtraction 
         for exp in range(nsci):
@@ -271,7 +274,8 @@ def make_illcorr(listob):
             newcube="DATACUBE_FINAL_LINEWCS_EXP{0:d}_ILLCORR_ifu.fits".format(exp+1)
             newimage="IMAGE_FOV_LINEWCS_EXP{0:d}_ILLCORR_ifu.fits".format(exp+1)
             make_illcorr_ifu(ifumask_cname,ifumask_iname,data_cname,\
-                                 data_iname,outcorr,outcorrnorm,newcube,newimage,binwidth)
+                                 data_iname,outcorr,outcorrnorm,newcube,newimage,binwidth,
+                                 compress=compress,quantize=quantize)
             
             #do second pass on stack - just constant on white image 
             print('Second pass for exposure {}'.format(exp+1))  
@@ -290,7 +294,8 @@ def make_illcorr(listob):
             maskedges="MASK_EXP{0:d}_ILLCORR_edges.fits".format(exp+1)
             outcorr="ILLCORR_EXP{0:d}_stack.fits".format(exp+1)
             make_illcorr_stack(ifumask_cname,ifumask_iname,data_cname,\
-                                 data_iname,outcorr,newcube,newimage,masknative,maskedges)
+                                 data_iname,outcorr,newcube,newimage,masknative,maskedges,
+                                 compress=compress,quantize=quantize)
             
 
         #back to top for next OB 
@@ -298,7 +303,7 @@ def make_illcorr(listob):
  
 
 def make_illcorr_ifu(ifumask_cname,ifumask_iname,data_cname,data_iname,outcorr,outcorrnorm,newcube,
-                     newimage,binwidth,debug=False):
+                     newimage,binwidth,debug=False,compress=False,quantize=16.):
 
     """
 
@@ -310,6 +315,7 @@ def make_illcorr_ifu(ifumask_cname,ifumask_iname,data_cname,data_iname,outcorr,o
     newcube,newimage             --> data cube and image names for wave dep IFU corrections
     binwidth                     --> how big chuncks in z-direction used for computing illumination correction
     debug                        --> enable interactive displays 
+    compress,quantize            --> tile-compress the outputs (see muse_utils.writecube)
 
     """
       
@@ -500,7 +506,7 @@ def make_illcorr_ifu(ifumask_cname,ifumask_iname,data_cname,data_iname,outcorr,o
         data[1].data=data[1].data*renormcoeff
         data[2].data=data[2].data*renormcoeff*renormcoeff
         #save new cubes 
-        data.writeto(newcube,clobber=True)
+        mut.writecube(data,newcube,compress=compress,quantize=quantize)
         
         #create white image
         print ('Creating final white image')
@@ -522,7 +528,7 @@ def make_illcorr_ifu(ifumask_cname,ifumask_iname,data_cname,data_iname,outcorr,o
 
 
 def make_illcorr_stack(ifumask_cname,ifumask_iname,data_cname,data_iname,outcorr,
-                       newcube,newimage,masknative,maskedges,debug=False):
+                       newcube,newimage,masknative,maskedges,debug=False,compress=False,quantize=16.):
 
     """
 
@@ -535,6 +541,7 @@ def make_illcorr_stack(ifumask_cname,ifumask_iname,data_cname,data_iname,outcorr
     masknative                   --> in oputput, mask of native pixels which have not been interpolated
     maskedges                    --> in output, mask of stack edges
     debug                        --> enable interactive displays 
+    compress,quantize            --> tile-compress the outputs (see muse_utils.writecube)
    
     """
       
@@ -543,6 +550,7 @@ def make_illcorr_stack(ifumask_cname,ifumask_iname,data_cname,data_iname,outcorr
     import subprocess
     import shutil
     from astropy.io import fits
+    from astropy import wcs
     import muse_utils as mut 
     import numpy as np
     import matplotlib as mpl
@@ -634,12 +642,12 @@ def make_illcorr_stack(ifumask_cname,ifumask_iname,data_cname,data_iname,outcorr
         hdu = fits.PrimaryHDU(white_corrections)
         hdulist = fits.HDUList([hdu])
         hdulist.writeto(outcorr,clobber=True)
-        #save image
+        #save image [2D header, from the celestial wcs of the cube]
+        wcsmask=wcs.WCS(data[1].header).dropaxis(2)
         hdu1 = fits.PrimaryHDU([])
-        hdu2 = fits.ImageHDU(masknoninterp)
-        hdu2.header=data[1].header
+        hdu2 = fits.ImageHDU(masknoninterp,header=wcsmask.to_header())
         hdulist = fits.HDUList([hdu1,hdu2])
-        hdulist.writeto(masknative,clobber=True)
+        mut.writecube(hdulist,masknative,compress=compress,quantize=0)
 
         #next apply correction
         maskpixedge=np.zeros((ny,nx))
@@ -703,13 +711,12 @@ def make_illcorr_stack(ifumask_cname,ifumask_iname,data_cname,data_iname,outcorr
 
         #save edge mask
         hdu1 = fits.PrimaryHDU([])
-        hdu2 = fits.ImageHDU(maskpixedge)
-        hdu2.header=data[1].header
+        hdu2 = fits.ImageHDU(maskpixedge,header=wcsmask.to_header())
         hdulist = fits.HDUList([hdu1,hdu2])
-        hdulist.writeto(maskedges,clobber=True)
+        mut.writecube(hdulist,maskedges,compress=compress,quantize=0)
 
         #save new cubes 
-        data.writeto(newcube,clobber=True)
+        mut.writecube(data,newcube,compress=compress,quantize=quantize)
         
         #create white image
         print ('Creating final white image')
@@ -730,7 +737,7 @@ def make_illcorr_stack(ifumask_cname,ifumask_iname,data_cname,data_iname,outcorr
 
 
         
-def internalskysub(listob,skymask):
+def internalskysub(listob,skymask,compress=False,quantize=16.):
 
     """
 
@@ -738,13 +745,17 @@ def internalskysub(listob,skymask):
 
     listob  -> OBs to loop on
     skymask -> if defined, use goodpixels in the mask for computing sky. Otherwise mask sources.
+    compress -> if True, write tile-compressed cubes (see muse_utils.writecube)
+    quantize -> quantisation level for DATA/STAT of compressed cubes 
 
     """
     
     import os
     import glob
+    import muse_index as idx
     from astropy.io import fits
     import numpy as np
+    import muse_utils as mut
 
     #grab top dir
     topdir=os.getcwd()
@@ -756,9 +767,8 @@ def internalskysub(listob,skymask):
         os.chdir(ob+'/Proc/')
         print('Processing {} for illumination correction'.format(ob))
  
-        #Search how many exposures are there
-        scils=glob.glob("OBJECT_RED_0*.fits*")
-        nsci=len(scils)
+        #Search how many exposures are there [from the index of the tree]
+        nsci=idx.nexposures(ob,topdir=topdir)
 
         #loop on exposures and reduce frame with sky subtraction 
         for exp in range(nsci):
@@ -805,7 +815,7 @@ def internalskysub(listob,skymask):
                     cube[1].data[ww,:,:]=skyimg
                     
             #write final cube
-            cube.writeto(newcube,clobber=True)
+            mut.writecube(cube,newcube,compress=compress,quantize=quantize)
             
             #create white image
             print ('Creating final white image')
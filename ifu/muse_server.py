@@ -0,0 +1,212 @@
+"""
+A local server that holds cubes in memory and serves extractions
+to many clients (zfit, notebooks, scripts) at the same time, so that
+a cube is loaded once per machine rather than once per process
+
+On the server side (e.g. in a screen session)
+
+   from mypython.ifu import muse_server as srv
+   srv.serve(cubes=['COMBINED_CUBE.fits'])
+
+On the client side
+
+   client=srv.CubeClient()
+   wave,flx,err,med=client.cube2spec('COMBINED_CUBE.fits',100,120,3)
+
+The server is a multiprocessing manager listening on localhost or on a
+Unix socket. Each client connection is served by its own thread, and all
+the threads share the muse_utils cube cache. Only the products
+(spectra, images, cutouts) travel through the socket.
+
+"""
+
+from multiprocessing.managers import BaseManager
+
+#default address and key for server and clients
+ADDRESS=('localhost',50517)
+AUTHKEY='pymuse'
+
+class CubeServer(object):
+
+    """
+    The object living in the server, whose methods are called by the clients.
+    Cubes are taken from the muse_utils cube cache, so that they are read
+    from disk on first use only
+
+    """
+
+    def cube2spec(self,cube,*args,**kwargs):
+
+        """ As muse_utils.cube2spec, on a cube held by the server """
+
+        from mypython.ifu import muse_utils as utl
+        return utl.cube2spec(cube,*args,**kwargs)
+
+    def cube2img(self,cube,*args,**kwargs):
+
+        """ As muse_utils.cube2img, on a cube held by the server """
+
+        from mypython.ifu import muse_utils as utl
+        return utl.cube2img(cube,*args,**kwargs)
+
+    def cube2slit(self,cube,*args,**kwargs):
+
+        """ As muse_utils.cube2slit, on a cube held by the server """
+
+        from mypython.ifu import muse_utils as utl
+        return utl.cube2slit(cube,*args,**kwargs)
+
+    def cutout(self,cube,box=None,wrange=None,helio=0):
+
+        """
+        As muse_utils.readcube, but a box and/or wrange must be given,
+        as the full cube is not sent through the socket
+
+        """
+
+        from mypython.ifu import muse_utils as utl
+
+        if((box is None) and (wrange is None)):
+            raise ValueError('Set box and/or wrange for a cutout')
+        return utl.readcube(cube,helio=helio,wrange=wrange,box=box)
+
+    def load(self,cube,helio=0):
+
+        """ Load a cube in the server ahead of the first request """
+
+        from mypython.ifu import muse_utils as utl
+
+        mcube=utl.opencube(cube,helio=helio)
+        mcube.close()
+
+    def info(self):
+
+        """ Return the cubes held, the memory used in MB and cache hits and misses """
+
+        from mypython.ifu import muse_utils as utl
+
+        cache=utl.CUBECACHE
+        with cache.lock:
+            cubes=[key[0] for key in cache.cubes.keys()]
+            return cubes, cache.nbytes()/1024.**2, cache.hits, cache.misses
+
+#the single server object, shared by all the connections
+SERVER=CubeServer()
+
+def getserver():
+
+    """ Return the server object [registered with the manager] """
+
+    return SERVER
+
+class CubeManager(BaseManager):
+
+    """ Manager giving access to the cube server """
+
+    pass
+
+CubeManager.register('server',callable=getserver)
+
+def serve(address=ADDRESS,authkey=AUTHKEY,maxmem=16384,preload=True,cubes=None):
+
+    """
+    Start the cube server and serve requests until killed
+
+    address -> (host,port) to listen on localhost, or a path for a Unix socket
+    authkey -> key that clients must present
+    maxmem  -> memory in MB for the cubes held [least recently used are dropped]
+    preload -> if True, cubes are read in memory, otherwise they are memory mapped
+               [and shared through the page cache]
+    cubes   -> list of cubes to load at start
+
+    """
+
+    import os
+    from mypython.ifu import muse_utils as utl
+
+    utl.usecache(maxmem=maxmem,preload=preload)
+
+    if(cubes):
+        for cube in cubes:
+            print('Loading {}'.format(cube))
+            SERVER.load(os.path.abspath(cube))
+
+    manager=CubeManager(address=address,authkey=authkey)
+    server=manager.get_server()
+    print('Serving cubes on {}'.format(address))
+    server.serve_forever()
+
+class CubeClient(object):
+
+    """
+    Thin client of the cube server, mirroring the muse_utils extraction
+    functions. File names (cubes and outputs) are made absolute before
+    being sent, as the server runs in its own directory
+
+    address,authkey -> as given to serve
+
+    """
+
+    def __init__(self,address=ADDRESS,authkey=AUTHKEY):
+
+        """ Connect to the server """
+
+        manager=CubeManager(address=address,authkey=authkey)
+        manager.connect()
+        self.server=manager.server()
+
+    def cube2spec(self,cube,*args,**kwargs):
+
+        """ Same arguments and return as muse_utils.cube2spec """
+
+        args,kwargs=absolutepaths(cube,args,kwargs)
+        return self.server.cube2spec(*args,**kwargs)
+
+    def cube2img(self,cube,*args,**kwargs):
+
+        """ Same arguments and return as muse_utils.cube2img """
+
+        args,kwargs=absolutepaths(cube,args,kwargs)
+        return self.server.cube2img(*args,**kwargs)
+
+    def cube2slit(self,cube,*args,**kwargs):
+
+        """ Same arguments and return as muse_utils.cube2slit """
+
+        args,kwargs=absolutepaths(cube,args,kwargs)
+        return self.server.cube2slit(*args,**kwargs)
+
+    def cutout(self,cube,box=None,wrange=None,helio=0):
+
+        """ Same return as muse_utils.readcube, for a box and/or wrange """
+
+        import os
+        return self.server.cutout(os.path.abspath(cube),box=box,wrange=wrange,helio=helio)
+
+    def load(self,cube,helio=0):
+
+        """ Ask the server to load a cube """
+
+        import os
+        self.server.load(os.path.abspath(cube),helio=helio)
+
+    def info(self):
+
+        """ Cubes held by the server, memory in MB, cache hits and misses """
+
+        return self.server.info()
+
+def absolutepaths(cube,args,kwargs):
+
+    """
+    Turn the cube and the write keyword in absolute paths, and return
+    the arguments and keywords for a call through the server proxy
+
+    """
+
+    import os
+
+    if(kwargs.get('write')):
+        kwargs['write']=os.path.abspath(kwargs['write'])
+
+    return (os.path.abspath(cube),)+tuple(args), kwargs
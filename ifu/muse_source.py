@@ -4,7 +4,7 @@ These are sets of utilities to handle muse sources
 """
 
 def findsources(image,cube,check=False,output='./',spectra=False,helio=0,nsig=2.,
-                minarea=10.,regmask=None,clean=True,outspec='Spectra'):
+                minarea=10.,regmask=None,clean=True,outspec='Spectra',overlap='first'):
 
     """      
 
@@ -18,7 +18,8 @@ def findsources(image,cube,check=False,output='./',spectra=False,helio=0,nsig=2.
     image   -> fits file of image to process
     check   -> if true write a bunch of check mages
     output  -> where to dump the output
-    cube    -> the cube used to extract spectra
+    cube    -> the cube used to extract spectra [for a first pass on a binned 
+               image, use the matching pyramid level, see muse_utils.pyramidcube]
     spectra -> if True, extract spectra in VACUUM wave!!
     helio   -> pass additional heliocentric correction
     nsig    -> number of skyrms used for source id 
@@ -26,6 +27,8 @@ def findsources(image,cube,check=False,output='./',spectra=False,helio=0,nsig=2.
     regmask -> ds9 region file (image) of regions to be masked before extraction [e.g. edges]
     clean   -> clean souces 
     outspec -> where to store output spectra 
+    overlap -> which source gets the pixels where the source ellipses overlap 
+               ['first', 'last' or 'nearest', see muse_utils.ellipses2labels]
 
     """
 
@@ -96,29 +99,30 @@ def findsources(image,cube,check=False,output='./',spectra=False,helio=0,nsig=2.
         if not os.path.exists(outspec):
             os.makedirs(outspec)
 
-    if((check) | (spectra)):
-        #create a detection mask alla cubex
-        srcmask=np.zeros((1,data.shape[0],data.shape[1]))
-        nbj=1
+    if((check) or (spectra)):
+        #label image of the source ellipses [IDs from 1, as in the catalogue order]
+        srclabels=utl.ellipses2labels(objects,data.shape,r=2.,overlap=overlap)
+
+    if(spectra):
+        #extract all the spectra in a single pass on the cube
         print('Generating spectra...')
-        #loop over detections
-        for obj in objects:
-            #init mask
-            tmpmask=np.zeros((data.shape[0],data.shape[1]),dtype=np.bool)
-            tmpmask3d=np.zeros((1,data.shape[0],data.shape[1]),dtype=np.bool)
-            #fill this mask
-            sep.mask_ellipse(tmpmask,obj['x'],obj['y'],obj['a'],obj['b'],obj['theta'],r=2)
-            tmpmask3d[0,:,:]=tmpmask[:,:]
-            srcmask=srcmask+tmpmask3d*nbj
-            if(spectra):
-                savename="{}/id{}.fits".format(outspec,nbj)
-                utl.cube2spec(cube,obj['x'],obj['y'],None,write=savename,
-                              shape='mask',helio=helio,mask=tmpmask3d,tovac=True)
-            #go to next
-            nbj=nbj+1
+        utl.labelspec(cube,srclabels,outspec=outspec,helio=helio,tovac=True)
+
+        #sources with no pixels left in the label image [ellipse covered by 
+        #other sources, or off the image] are extracted from their full ellipse 
+        empty=np.setdiff1d(np.arange(len(objects))+1,srclabels)
+        for srcid in empty:
+            ownlabels=utl.ellipses2labels(objects[srcid-1:srcid],data.shape,r=2.)*srcid
+            if(np.any(ownlabels)):
+                print 'Source {} is covered by other sources: using its full ellipse'.format(srcid)
+                utl.labelspec(cube,ownlabels,outspec=outspec,helio=helio,tovac=True)
+            else:
+                print 'Source {} has no pixels in the image: no spectrum written'.format(srcid)
 
     if(check):
         print 'Dumping source mask...'
+        #detection mask alla cubex
+        srcmask=srclabels[None,:,:]
         hdumain  = fits.PrimaryHDU(srcmask,header=header)
         hdubk  = fits.ImageHDU(srcmask)
         hdulist = fits.HDUList([hdumain,hdubk])
@@ -168,23 +172,128 @@ def sourcephot(catalogue,image,segmap,detection,instrument='MUSE',dxp=0.,dyp=0.,
   
     circap -> radius in arcsec for aperture photmetry to be used when Kron aperture fails 
 
+    Kron radii are measured on the detection image by kronapertures, and the 
+    photometry is done by aperturephot [see these to reuse the apertures 
+    on several images]
+
     """  
 
+    #Kron radii on the detection image
+    apertures=kronapertures(catalogue,segmap,detection,circap=circap)
+
+    #photometry on the image 
+    return aperturephot(apertures,image,instrument=instrument,dxp=dxp,dyp=dyp,
+                        noise=noise,zpab=zpab,kn=kn)
+
+def multiphot(catalogue,images,segmap,detection,bands=None,instrument='MUSE',dxp=0.,dyp=0.,
+              noise=[False],zpab=False,kn=2.5,circap=1.0,nproc=1,output=None):
+
+    """
+
+    As sourcephot, but for a list of images [bands] measured with the same
+    catalogue, segmentation map and detection image. The catalogue and
+    segmentation map are read, and the Kron apertures measured, only once
+
+    catalogue,segmap,detection -> as in sourcephot
+    images    -> list of fits images with ZP in header [at least one]
+    bands     -> list of names used to label the columns of each image
+                 [default the image root names]
+
+    instrument,dxp,dyp,noise,zpab -> as in sourcephot, either a single value used
+                 for all the images, or a list with one value per image
+    kn,circap -> as in sourcephot
+
+    nproc     -> number of processes to use across images
+    output    -> if set, write the table to this fits file
+
+    Return one table with ID and the sourcephot columns of each image,
+    as MAGAP_<band>, FXAP_<band> etc.
+
+    """
+
+    import multiprocessing
     from astropy.io import fits
-    import numpy as np
-    import sep
-    import matplotlib.pyplot as plt
     from astropy.table import Table
-    from astropy import wcs 
 
+    nimg=len(images)
+    if(nimg == 0):
+        raise ValueError('No images to measure')
+    if(bands is None):
+        bands=[((image.split('/')[-1]).split('.fits'))[0] for image in images]
+
+    #expand options to one value per image
+    options={'instrument':instrument,'dxp':dxp,'dyp':dyp,'noise':noise,'zpab':zpab}
+    for key in options.keys():
+        value=options[key]
+        if((key == 'noise') and (len(value) > 0) and not isinstance(value[0],(list,tuple))):
+            value=[value]*nimg
+        elif(not isinstance(value,(list,tuple))):
+            value=[value]*nimg
+        if(len(value) != nimg):
+            raise ValueError('Need one value of {} per image'.format(key))
+        options[key]=value
+
+    #Kron radii once, on the detection image
+    apertures=kronapertures(catalogue,segmap,detection,circap=circap)
+
+    #photometry of each image
+    jobs=[]
+    if(nproc > 1):
+        pool=multiprocessing.Pool(processes=nproc)
+    for ii in range(nimg):
+        kwargs=dict(kn=kn)
+        for key in options.keys():
+            kwargs[key]=options[key][ii]
+        if(nproc > 1):
+            jobs.append(pool.apply_async(aperturephot,(apertures,images[ii]),kwargs))
+        else:
+            jobs.append(aperturephot(apertures,images[ii],**kwargs))
+    if(nproc > 1):
+        pool.close()
+        #collect results in order
+        jobs=[job.get() for job in jobs]
+        pool.join()
+
+    #one wide table
+    phot=Table()
+    phot['ID']=jobs[0]['ID']
+    for band,bandphot in zip(bands,jobs):
+        for col in bandphot.colnames[1:]:
+            phot['{}_{}'.format(col,band)]=bandphot[col]
+
+    if(output):
+        tbhdu=fits.BinTableHDU(phot.as_array())
+        tbhdu.writeto(output,clobber=True)
 
-    #grab root name 
-    rname=((image.split('/')[-1]).split('.fits'))[0]
-    print ('Working on {}'.format(rname))
+    return phot
+
+def kronapertures(catalogue,segmap,detection,circap=1.0):
+
+    """
+
+    Compute the Kron radii of the sources in a catalogue on the detection 
+    image, masking all the other sources in the segmentation map. Sources 
+    are processed in batches with no overlapping apertures, so that each 
+    batch needs a single mask and a single call to sep 
+
+    catalogue -> source cat from findsources
+    segmap    -> fits of segmentation map 
+    detection -> the detection image 
+    circap    -> radius in arcsec of the circular aperture used when Kron aperture fails 
+
+    Return a dictionary with the source parameters, the Kron radii and 
+    the flag for circular apertures, the segmentation map and the 
+    reference wcs, as used by aperturephot
+
+    """
+
+    from astropy.io import fits
+    import numpy as np
+    import sep
+    from astropy import wcs 
 
     #open the catalogue/fits 
     cat=fits.open(catalogue)
-    img=fits.open(image)
     seg=fits.open(segmap)
     det=fits.open(detection)
 
@@ -193,6 +302,146 @@ def sourcephot(catalogue,image,segmap,detection,instrument='MUSE',dxp=0.,dyp=0.,
     psref=wref.pixel_scale_matrix[1,1]*3600.
     print ('Reference pixel size {}'.format(psref))
 
+    #grab detection and seg mask 
+    detflx=np.nan_to_num(det[0].data.byteswap(True).newbyteorder())
+    #go back to 1d
+    segmask=(np.nan_to_num(seg[0].data.byteswap(True).newbyteorder()))[0,:,:]
+
+    apertures={}
+    for key in ['x','y','a','b','theta']:
+        apertures[key]=np.array(cat[1].data[key],dtype=np.float64)
+    nsrc=len(apertures['x'])
+    apertures['id']=np.arange(nsrc)+1
+
+    #compute kron radius [pixel of reference image, in units of a,b]
+    #masking all other sources to avoid overlaps but keeping the desired one
+    kronrad=np.zeros(nsrc)
+    extent=6.0*apertures['a']+1
+    segid=segmask.astype(int)
+    for batch in apbatches(apertures['x'],apertures['y'],extent,segid):
+        tmpmask=batchmask(segid,apertures['id'][batch])
+        kronrad[batch], flg = sep.kron_radius(detflx,apertures['x'][batch],apertures['y'][batch],
+                                              apertures['a'][batch],apertures['b'][batch],
+                                              apertures['theta'][batch],6.0,mask=tmpmask)
+    apertures['kronrad']=kronrad
+
+    #now check if size is sensible in units of MUSE data 
+    rmin = 2.0  #MUSE pix 
+    apertures['use_circle']=kronrad*np.sqrt(apertures['a']*apertures['b']) < rmin
+    #use circular aperture of circap in muse pixel unit
+    apertures['rcircap']=circap/psref
+
+    apertures['segmask']=segmask
+    apertures['wref']=wref
+    apertures['psref']=psref
+
+    cat.close()
+    seg.close()
+    det.close()
+
+    return apertures
+
+def apbatches(x,y,extent,segid):
+
+    """
+
+    Split sources in batches such that, within a batch, the box of each source 
+    does not overlap the boxes of the others [greedy assignment]. The box of a 
+    source covers both its aperture [half size extent] and the bounding box 
+    of its segment [ID = index+1 in segid], so that no pixel of a source can 
+    fall in the aperture of another source of the same batch, where it 
+    would not be masked 
+
+    Return a list of arrays of indexes 
+
+    """
+
+    import numpy as np
+    from scipy import ndimage
+
+    nsrc=len(x)
+    boxes=np.zeros((nsrc,4),dtype=int)
+    boxes[:,0]=np.floor(x-extent)
+    boxes[:,1]=np.floor(x+extent)+2
+    boxes[:,2]=np.floor(y-extent)
+    boxes[:,3]=np.floor(y+extent)+2
+
+    #extend to the segments
+    segments=ndimage.find_objects(np.clip(segid,0,nsrc),max_label=nsrc)
+    for ii,segslice in enumerate(segments):
+        if(segslice is not None):
+            boxes[ii,0]=min(boxes[ii,0],segslice[1].start)
+            boxes[ii,1]=max(boxes[ii,1],segslice[1].stop)
+            boxes[ii,2]=min(boxes[ii,2],segslice[0].start)
+            boxes[ii,3]=max(boxes[ii,3],segslice[0].stop)
+
+    #boxes taken in each batch 
+    batches=[]
+    taken=[]
+    for ii in range(nsrc):
+        x0,x1,y0,y1=boxes[ii]
+        for bb in range(len(batches)+1):
+            if(bb == len(batches)):
+                batches.append([])
+                taken.append(np.zeros((nsrc,4),dtype=int))
+            tbox=taken[bb][:len(batches[bb])]
+            if not (np.any((tbox[:,0] < x1) & (x0 < tbox[:,1]) & (tbox[:,2] < y1) & (y0 < tbox[:,3]))):
+                taken[bb][len(batches[bb])]=boxes[ii]
+                batches[bb].append(ii)
+                break
+
+    return [np.array(batch,dtype=int) for batch in batches]
+
+def batchmask(segid,ids):
+
+    """
+
+    Mask of all the sources in the integer segmentation map segid, but 
+    the ones in ids [and the background]
+
+    """
+
+    import numpy as np
+
+    keep=np.zeros(max(segid.max(),ids.max())+1,dtype=bool)
+    keep[0]=True
+    keep[ids]=True
+
+    return ~keep[np.clip(segid,0,None)]
+
+def aperturephot(apertures,image,instrument='MUSE',dxp=0.,dyp=0.,noise=[False],zpab=False,kn=2.5,
+                 check=True):
+
+    """
+
+    Compute Kron (or circular) and segmentation photometry on an image, 
+    for the apertures measured on the detection image by kronapertures. 
+    Each source is measured with all the other sources masked and with 
+    a local sky subtraction, in batches of non overlapping apertures 
+
+    apertures  -> output of kronapertures 
+    image      -> fits image with ZP in header
+    instrument, dxp, dyp, noise, zpab, kn -> as in sourcephot 
+    check      -> if True, write the check images of apertures [and remapped segmap]
+
+    Return a table with the photometry, in the order of the catalogue 
+
+    """
+
+    from astropy.io import fits
+    import numpy as np
+    import sep
+    from astropy.table import Table
+    from astropy import wcs 
+
+    #grab root name 
+    rname=((image.split('/')[-1]).split('.fits'))[0]
+    print ('Working on {}'.format(rname))
+
+    img=fits.open(image)
+    wref=apertures['wref']
+    psref=apertures['psref']
+    segmask=apertures['segmask']
 
     #if not handling MUSE, special cases for format of data
     if('MUSE' not in instrument):
@@ -217,264 +466,243 @@ def sourcephot(catalogue,image,segmap,detection,instrument='MUSE',dxp=0.,dyp=0.,
         imgdata=img[0].data
         vardata=img[1].data
         psimg=psref
+    zp=img[0].header['ZPAB']
 
     #grab flux and var
     dataflx=np.nan_to_num(imgdata.byteswap(True).newbyteorder())
     datavar=np.nan_to_num(vardata.byteswap(True).newbyteorder())
-    #grab detection and seg mask 
-    detflx=np.nan_to_num(det[0].data.byteswap(True).newbyteorder())
-    #go back to 1d
-    segmask=(np.nan_to_num(seg[0].data.byteswap(True).newbyteorder()))[0,:,:]
 
     #if needed, map the segmap to new image with transformation
     if('MUSE' not in instrument):
-        #allocate space for transformed segmentation map
-        segmasktrans=np.zeros(dataflx.shape)
         print "Remapping segmentation map to new image..."
-
-        #loop over original segmap and map to trasformed one
-        #Just use nearest pixel, and keep only 1 when multiple choices 
-        for xx in range(segmask.shape[0]):
-            for yy in range(segmask.shape[1]):
-                #go to world
-                radec=wref.wcs_pix2world([[yy,xx]],0)
-                #back to new instrument pixel 
-                newxy=wimg.wcs_world2pix(radec,0)
-                #apply shift to register WCS
-                newxy[0][1]=newxy[0][1]+dyp
-                newxy[0][0]=newxy[0][0]+dxp
-                segmasktrans[newxy[0][1],newxy[0][0]]=segmask[xx,yy]
-                
-                #grow buffer as needed by individual instruments
-                #This accounts for resampling to finer pixel size
-                if('LRIS' in instrument):
-                    segmasktrans[newxy[0][1]+1,newxy[0][0]+1]=segmask[xx,yy]
-                    segmasktrans[newxy[0][1]-1,newxy[0][0]-1]=segmask[xx,yy]
-                    segmasktrans[newxy[0][1]+1,newxy[0][0]-1]=segmask[xx,yy]
-                    segmasktrans[newxy[0][1]-1,newxy[0][0]+1]=segmask[xx,yy]
-                    segmasktrans[newxy[0][1]+1,newxy[0][0]]=segmask[xx,yy]
-                    segmasktrans[newxy[0][1]-1,newxy[0][0]]=segmask[xx,yy]
-                    segmasktrans[newxy[0][1],newxy[0][0]-1]=segmask[xx,yy]
-                    segmasktrans[newxy[0][1],newxy[0][0]+1]=segmask[xx,yy]
+        #nearest pixel on the new grid, then grow by one pixel 
+        #as needed by individual instruments [finer pixel size]
+        if('LRIS' in instrument):
+            grow=1
+        else:
+            grow=0
+        segmasktrans=remapsegmap(segmask,wref,wimg,dataflx.shape,dxp=dxp,dyp=dyp,grow=grow)
                  
         #dump the transformed segmap for checking 
-        hdumain  = fits.PrimaryHDU(segmasktrans,header=img[1].header)
-        hdulist = fits.HDUList(hdumain)
-        hdulist.writeto("{}_segremap.fits".format(rname),clobber=True)
+        if(check):
+            hdumain  = fits.PrimaryHDU(segmasktrans,header=img[1].header)
+            hdulist = fits.HDUList(hdumain)
+            hdulist.writeto("{}_segremap.fits".format(rname),clobber=True)
+
+        #map centre of apertures - +1 reference
+        ra,dec=wref.wcs_pix2world(apertures['x'],apertures['y'],1)
+        xphot,yphot=wimg.wcs_world2pix(ra,dec,1)
+        #apply shift to register WCS
+        xphot=xphot+dxp
+        yphot=yphot+dyp
+        #scale radii to new pixel size 
+        rminphot=apertures['rcircap']*psref/psimg
+        aphot=apertures['a']*psref/psimg
+        bphot=apertures['b']*psref/psimg
     else:
         #no transformation needed
         segmasktrans=segmask
+        xphot=apertures['x']
+        yphot=apertures['y']
+        rminphot=apertures['rcircap']
+        aphot=apertures['a']
+        bphot=apertures['b']
 
     #source to extract
-    nsrc=len(cat[1].data)
+    nsrc=len(xphot)
     print('Extract photometry for {} sources'.format(nsrc))
-    phot = Table(names=('ID', 'MAGAP', 'MAGAP_ERR','FXAP', 'FXAP_ERR', 
-                        'RAD', 'MAGSEG', 'MAGSEG_ERR', 'FXSEG', 'FXSEG_ERR','ZP'), 
-                 dtype=('i4','f4','f4','f4','f4','f4','f4','f4','f4','f4','f4'))
-    
-   
-    #create check aperture mask 
-    checkaperture=np.zeros(dataflx.shape)
-    print('Computing photometry for objects...')
-
-    #loop over each source
-    for idobj in range(nsrc):
-        
-        #########
-        #Find positions etc and transform as appropriate
-        #########
-                
-        #extract MUSE source paramaters 
-        x= cat[1].data['x'][idobj]
-        y= cat[1].data['y'][idobj]
-        a= cat[1].data['a'][idobj]
-        b= cat[1].data['b'][idobj]
-        theta= cat[1].data['theta'][idobj]
-
-        #compute kron radius on MUSE detection image 
-        #Kron rad in units of a,b
-        tmpdata=np.copy(detflx)
-        tmpmask=np.copy(segmask)
-        #mask all other sources to avoid overlaps but keep desired one
-        pixels=np.where(tmpmask == idobj+1) 
-        tmpmask[pixels]=0
-
-        #compute kron radius [pixel of reference image]
-        kronrad, flg = sep.kron_radius(tmpdata,x,y,a,b,theta,6.0,mask=tmpmask)
-
-        #plt.imshow(np.log10(tmpdata+1),origin='low')
-        #plt.show()
-        #exit()
-
-        #now check if size is sensible in units of MUSE data 
-        rmin = 2.0  #MUSE pix 
-        use_circle = kronrad * np.sqrt(a*b) < rmin
-      
-        #use circular aperture of 2" in muse pixel unit
-        rcircap = circap/psref
-        
-        #now use info to compute photometry and apply 
-        #spatial transformation if needed
-        if('MUSE' not in instrument):
-            #map centre of aperture - +1 reference
-            #go to world
-            radec=wref.wcs_pix2world([[x,y]],1)
-            #back to new instrument pixel 
-            newxy=wimg.wcs_world2pix(radec,1)
-            #apply shift to register WCS
-            xphot=newxy[0][0]+dxp
-            yphot=newxy[0][1]+dyp
-                      
-            #scale radii to new pixel size 
-            rminphot=rcircap*psref/psimg
-            aphot=a*psref/psimg
-            bphot=b*psref/psimg
-            #Kron radius in units of a,b
-
-        else:
-            #for muse, transfer to same units
-            xphot=x
-            yphot=y
-            rminphot=rcircap
-            aphot=a
-            bphot=b     
-            
-        #####
-        #Compute local sky 
-        #####
-        skyreg=kn*kronrad*np.sqrt(aphot*bphot)+15
-        cutskymask=segmasktrans[yphot-skyreg:yphot+skyreg,xphot-skyreg:xphot+skyreg]
-        cutskydata=dataflx[yphot-skyreg:yphot+skyreg,xphot-skyreg:xphot+skyreg]
-        skymedian=np.nan_to_num(np.median(cutskydata[np.where(cutskymask < 1.0)]))
-
-        #print skymedian    
-        #plt.imshow(cutskymask,origin='low')
-        #plt.show()
-        #if(idobj > 30):
-        #    exit()
-
-
-        #########
-        #Now grab the Kron mag computed using detection image
-        #########
-   
-        #mask all other objects to avoid blending   
-        tmpdata=np.copy(dataflx)
-        #apply local sky subtraction 
-        tmpdata=tmpdata-skymedian
-        tmpvar=np.copy(datavar)
-        tmpmask=np.copy(segmasktrans)
-        pixels=np.where(tmpmask == idobj+1) 
-        tmpmask[pixels]=0
-
-        #plt.imshow(tmpmask,origin='low')
-        #plt.show()
-        #exit()
-
-        #circular aperture
-        if(use_circle):        
-           
-            #flux in circular aperture
-            flux_kron, err, flg = sep.sum_circle(tmpdata,xphot,yphot,rminphot,mask=tmpmask)
-            #propagate variance
-            fluxvar, err, flg = sep.sum_circle(tmpvar,xphot,yphot,rminphot,mask=tmpmask)
-            #store Rused in arcsec
-            rused=rminphot*psimg
-
-            #update check aperture
-            tmpcheckaper=np.zeros(dataflx.shape,dtype=bool)
-            sep.mask_ellipse(tmpcheckaper,xphot,yphot,1.,1.,0.,r=rminphot)
-            checkaperture=checkaperture+tmpcheckaper*(idobj+1)
-
-        #kron apertures 
-        else:
-            #kron flux 
-            flux_kron, err, flg = sep.sum_ellipse(tmpdata,xphot, yphot, aphot, bphot, theta, kn*kronrad,
-                                                  mask=tmpmask)            
-            #propagate variance 
-            fluxvar, err, flg = sep.sum_ellipse(tmpvar,xphot,yphot, aphot, bphot, theta, kn*kronrad,
-                                                mask=tmpmask)
-            #translate in radius
-            rused=kn*kronrad*psimg*np.sqrt(aphot*bphot)
-
-            #update check aperture
-            tmpcheckaper=np.zeros(dataflx.shape,dtype=bool)
-            sep.mask_ellipse(tmpcheckaper,xphot,yphot,aphot,bphot,theta,r=kn*kronrad)
-            checkaperture=checkaperture+tmpcheckaper*(idobj+1)
-
-        #compute error for aperture
-        if(noise[0]):
-            #use model 
-            appix=np.where(tmpcheckaper > 0)
-            errflux_kron=noise[0]*noise[1]*len(appix[0])**noise[2]
-        else:
-            #propagate variance 
-            errflux_kron=np.sqrt(fluxvar)
+    theta=apertures['theta']
+    kronrad=apertures['kronrad']
+    use_circle=apertures['use_circle']
+    ids=apertures['id']
+    ny,nx=dataflx.shape
+
+    #####
+    #Compute local sky, in a box around each source 
+    #####
+    skymedian=np.zeros(nsrc)
+    skyreg=kn*kronrad*np.sqrt(aphot*bphot)+15
+    for ii in range(nsrc):
+        x0=max(int(xphot[ii]-skyreg[ii]),0)
+        x1=max(int(xphot[ii]+skyreg[ii]),0)
+        y0=max(int(yphot[ii]-skyreg[ii]),0)
+        y1=max(int(yphot[ii]+skyreg[ii]),0)
+        cutskymask=segmasktrans[y0:y1,x0:x1]
+        cutskydata=dataflx[y0:y1,x0:x1]
+        if(np.any(cutskymask < 1.0)):
+            skymedian[ii]=np.nan_to_num(np.median(cutskydata[cutskymask < 1.0]))
+
+    #########
+    #Now grab the Kron mag computed using detection image
+    #########
+    radius=np.where(use_circle,rminphot,kn*kronrad*np.sqrt(aphot*bphot))
+    rused=radius*psimg
+    flux_kron=np.zeros(nsrc)
+    fluxvar=np.zeros(nsrc)
+    unity=np.ones(dataflx.shape)
+    segid=segmasktrans.astype(int)
+    #batches from the full extent of the apertures [major axis for ellipses]
+    extent=np.where(use_circle,rminphot,kn*kronrad*np.maximum(aphot,bphot))+1
+    for batch in apbatches(xphot,yphot,extent,segid):
+        #mask all other objects in the batch to avoid blending 
+        tmpmask=batchmask(segid,ids[batch])
+        circ=batch[use_circle[batch]]
+        ell=batch[~use_circle[batch]]
+        for data,store in [(dataflx,flux_kron),(datavar,fluxvar),(unity,None)]:
+            sums=np.zeros(nsrc)
+            if(len(circ) > 0):
+                sums[circ], err, flg = sep.sum_circle(data,xphot[circ],yphot[circ],rminphot,mask=tmpmask)
+            if(len(ell) > 0):
+                sums[ell], err, flg = sep.sum_ellipse(data,xphot[ell],yphot[ell],aphot[ell],bphot[ell],
+                                                      theta[ell],kn*kronrad[ell],mask=tmpmask)
+            if(store is not None):
+                store[batch]=sums[batch]
+            else:
+                #apply local sky subtraction over the unmasked area
+                flux_kron[batch]=flux_kron[batch]-skymedian[batch]*sums[batch]
 
-        #go to mag 
-        if(flux_kron > 0):
-            mag_aper=-2.5*np.log10(flux_kron)+img[0].header['ZPAB']
-            errmg_aper=2.5*np.log10(1.+errflux_kron/flux_kron)
-        else:
-            mag_aper=99.0
-            errmg_aper=99.0
-        
-        #find out if non detections
-        if(errflux_kron >= flux_kron):
-            errmg_aper=9
-            mag_aper=-2.5*np.log10(2.*errflux_kron)+img[0].header['ZPAB']
-          
-        #######
-        #grab the photometry in the segmentation map 
-        #####
-
-        #This may not work well for other instruments 
-        #if images are not well aligned
-        pixels=np.where(segmasktrans == idobj+1) 
-        #add flux in pixels
-        tmpdata=np.copy(dataflx)
-        #apply sky sub
-        tmpdata=tmpdata-skymedian
-        flux_seg=np.sum(tmpdata[pixels])
-        
-        #compute noise from model or adding variance 
-        if(noise[0]):
-            #from model 
-            errfx_seg=noise[0]*noise[1]*len(pixels[0])**noise[2]
-        else:
-            #add variance in pixels to compute error
-            errfx_seg=np.sqrt(np.sum(datavar[pixels]))
-  
-        #go to mag with calibrations 
-        if(flux_seg > 0):
-            mag_seg=-2.5*np.log10(flux_seg)+img[0].header['ZPAB']
-            errmg_seg=2.5*np.log10(1.+errfx_seg/flux_seg)     
+    #check apertures and their size in pixels 
+    checkaperture=np.zeros(dataflx.shape)
+    appix=np.zeros(nsrc)
+    for ii in range(nsrc):
+        if(use_circle[ii]):
+            apa,apb,apt,apr=1.,1.,0.,rminphot
         else:
-            mag_seg=99.0
-            errmg_seg=99.0
-      
-        #find out if non detections
-        if(errfx_seg >= flux_seg):
-            errmg_seg=9
-            mag_seg=-2.5*np.log10(2.*errfx_seg)+img[0].header['ZPAB']
+            apa,apb,apt,apr=aphot[ii],bphot[ii],theta[ii],kn*kronrad[ii]
+        ext=apr*max(apa,apb)+1
+        x0=min(max(int(xphot[ii]-ext),0),nx)
+        x1=min(max(int(xphot[ii]+ext)+2,0),nx)
+        y0=min(max(int(yphot[ii]-ext),0),ny)
+        y1=min(max(int(yphot[ii]+ext)+2,0),ny)
+        tmpcheckaper=np.zeros((y1-y0,x1-x0),dtype=bool)
+        sep.mask_ellipse(tmpcheckaper,xphot[ii]-x0,yphot[ii]-y0,apa,apb,apt,r=apr)
+        checkaperture[y0:y1,x0:x1]+=tmpcheckaper*ids[ii]
+        appix[ii]=np.sum(tmpcheckaper)
+
+    #compute error for aperture
+    if(noise[0]):
+        #use model 
+        errflux_kron=noise[0]*noise[1]*appix**noise[2]
+    else:
+        #propagate variance 
+        errflux_kron=np.sqrt(fluxvar)
+    mag_aper,errmg_aper=fluxtomag(flux_kron,errflux_kron,zp)
+
+    #######
+    #grab the photometry in the segmentation map, for all sources at once
+    #####
+
+    #This may not work well for other instruments 
+    #if images are not well aligned
+    segid=segid.ravel()
+    insrc=(segid > 0) & (segid <= nsrc)
+    npixseg=np.bincount(segid[insrc],minlength=nsrc+1)[1:]
+    #add flux in pixels and apply sky sub
+    flux_seg=np.bincount(segid[insrc],weights=dataflx.ravel()[insrc],minlength=nsrc+1)[1:]-skymedian*npixseg
         
-        #stash by id
-        phot.add_row((idobj+1,mag_aper,errmg_aper,flux_kron,errflux_kron,rused,mag_seg,errmg_seg,
-                      flux_seg,errfx_seg,img[0].header['ZPAB']))
+    #compute noise from model or adding variance 
+    if(noise[0]):
+        #from model 
+        errfx_seg=noise[0]*noise[1]*npixseg**noise[2]
+    else:
+        #add variance in pixels to compute error
+        errfx_seg=np.sqrt(np.bincount(segid[insrc],weights=datavar.ravel()[insrc],minlength=nsrc+1)[1:])
+    mag_seg,errmg_seg=fluxtomag(flux_seg,errfx_seg,zp)
+
+    #fill the table by columns 
+    phot = Table([ids,mag_aper,errmg_aper,flux_kron,errflux_kron,rused,mag_seg,errmg_seg,
+                  flux_seg,errfx_seg,np.zeros(nsrc)+zp],
+                 names=('ID', 'MAGAP', 'MAGAP_ERR','FXAP', 'FXAP_ERR', 
+                        'RAD', 'MAGSEG', 'MAGSEG_ERR', 'FXSEG', 'FXSEG_ERR','ZP'), 
+                 dtype=('i4','f4','f4','f4','f4','f4','f4','f4','f4','f4','f4'))
 
     #dump the aperture check image 
-    hdumain  = fits.PrimaryHDU(checkaperture,header=img[1].header)
-    hdulist = fits.HDUList(hdumain)
-    hdulist.writeto("{}_aper.fits".format(rname),clobber=True)
+    if(check):
+        hdumain  = fits.PrimaryHDU(checkaperture,header=img[1].header)
+        hdulist = fits.HDUList(hdumain)
+        hdulist.writeto("{}_aper.fits".format(rname),clobber=True)
 
     #close
-    cat.close()
     img.close()
-    seg.close()
-    det.close()
 
     return phot
 
+def fluxtomag(flux,errflux,zp):
+
+    """
+
+    Convert fluxes and errors to AB magnitudes. Sources with flux <= 0 
+    or error >= flux are non detections: the magnitude is then the 2 sigma 
+    limit, and the error is set to 9 
+
+    Return magnitudes and errors 
+
+    """
+
+    import numpy as np
+
+    flux=np.asarray(flux,dtype=float)
+    errflux=np.asarray(errflux,dtype=float)
+    detected=(flux > 0) & (errflux < flux)
+    safeflux=np.where(detected,flux,1.)
+    mag=np.where(detected,-2.5*np.log10(safeflux)+zp,-2.5*np.log10(np.maximum(2.*errflux,1e-30))+zp)
+    errmag=np.where(detected,2.5*np.log10(1.+errflux/safeflux),9.)
+
+    return mag, errmag
+
+def remapsegmap(segmask,wref,wimg,shape,dxp=0.,dyp=0.,grow=0):
+
+    """
+
+    Remap a segmentation map to the pixel grid of another image, by inverse 
+    mapping: the pixels of the new image that fall on the reference image 
+    are transformed to the reference grid in a single array call, and take 
+    the label of the nearest reference pixel 
+
+    segmask   -> the segmentation map (y,x) on the reference grid 
+    wref,wimg -> wcs of the reference and of the new image 
+    shape     -> (y,x) size of the new image 
+    dxp,dyp   -> shifts in pixel of the new image to register the astrometry
+    grow      -> grow the footprints by this number of pixels into the background 
+
+    """
+
+    import numpy as np
+    from scipy import ndimage
+
+    segmasktrans=np.zeros(shape)
+
+    #footprint of the reference image on the new grid 
+    ny,nx=segmask.shape
+    edge=np.linspace(0,1,11)
+    xedge=np.concatenate([edge*(nx-1),edge*0,edge*(nx-1),edge*0+nx-1])
+    yedge=np.concatenate([edge*0,edge*(ny-1),edge*0+ny-1,edge*(ny-1)])
+    ra,dec=wref.wcs_pix2world(xedge,yedge,0)
+    xnew,ynew=wimg.wcs_world2pix(ra,dec,0)
+    x0=max(int(np.floor(np.min(xnew+dxp)))-1,0)
+    x1=min(int(np.ceil(np.max(xnew+dxp)))+2,shape[1])
+    y0=max(int(np.floor(np.min(ynew+dyp)))-1,0)
+    y1=min(int(np.ceil(np.max(ynew+dyp)))+2,shape[0])
+    if((x1 <= x0) or (y1 <= y0)):
+        return segmasktrans
+
+    #back to the reference grid, removing the shifts 
+    yy,xx=np.mgrid[y0:y1,x0:x1]
+    ra,dec=wimg.wcs_pix2world((xx-dxp).ravel(),(yy-dyp).ravel(),0)
+    xref,yref=wref.wcs_world2pix(ra,dec,0)
+    xref=np.round(xref).astype(int)
+    yref=np.round(yref).astype(int)
+    inside=(xref >= 0) & (xref < nx) & (yref >= 0) & (yref < ny)
+    values=np.zeros(len(xref))
+    values[inside]=segmask[yref[inside],xref[inside]]
+    segmasktrans[y0:y1,x0:x1]=values.reshape(yy.shape)
+
+    #grow footprints only into the background
+    for gg in range(grow):
+        grown=ndimage.grey_dilation(segmasktrans,size=(3,3))
+        segmasktrans=np.where(segmasktrans > 0,segmasktrans,grown)
+
+    return segmasktrans
 
 def mocklines(cube,fluxlimits,num=500,wavelimits=None,spatwidth=3.5,wavewidth=2,outprefix='mocks',fill=6.):
 
@@ -598,44 +826,266 @@ def mocklines(cube,fluxlimits,num=500,wavelimits=None,spatwidth=3.5,wavewidth=2,
     return
 
 
-def forcephot(image,x,y,rad,skyreg=[10,20],show=False,mask=None):
+def findlines(cube,output='./',fwhm=3.5,linewidth=2.,snthresh=5.,minvox=10,maxmem=1024,nthreads=4):
+
+    """
+
+    Detect line emitters in a cube with a 3D matched filter, as an 
+    alternative to CubEx after line_process 
+
+    The cube is convolved with a spatial Gaussian PSF and a Gaussian line 
+    template, separately and with FFTs, in chunks of wavelength that overlap 
+    by the template size. The variance is propagated with the squared kernels 
+    to build a S/N cube [voxels where less than half of the kernel falls on 
+    valid pixels are set to 0]. Voxels above threshold are grouped in 3D connected 
+    objects, labelled chunk by chunk and joined across the chunk boundaries 
+
+    cube      -> a MUSE cube [filename] with DATA and STAT, continuum subtracted 
+    output    -> where to write lines_snr.fits (S/N cube), lines_labels.fits 
+                 (label cube, 0 for background), lines_footprints.fits 
+                 (2D footprints of the labels) and lines_catalogue.fits
+    fwhm      -> FWHM of the spatial PSF, in pixels 
+    linewidth -> FWHM of the line template, in slices 
+    snthresh  -> S/N threshold for detection 
+    minvox    -> minimum number of voxels of an object 
+    maxmem    -> memory ceiling in MB shared by all the threads 
+    nthreads  -> number of chunks processed in parallel 
+
+    The footprints are the label cube collapsed along wavelength 
+    [the maximum ID in each spaxel, so where two objects at different 
+    wavelengths overlap the spaxel goes to the higher ID], as a (1,y,x) 
+    image in the format of the CubEx Objects_Id_2D images. Spectra are 
+    extracted from the footprints with 
+       cube2spec(cube,0,0,0,shape='mask',mask=footprints,idsource=id)
+    or for all the objects at once with labelspec(cube,footprints). 
+    The 3D label cube selects voxels rather than spaxels, and is not 
+    meant to be used as a mask for extraction 
+
+    Return the catalogue of detections [id, pixel and sky position, 
+    wavelength, number of voxels, peak S/N, flux and error in the voxels]
+
+    """
+
+    import os
+    import numpy as np
+    from astropy.io import fits 
+    from multiprocessing.pool import ThreadPool
+    from mypython.ifu import muse_utils as utl
+
+    with utl.opencube(cube) as mcube:
+        nwv,ny,nx=mcube.shape
+        header=mcube.header
+
+        #normalised kernels
+        sigs=fwhm/(2*np.sqrt(2*np.log(2)))
+        sigw=linewidth/(2*np.sqrt(2*np.log(2)))
+        hs=int(np.ceil(3*sigs))
+        hw=int(np.ceil(3*sigw))
+        ks=np.arange(-hs,hs+1)
+        kspat=np.exp(-0.5*(ks[:,None]**2+ks[None,:]**2)/sigs**2)
+        kspat=kspat/np.sum(kspat)
+        kw=np.arange(-hw,hw+1)
+        kspec=np.exp(-0.5*kw**2/sigw**2)
+        kspec=kspec/np.sum(kspec)
+
+        #outputs on disk, filled by chunks 
+        snrname=os.path.join(output,'lines_snr.fits')
+        labname=os.path.join(output,'lines_labels.fits')
+        utl.makebigfits(snrname,[('SNR',(nwv,ny,nx),np.float32,header)])
+        utl.makebigfits(labname,[('LABELS',(nwv,ny,nx),np.int32,header)])
+        snrfits=fits.open(snrname,mode='update',memmap=True)
+        labfits=fits.open(labname,mode='update',memmap=True)
+        snrdata=snrfits['SNR'].data
+        labdata=labfits['LABELS'].data
+
+        #chunks in wavelength [data, variance, convolutions and fft buffers]
+        nslab=utl.slabsize(mcube.shape,maxmem/float(nthreads),nbuffers=12)
+        nslab=max(nslab,2*hw+1)
+        chunks=[(w0,min(w0+nslab,nwv)) for w0 in range(0,nwv,nslab)]
+
+        #map the cube before the threads start 
+        mcube.data
+        mcube.stat
+
+        print 'Filtering the cube in {} chunks'.format(len(chunks))
+        pool=ThreadPool(processes=nthreads)
+        results=pool.map(linechunk,[(mcube,w0,w1,hw,kspat,kspec,snthresh,snrdata,labdata) for w0,w1 in chunks])
+        pool.close()
+        pool.join()
+
+        #join objects across chunk boundaries [labels are numbered per chunk]
+        offsets=np.cumsum([0]+[res[0] for res in results])
+        parent=np.arange(offsets[-1]+1)
+        counts=np.zeros(offsets[-1]+1)
+        for kk,res in enumerate(results):
+            counts[offsets[kk]+1:offsets[kk+1]+1]=res[1][1:]
+        for kk in range(len(chunks)-1):
+            last=results[kk][3]
+            first=results[kk+1][2]
+            touch=(last > 0) & (first > 0)
+            for aa,bb in set(zip(last[touch]+offsets[kk],first[touch]+offsets[kk+1])):
+                ra=findroot(parent,aa)
+                rb=findroot(parent,bb)
+                parent[max(ra,rb)]=min(ra,rb)
+        roots=np.array([findroot(parent,ii) for ii in range(len(parent))])
+
+        #final ids, dropping small objects
+        nvox=np.bincount(roots,weights=counts,minlength=len(parent))
+        keep=np.nonzero(nvox >= minvox)[0]
+        keep=keep[keep > 0]
+        newid=np.zeros(len(parent),dtype=np.int32)
+        newid[keep]=np.arange(len(keep))+1
+        mapping=newid[roots]
+        nobj=len(keep)
+        print 'Found {} objects'.format(nobj)
+
+        #relabel and measure the objects
+        sums=np.zeros((7,nobj+1))
+        snmax=np.zeros(nobj+1)
+        footprints=np.zeros((ny,nx),dtype=np.int32)
+        for kk,(w0,w1) in enumerate(chunks):
+            lab=np.array(labdata[w0:w1])
+            inobj=lab > 0
+            lab[inobj]=mapping[lab[inobj]+offsets[kk]]
+            labdata[w0:w1]=lab
+            footprints=np.maximum(footprints,np.max(lab,axis=0))
+            inobj=lab > 0
+            ids=lab[inobj]
+            zz,yy,xx=np.nonzero(inobj)
+            snr=np.array(snrdata[w0:w1])[inobj]
+            dslab,vslab=mcube.slab(w0,w1,stat=True)
+            flux=np.nan_to_num(dslab[inobj])
+            var=np.nan_to_num(vslab[inobj])
+            for ii,weights in enumerate([snr,snr*xx,snr*yy,snr*(zz+w0),flux,var,np.ones(len(ids))]):
+                sums[ii]+=np.bincount(ids,weights=weights,minlength=nobj+1)
+            np.maximum.at(snmax,ids,snr)
+
+        snrfits.close()
+        labfits.close()
+        hdu=fits.PrimaryHDU(footprints[None,:,:],header=mcube.wcs.celestial.to_header())
+        hdu.writeto(os.path.join(output,'lines_footprints.fits'),clobber=True)
+
+        #S/N weighted centroids 
+        sums=sums[:,1:]
+        xc=sums[1]/sums[0]
+        yc=sums[2]/sums[0]
+        zc=sums[3]/sums[0]
+        if(nobj > 0):
+            ra,dec=mcube.wcs.celestial.wcs_pix2world(xc,yc,0)
+        else:
+            ra,dec=xc,yc
+        lambdac=np.interp(zc,np.arange(nwv),mcube.wave)
+
+    #line flux, integrated over wavelength
+    catalogue=np.zeros(nobj,dtype=[('id',int),('x',float),('y',float),('z',float),('ra',float),('dec',float),
+                                    ('lambda',float),('nvox',int),('snmax',float),('flux',float),('errflux',float)])
+    catalogue['id']=np.arange(nobj)+1
+    catalogue['x']=xc
+    catalogue['y']=yc
+    catalogue['z']=zc
+    catalogue['ra']=ra
+    catalogue['dec']=dec
+    catalogue['lambda']=lambdac
+    catalogue['nvox']=sums[6]
+    catalogue['snmax']=snmax[1:]
+    catalogue['flux']=sums[4]*header['CD3_3']
+    catalogue['errflux']=np.sqrt(sums[5])*header['CD3_3']
+
+    print 'Writing catalogue..'
+    cols=fits.ColDefs(catalogue)
+    tbhdu=fits.BinTableHDU.from_columns(cols)
+    tbhdu.writeto(os.path.join(output,'lines_catalogue.fits'),clobber=True)
+
+    return catalogue
+
+def linechunk(args):
+
+    """
+    Worker of findlines: filter a chunk of wavelengths, write its S/N 
+    and labels [numbered within the chunk], and return the number of 
+    objects, their voxel counts and the labels in the first and last plane 
+
+    """
+
+    import numpy as np
+    from scipy import signal, ndimage
+
+    mcube,w0,w1,hw,kspat,kspec,snthresh,snrdata,labdata=args
+
+    #read with overlap for the line template 
+    r0=max(w0-hw,0)
+    r1=min(w1+hw,mcube.shape[0])
+    dslab,vslab=mcube.slab(r0,r1,stat=True)
+    good=np.isfinite(dslab) & np.isfinite(vslab)
+    dslab[~good]=0.
+    vslab[~good]=0.
+
+    #separable convolution, spatial then spectral
+    cdata=signal.fftconvolve(dslab,kspat[None,:,:],mode='same',axes=(1,2))
+    cdata=signal.fftconvolve(cdata,kspec[:,None,None],mode='same',axes=0)[w0-r0:w1-r0]
+    cvar=signal.fftconvolve(vslab,kspat[None,:,:]**2,mode='same',axes=(1,2))
+    cvar=signal.fftconvolve(cvar,kspec[:,None,None]**2,mode='same',axes=0)[w0-r0:w1-r0]
+    #fraction of the kernel on valid pixels 
+    cover=signal.fftconvolve(good.astype(float),kspat[None,:,:],mode='same',axes=(1,2))
+    cover=signal.fftconvolve(cover,kspec[:,None,None],mode='same',axes=0)[w0-r0:w1-r0]
+
+    snr=np.zeros(cdata.shape,dtype=np.float32)
+    valid=(cvar > 0) & (cover > 0.5)
+    snr[valid]=cdata[valid]/np.sqrt(cvar[valid])
+    snrdata[w0:w1]=snr
+
+    labels,nlab=ndimage.label(snr > snthresh)
+    labdata[w0:w1]=labels
+    counts=np.bincount(labels.ravel(),minlength=nlab+1)
+
+    return nlab, counts, labels[0].copy(), labels[-1].copy()
+
+def findroot(parent,ii):
+
+    """ Root of ii in a union-find forest, compressing the path """
+
+    root=ii
+    while(parent[root] != root):
+        root=parent[root]
+    while(parent[ii] != root):
+        parent[ii],ii=root,parent[ii]
+
+    return root
+
+def forcephot(image,x,y,rad,skyreg=[10,20],show=False,mask=None,radec=False):
     
     """
 
     Compute the photometry on a MUSE reconstructed image within an aperture 
     Treat limits as 2sigma
 
-    x,y        -> position of the aperture in pixels
-    radap      -> radius of the aperture in pixels
+    x,y        -> position of the aperture in pixels [or arrays of positions]
+    radap      -> radius of the aperture in pixels [or array of radii]
     skyreg     -> radius of inner/outer sky region in pixel
     mask       -> mask to avoid pixels
+    radec      -> if True, x,y are ra,dec in degrees, converted with the image wcs
     
     show       -> if true, show what's appening
 
+    For a single position, return mag and error [99 for limits]. For arrays 
+    of positions, the image is read once and a table is returned, 
+    see forcetable 
 
     """
     
-    from astropy.io import fits
     import matplotlib.pyplot as plt
-    import sep
     import numpy as np
 
     #open the image
-    image=fits.open(image)
-    data = image[1].data.byteswap().newbyteorder()
-    var = image[2].data.byteswap().newbyteorder()
+    data,var,zp,wimg=forceload(image)
 
-    #grab the zp
-    zp=image[0].header['ZPAB']
-    flux, err, flg = sep.sum_circle(data,x,y,rad,var=var,bkgann=skyreg,mask=mask)
-
-    #compute magnitudes
-    if(flux < 2*err):
-        mag=-2.5*np.log10(2*err)+zp
-        errmag=99
+    #convert positions if needed
+    if(radec):
+        xpix,ypix=wimg.wcs_world2pix(x,y,0)
     else:
-        mag=-2.5*np.log10(flux)+zp
-        errmag=2.5*np.log10(1.+err/flux)     
+        xpix,ypix=x,y
+
+    phot=forcetable(data,var,zp,xpix,ypix,rad,skyreg=skyreg,mask=mask)
 
     #if show
     if(show):
@@ -645,23 +1095,136 @@ def forcephot(image,x,y,rad,skyreg=[10,20],show=False,mask=None):
         median=np.median(data)
         stddev=np.std(data)
         plt.imshow(data,clim=[median-0.2*stddev,median+stddev],origin='low')
-        
-
-        #now the aperture 
-        circ=plt.Circle((x,y),radius=rad, color='red', fill=False)
         ax=plt.gca()
-        ax.add_patch(circ)
+        
+        #now the apertures
+        for src in phot:
+            circ=plt.Circle((src['X'],src['Y']),radius=src['RAD'], color='red', fill=False)
+            ax.add_patch(circ)
     
-        if(skyreg):
-             circ1=plt.Circle((x,y),radius=skyreg[0], color='red', fill=False)
-             circ2=plt.Circle((x,y),radius=skyreg[1], color='red', fill=False)
-             ax.add_patch(circ1)
-             ax.add_patch(circ2)
+            if(skyreg):
+                circ1=plt.Circle((src['X'],src['Y']),radius=skyreg[0], color='red', fill=False)
+                circ2=plt.Circle((src['X'],src['Y']),radius=skyreg[1], color='red', fill=False)
+                ax.add_patch(circ1)
+                ax.add_patch(circ2)
 
         
 
         plt.show()
 
 
+    #single aperture
+    if(np.ndim(x) == 0):
+        return phot['MAG'][0], phot['MAG_ERR'][0]
 
-    return mag, errmag
+    return phot
+
+def forcephotimages(images,x,y,rad,skyreg=[10,20],mask=None,radec=False,names=None):
+
+    """
+
+    Forced photometry of the same list of positions on many images 
+    [e.g. upper limits for line emitters in many bands or cubes slices]. 
+    Each image is read once and all the apertures are measured together 
+
+    images     -> list of images [as for forcephot]
+    x,y,rad,skyreg,mask -> as in forcephot 
+    radec      -> if True, x,y are ra,dec in degrees, converted with the wcs of 
+                  each image
+    names      -> names used to label the columns of each image 
+                  [default the image root names]
+
+    Return one table with the positions and FLUX, FLUX_ERR, MAG, MAG_ERR, LIMIT
+    for each image, as FLUX_<name> etc.
+
+    """
+
+    from astropy.table import Table
+    import numpy as np
+
+    if(names is None):
+        names=[((image.split('/')[-1]).split('.fits'))[0] for image in images]
+
+    phot=Table()
+    if(radec):
+        phot['RA']=np.atleast_1d(x)
+        phot['DEC']=np.atleast_1d(y)
+    else:
+        phot['X']=np.atleast_1d(x)
+        phot['Y']=np.atleast_1d(y)
+
+    for image,name in zip(images,names):
+        data,var,zp,wimg=forceload(image)
+        if(radec):
+            xpix,ypix=wimg.wcs_world2pix(x,y,0)
+        else:
+            xpix,ypix=x,y
+        imgphot=forcetable(data,var,zp,xpix,ypix,rad,skyreg=skyreg,mask=mask)
+        for col in ['FLUX','FLUX_ERR','MAG','MAG_ERR','LIMIT']:
+            phot['{}_{}'.format(col,name)]=imgphot[col]
+
+    return phot
+
+def forceload(image):
+
+    """
+
+    Read a MUSE reconstructed image for forced photometry
+
+    Return data and variance [native byte order], zeropoint and wcs 
+
+    """
+
+    from astropy.io import fits
+    from astropy import wcs
+    import numpy as np
+
+    img=fits.open(image)
+    data=img[1].data.byteswap().newbyteorder()
+    var=img[2].data.byteswap().newbyteorder()
+    #grab the zp
+    zp=img[0].header['ZPAB']
+    wimg=wcs.WCS(img[1].header)
+    img.close()
+
+    return data, var, zp, wimg
+
+def forcetable(data,var,zp,x,y,rad,skyreg=[10,20],mask=None):
+
+    """
+
+    Circular aperture photometry at arrays of positions, in a single call to sep.
+    Treat limits as 2sigma
+
+    data,var   -> image and variance 
+    zp         -> AB zeropoint
+    x,y        -> positions in pixels [0 based]
+    rad        -> radius of the apertures in pixels [scalar or array]
+    skyreg     -> radius of inner/outer sky region in pixel
+    mask       -> mask to avoid pixels
+
+    Return a table with X, Y, RAD, FLUX, FLUX_ERR, MAG, MAG_ERR [99 for limits] 
+    and LIMIT [True if flux < 2 error, in which case MAG is the 2sigma limit]
+
+    """
+
+    from astropy.table import Table
+    import sep
+    import numpy as np
+
+    x=np.atleast_1d(np.array(x,dtype=np.float64))
+    y=np.atleast_1d(np.array(y,dtype=np.float64))
+    rad=np.array(rad,dtype=np.float64)+np.zeros(len(x))
+
+    flux, err, flg = sep.sum_circle(data,x,y,rad,var=var,bkgann=skyreg,mask=mask)
+
+    #compute magnitudes
+    limit=flux < 2*err
+    safeflux=np.where(limit,1.,flux)
+    mag=np.where(limit,-2.5*np.log10(np.maximum(2*err,1e-30))+zp,-2.5*np.log10(safeflux)+zp)
+    errmag=np.where(limit,99.,2.5*np.log10(1.+err/safeflux))
+
+    phot=Table([x,y,rad,flux,err,mag,errmag,limit],
+               names=('X','Y','RAD','FLUX','FLUX_ERR','MAG','MAG_ERR','LIMIT'))
+
+    return phot
@@ -1,63 +1,208 @@
-def aligntocat(cube,catalogue):
+def aligntocat(cube,catalogue,box=20,gauss=False,nsig=3.,whiteimg=None,residuals=False):
 
     """ 
 
     Take a cube and compare the sources in the field to the positions in the reference 
     catalogue. Return offsets in ra/dec that can be used for re-projecting the cube
 
-    This makes use of pyguide to find stars and centroid on them
+    Stars are centroided all together with centroidstars [no external dependencies]
+
+    box      -> half size in pixels of the window used to centroid each star
+    gauss    -> if True, refine the centroids with a 2D Gaussian fit 
+    nsig     -> clipping threshold applied to the offsets before taking the median
+    whiteimg -> if set, name of the white image of the cube. If the file exists and is up 
+                to date with the cube [see opensidecar] it is used instead of projecting 
+                the cube, otherwise it is created by cube2img
+    residuals -> if True, return also an array with per-star positions, offsets and flags
 
     """
        
-    import PyGuide
     import numpy as np
     from astropy import wcs
+    from astropy.io import fits
+    from scipy.stats import sigmaclip
 
     print "Processing cube {} for offsets".format(cube)
 
-    #first project the cube to create a white image with wcs
-    img, var, wcsimg = cube2img(cube)
+    #first project the cube to create a white image with wcs [or reuse it]
+    whdu=None
+    if(whiteimg):
+        whdu=opensidecar(cube,whiteimg)
+    if(whdu is not None):
+        print "Using white image {}".format(whiteimg)
+        img=np.array(whdu[1].data)
+        wcsimg=wcs.WCS(whdu[0].header)
+        whdu.close()
+    else:
+        img, var, wcsimg = cube2img(cube,write=whiteimg)
+        if(whiteimg):
+            #record the cube, so that the image is not reused once the cube changes 
+            whdu=fits.open(whiteimg,mode='update')
+            whdu[0].header.extend(sidecarheader(cube))
+            whdu.close()
 
     #load the reference stars
-    starcat=np.loadtxt(catalogue,dtype={'names': ('ra','dec'),'formats': ('f4', 'f4')})
+    starcat=np.loadtxt(catalogue,dtype={'names': ('ra','dec'),'formats': ('f8', 'f8')},ndmin=1)
 
-    #loop on reference stars and centroid 
-    nref=len(starcat['ra'])
+    #find first guess for all stars at once
+    xpix,ypix=wcsimg.wcs_world2pix(starcat['ra'],starcat['dec'],0)
+
+    #centroid all the stars
+    xcen,ycen,good=centroidstars(img,xpix,ypix,box=box,gauss=gauss)
+
+    #back to ra/dec for all stars 
+    racen,deccen=wcsimg.wcs_pix2world(xcen,ycen,0)
+    raoffcurrent=racen-starcat['ra']
+    decoffcurrent=deccen-starcat['dec']
+
+    #clip outliers in the offsets of good stars
+    used=np.copy(good)
+    if(np.sum(good) > 2):
+        c,rlow,rupp=sigmaclip(raoffcurrent[good],nsig,nsig)
+        c,dlow,dupp=sigmaclip(decoffcurrent[good],nsig,nsig)
+        used=good & (raoffcurrent >= rlow) & (raoffcurrent <= rupp) & \
+            (decoffcurrent >= dlow) & (decoffcurrent <= dupp)
 
-    #space for offsets
-    raoffcurrent=[]
-    decoffcurrent=[]
-       
-    for sr in range(nref):
-        #find first guess
-        pix = wcsimg.wcs_world2pix(starcat['ra'][sr],starcat['dec'][sr],0)
-        #centroid within 20 pixels 
-        ccd=PyGuide.CCDInfo(0,0,1)
-        
-        #handle weird errors for bas pixels
-        usethis=True
-        try:
-            centroid=PyGuide.centroid(img,None,None,[pix[0],pix[1]],20,ccd)
-        except:        
-            usethis=False
-
-        #back to ra/dec if centroid is good
-        if ((centroid.isOK) & (usethis)): 
-            coord = wcsimg.wcs_pix2world(centroid.xyCtr[0],centroid.xyCtr[1],0)
-            raoffcurrent.append(coord[0]-starcat['ra'][sr])
-            decoffcurrent.append(coord[1]-starcat['dec'][sr])
-                
     #stack offsets
-    raoff=np.median(np.array(raoffcurrent))
-    decoff=np.median(np.array(decoffcurrent))
+    raoff=np.median(raoffcurrent[used])
+    decoff=np.median(decoffcurrent[used])
      
     print "Offsets for cube {} RA: {} Dec: {}".format(cube,raoff*3600.,decoff*3600.)
-    print "Error offsets for cube {} RA: {} Dec: {}".format(cube,np.std(np.array(raoffcurrent))*3600.,
-                                                            np.std(np.array(decoffcurrent))*3600.)
+    print "Error offsets for cube {} RA: {} Dec: {}".format(cube,np.std(raoffcurrent[used])*3600.,
+                                                            np.std(decoffcurrent[used])*3600.)
+    print "Used {} out of {} stars".format(np.sum(used),len(used))
+
+    if(residuals):
+        resid=np.zeros(len(used),dtype=[('ra','f8'),('dec','f8'),('x','f8'),('y','f8'),
+                                        ('dra','f8'),('ddec','f8'),('good','bool'),('used','bool')])
+        resid['ra']=starcat['ra']
+        resid['dec']=starcat['dec']
+        resid['x']=xcen
+        resid['y']=ycen
+        resid['dra']=raoffcurrent
+        resid['ddec']=decoffcurrent
+        resid['good']=good
+        resid['used']=used
+        return raoff,decoff,resid
                              
     return raoff,decoff
 
-def cube2img(cube,write=None,wrange=None,helio=0,filt=None):
+def aligncubes(cubes,catalogue,nproc=4,box=20,gauss=False,nsig=3.,cachewhite=True):
+
+    """ 
+
+    Run aligntocat on a list of cubes in parallel 
+
+    cubes     -> list of cubes to align 
+    catalogue -> reference catalogue of ra/dec 
+    nproc     -> number of processes to use 
+    box,gauss,nsig -> as in aligntocat 
+    cachewhite -> if True, white images are stored as cube_white.fits and 
+                  reused in later calls instead of projecting the cube again
+
+    Return a list of (raoff,decoff) for each cube 
+
+    """
+
+    import multiprocessing
+
+    pool=multiprocessing.Pool(processes=nproc)
+    jobs=[]
+    for cube in cubes:
+        if(cachewhite):
+            whiteimg=cube.split('.fits')[0]+'_white.fits'
+        else:
+            whiteimg=None
+        jobs.append(pool.apply_async(aligntocat,(cube,catalogue),
+                                     dict(box=box,gauss=gauss,nsig=nsig,whiteimg=whiteimg)))
+    pool.close()
+
+    #collect results in order
+    offsets=[job.get() for job in jobs]
+    pool.join()
+
+    return offsets
+
+def centroidstars(img,xpos,ypos,box=20,niter=3,gauss=False):
+
+    """ 
+
+    Centroid a list of stars in an image all at once, using the first moments 
+    in a window around each guess after removing the local median background
+
+    img       -> the image 
+    xpos,ypos -> first guess of positions [0-index pixels]
+    box       -> half size of the window in pixels 
+    niter     -> number of iterations, each re-centering the window
+    gauss     -> if True, refine each centroid with a 2D Gaussian fit
+
+    Return x, y of centroids and a flag for good measurements 
+
+    """
+
+    import numpy as np
+    import warnings
+    from scipy.optimize import curve_fit
+
+    img=np.asarray(img,dtype=np.float64)
+    ny,nx=img.shape
+    xguess=np.atleast_1d(np.asarray(xpos,dtype=np.float64))
+    yguess=np.atleast_1d(np.asarray(ypos,dtype=np.float64))
+    nstar=len(xguess)
+    xcen=np.copy(xguess)
+    ycen=np.copy(yguess)
+    good=np.isfinite(xcen) & np.isfinite(ycen)
+    xcen[~good]=0.
+    ycen[~good]=0.
+
+    #window offsets shared by all stars
+    off=np.arange(-int(box),int(box)+1)
+
+    for it in range(niter):
+        #windows as (star,y,x) pixel grids
+        xx=np.round(xcen).astype(int)[:,None,None]+off[None,None,:]
+        yy=np.round(ycen).astype(int)[:,None,None]+off[None,:,None]
+        inside=(xx >= 0) & (xx < nx) & (yy >= 0) & (yy < ny)
+        cut=img[np.clip(yy,0,ny-1),np.clip(xx,0,nx-1)]
+        cut[~inside]=np.nan
+
+        #remove local background and keep positive flux
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore',RuntimeWarning)
+            bkg=np.nanmedian(cut.reshape(nstar,-1),axis=1)
+        wgt=np.nan_to_num(cut-bkg[:,None,None])
+        wgt[wgt < 0]=0.
+        tot=np.sum(wgt,axis=(1,2))
+        ok=tot > 0
+
+        #first moments 
+        xcen[ok]=np.sum(wgt*xx,axis=(1,2))[ok]/tot[ok]
+        ycen[ok]=np.sum(wgt*yy,axis=(1,2))[ok]/tot[ok]
+        good=good & ok
+
+    #optional gaussian refinement on the same windows 
+    if(gauss):
+        def gauss2d(xy,amp,x0,y0,sig,cont):
+            return amp*np.exp(-((xy[0]-x0)**2+(xy[1]-y0)**2)/(2.*sig**2))+cont
+        for ss in np.nonzero(good)[0]:
+            fit=np.isfinite(cut[ss])
+            xy=(xx[ss].repeat(len(off),axis=0)[fit],yy[ss].repeat(len(off),axis=1)[fit])
+            p0=[np.nanmax(cut[ss])-bkg[ss],xcen[ss],ycen[ss],2.,bkg[ss]]
+            try:
+                popt,pcov=curve_fit(gauss2d,xy,cut[ss][fit],p0=p0)
+            except (RuntimeError,ValueError):
+                continue
+            if(np.hypot(popt[1]-xcen[ss],popt[2]-ycen[ss]) < box):
+                xcen[ss]=popt[1]
+                ycen[ss]=popt[2]
+
+    #reject centroids that wandered away from the guess
+    good=good & (np.abs(xcen-xguess) < box) & (np.abs(ycen-yguess) < box)
+
+    return xcen,ycen,good
+
+def cube2img(cube,write=None,wrange=None,helio=0,filt=None,maxmem=512,box=None,native=False,
+             level=None,cumsum=False):
     
     """
     Take a cube and make a projection, extracting also WCS information.
@@ -70,27 +215,107 @@ def cube2img(cube,write=None,wrange=None,helio=0,filt=None):
     filt -> The ID of a filter transmission curve to use for convolution,
             which filter package can understand (e.g. 129 for SDSS r-band) 
             Filt overwrite wrange
+    maxmem -> memory ceiling in MB for the wavelength slabs that are 
+              read and combined at any one time 
+    box -> if set to (xmin,ymin,xmax,ymax), project only this spatial box
+           [pixels, 0-index, x along NAXIS1, upper edges excluded]
+    native -> if True, work in float32 as the cube [see slabproject]
+    level -> if set, project the pyramid level binned by this factor instead 
+             of the cube [see makepyramid]; box is then in binned pixels 
+    cumsum -> if True, tophat images (wrange or white) are made from the 
+              cumulative sidecar of makecumcube when it is available and 
+              up to date, so that only two planes are read 
+
+    Only the slices with non-zero transmission (and the box) are read from disk.
 
     """
 
     import numpy as np
-    import matplotlib.pyplot as plt
     from astropy.io import fits 
     from astropy import wcs
-    from mypython.filters import filter as fil
-    from scipy import interpolate
-    from scipy import integrate
 
-    #read the cube
-    cubdata,vardata,wcsc,wavec,regions=readcube(cube,helio=helio)
+    #quick look on a binned version
+    if(level):
+        cube=pyramidcube(cube,level)
+
+    #open the cube [slabs are read only when needed]
+    with opencube(cube,helio=helio) as mcube:
+        wavec=mcube.wave
         
-    #find delta lambda
-    delta_lambda=wavec-np.roll(wavec,1)
-    delta_lambda[0]=wavec[1]-wavec[0]
+        #find delta lambda
+        delta_lambda=wavec-np.roll(wavec,1)
+        delta_lambda[0]=wavec[1]-wavec[0]
+
+        #compute the desired transmission curves
+        trans,ZP=bandtrans(wavec,wrange=wrange,filt=filt)
+
+        ###############################
+        #now do the actual combination#
+        ###############################
+
+        #combine trans with delta lambda and reduce in slabs along wavelength
+        #NaNs are masked in place inside each slab - no full cube temporaries 
+        trans=trans*delta_lambda
+        wmin,wmax,xmin,xmax,ymin,ymax=mcube.window(box=box)
+
+        #tophat with a cumulative sidecar is a difference of planes
+        used=np.nonzero(trans)[0]
+        cumfits=None
+        if(cumsum and (filt is None) and (len(used) > 0) and (len(used) == used[-1]-used[0]+1) and 
+           np.allclose(trans[used],trans[used[0]])):
+            cumfits=opencumcube(cube)
+        if(cumfits):
+            img,var,wgt=cumproject(cumfits,used[0],used[-1]+1,box=(xmin,ymin,xmax,ymax))
+            img=img*trans[used[0]]
+            var=var*trans[used[0]]**2
+            wgt=wgt*trans[used[0]]
+            cumfits.close()
+        else:
+            img,var,wgt=slabproject(mcube.data[:,ymin:ymax,xmin:xmax],mcube.stat[:,ymin:ymax,xmin:xmax],
+                                    trans,maxmem=maxmem,native=native)
+
+        #reassemble - this is constrcuting a mean image weighted by the transmission curve
+        wgt[wgt <= 0]=1e-20
+        img=np.nan_to_num(img/wgt)
+        var=np.nan_to_num(var/wgt**2)
+
+        #grab 2D wcs
+        wcsimg=wcs.WCS(mcube.subheader(wmin,wmax,xmin,xmax,ymin,ymax)).dropaxis(2)
+    
+    #if write, write
+    if(write):
+        print 'Writing to ', write
+        header=wcsimg.to_header()
+        header["ZPAB"]=ZP
+        hduhead = fits.PrimaryHDU(img,header=header)
+        hduimg  = fits.ImageHDU(img)
+        hduvar  = fits.ImageHDU(var)
+        hdulist = fits.HDUList([hduhead,hduimg,hduvar])
+        hdulist.writeto(write,clobber=True)
+
+    return img, var, wcsimg
+
+def bandtrans(wavec,wrange=None,filt=None):
+
+    """
+    Compute the transmission curve on the cube wavelength grid 
+    and the AB zeropoint of the resulting image. 
+
+    wavec  -> the cube wavelength array
+    wrange -> if set to a (minl,maxl) use a tophat in this range
+    filt   -> The ID of a filter transmission curve to use for convolution,
+              which filter package can understand (e.g. 129 for SDSS r-band) 
+              Filt overwrite wrange
+    
+    If neither is set, a white image over the full cube is assumed.
+    Return the transmission (zero outside the band) and the zeropoint 
+
+    """
 
-    #########################################
-    #compute the desired transmission curves#
-    #########################################
+    import numpy as np
+    from mypython.filters import filter as fil
+    from scipy import interpolate
+    from scipy import integrate
 
     #if no filter or wrange, default to mix max cube
     if not (wrange) and not (filt):
@@ -99,19 +324,16 @@ def cube2img(cube,write=None,wrange=None,helio=0,filt=None):
     #implement filtering in wrange
     if(wrange):
         
-        #create a good mask escluding NaN
-        mask=np.isfinite(cubdata)
-        mask=mask.astype(int)
-        
-        #trim data in desired range
-        trim=np.where((wavec < wrange[0]) | (wavec > wrange[1]))
-        mask[trim[0],:,:]=0
-        
         #set the trasmission T=1 for white/tophat image masking 5 pixel at edges
         trans=np.zeros(len(wavec))+1
         trans[0:5]=0
         trans[-5:]=0
 
+        #trim data in desired range [NaN are masked later, slab by slab]
+        trim=np.where((wavec < wrange[0]) | (wavec > wrange[1]))
+        transtrim=np.copy(trans)
+        transtrim[trim[0]]=0
+
         #set zeropoint 
         #now compute the zero point of the image
         lefffn=interpolate.interp1d(wavec,wavec*trans,bounds_error=False,fill_value=0)
@@ -123,13 +345,12 @@ def cube2img(cube,write=None,wrange=None,helio=0,filt=None):
         #Compute the ZP in AB - native image is in 1e-20 erg/s/cm2/A
         ZP=-2.5*np.log10(lmean*lmean/29979245800.*1e-8*1e-20)-48.6
         print 'Filter zeropoint ',  ZP
+
+        #the zeropoint uses the untrimmed curve, the projection the trimmed one
+        trans=transtrim
         
     #implement filter transmission
     if(filt):
-        #create a good mask - this overwrites wrange
-        mask=np.isfinite(cubdata)
-        mask=mask.astype(int)
-        
         #load the filter 
         myfilter=fil.Filter(filt)
         myfilter.loadtrans()
@@ -159,296 +380,2173 @@ def cube2img(cube,write=None,wrange=None,helio=0,filt=None):
         ZP=-2.5*np.log10(lmean*lmean/29979245800.*1e-8*1e-20)-48.6
         print 'Filter zeropoint ',  ZP
 
+    return trans, ZP
 
-    ###############################
-    #now do the actual combination#
-    ###############################
-
-    #fix nans [already masked above]
-    cubdata=np.nan_to_num(cubdata)
-    vardata=np.nan_to_num(vardata)
-
-    #combine trans with delta lambda
-    trans=trans*np.tile(delta_lambda,((cubdata.shape)[2],(cubdata.shape)[1],1))
-    trans=np.transpose(trans)
-
-    #do not vectorise - as this requires too much memory
-    nx=cubdata.shape[1]
-    ny=cubdata.shape[2]
-    img=np.zeros((nx,ny))
-    var=np.zeros((nx,ny))
-    wgt=np.zeros((nx,ny))
-
-    #Do for loop for better memory usage
-    for xx in range(nx):
-        for yy in range(ny):
-            img[xx,yy]=np.sum(cubdata[:,xx,yy]*trans[:,xx,yy]*mask[:,xx,yy])
-            var[xx,yy]=np.sum(vardata[:,xx,yy]*mask[:,xx,yy]*trans[:,xx,yy]**2)
-            wgt[xx,yy]=np.sum(mask[:,xx,yy]*trans[:,xx,yy])
-            if(wgt[xx,yy] <= 0):
-                wgt[xx,yy]=1e-20
-
-    #reassemble - this is constrcuting a mean image weighted by the transmission curve
-    img=np.nan_to_num(img/wgt)
-    var=np.nan_to_num(var/wgt**2)
-
-    #grab 2D wcs
-    wcsimg=wcsc.dropaxis(2)
+def cube2imgs(cube,bands,write=None,helio=0,maxmem=512,separate=False,box=None,native=False):
+
+    """
+    Project a cube in many bands at once, reading the cube a single time.
+    Each band is equivalent to a call to cube2img with the same filt/wrange.
+
+    bands -> a list of bands, each being a filter ID (as understood by the 
+             filter package, e.g. 129 for SDSS r) or a (minl,maxl) range 
+    write -> if set to string, write all the images in output. 
+             By default a single multi-extension file is written, with an 
+             image and var extension per band (EXTNAME band name and band_VAR)
+             and ZPAB in the header of each extension 
+    separate -> if True, write is used as prefix and each band is written 
+             to prefix_band.fits in the same format as cube2img
+    helio -> passes heliocentric correction in km/s 
+    maxmem -> memory ceiling in MB for the wavelength slabs 
+    box -> if set to (xmin,ymin,xmax,ymax), project only this spatial box
+    native -> if True, work in float32 as the cube [see slabproject]
     
-    #if write, write
+    Return lists of images, variances, zeropoints and band names, plus the wcs
+    
+    """
+
+    import numpy as np
+    from astropy.io import fits 
+    from astropy import wcs
+
+    #open the cube [slabs are read only when needed]
+    with opencube(cube,helio=helio) as mcube:
+        wavec=mcube.wave
+
+        #find delta lambda
+        delta_lambda=wavec-np.roll(wavec,1)
+        delta_lambda[0]=wavec[1]-wavec[0]
+
+        #build all the transmission curves
+        nband=len(bands)
+        trans=np.zeros((len(wavec),nband))
+        zps=[]
+        names=[]
+        for bb,band in enumerate(bands):
+            if(np.isscalar(band)):
+                tr,ZP=bandtrans(wavec,filt=band)
+                names.append('FILT{}'.format(band))
+            else:
+                tr,ZP=bandtrans(wavec,wrange=band)
+                names.append('W{:.0f}-{:.0f}'.format(band[0],band[1]))
+            trans[:,bb]=tr*delta_lambda
+            zps.append(ZP)
+
+        #single pass on the cube 
+        wmin,wmax,xmin,xmax,ymin,ymax=mcube.window(box=box)
+        img,var,wgt=slabproject(mcube.data[:,ymin:ymax,xmin:xmax],mcube.stat[:,ymin:ymax,xmin:xmax],
+                                trans,maxmem=maxmem,native=native)
+        wgt[wgt <= 0]=1e-20
+        img=np.nan_to_num(img/wgt)
+        var=np.nan_to_num(var/wgt**2)
+        imgs=[img[bb] for bb in range(nband)]
+        imgvars=[var[bb] for bb in range(nband)]
+
+        #grab 2D wcs
+        wcsimg=wcs.WCS(mcube.subheader(wmin,wmax,xmin,xmax,ymin,ymax)).dropaxis(2)
+
     if(write):
-        print 'Writing to ', write
-        header=wcsimg.to_header()
-        header["ZPAB"]=ZP
-        hduhead = fits.PrimaryHDU(img,header=header)
-        hduimg  = fits.ImageHDU(img)
-        hduvar  = fits.ImageHDU(var)
-        hdulist = fits.HDUList([hduhead,hduimg,hduvar])
-        hdulist.writeto(write,clobber=True)
+        if(separate):
+            for bb in range(nband):
+                outname='{}_{}.fits'.format(write,names[bb])
+                print 'Writing to ', outname
+                header=wcsimg.to_header()
+                header["ZPAB"]=zps[bb]
+                hduhead = fits.PrimaryHDU(imgs[bb],header=header)
+                hduimg  = fits.ImageHDU(imgs[bb])
+                hduvar  = fits.ImageHDU(imgvars[bb])
+                hdulist = fits.HDUList([hduhead,hduimg,hduvar])
+                hdulist.writeto(outname,clobber=True)
+        else:
+            print 'Writing to ', write
+            hdulist = fits.HDUList([fits.PrimaryHDU(header=wcsimg.to_header())])
+            for bb in range(nband):
+                header=wcsimg.to_header()
+                header["ZPAB"]=zps[bb]
+                hdulist.append(fits.ImageHDU(imgs[bb],header=header,name=names[bb]))
+                hdulist.append(fits.ImageHDU(imgvars[bb],header=header,name=names[bb]+'_VAR'))
+            hdulist.writeto(write,clobber=True)
 
-    return img, var, wcsimg
+    return imgs, imgvars, zps, names, wcsimg
 
-def cube2spec(cube,x,y,s,write=None,shape='box',helio=0,mask=None,twod=True,tovac=False,idsource=None):
+def slabproject(cubdata,vardata,weights,maxmem=512,native=False):
 
-    """ 
-    Extract a 1D spectrum from a cube at position x,y in box or circle of radius s 
+    """
+    Reduce a cube over the wavelength axis using a set of weights 
+    (e.g. transmission*delta lambda), working on slabs of wavelength 
+    so that only a bounded amount of memory is used at any time. 
 
-    If shape = 'mask', then mask is a boolean mask and pixels within it will be extracted form 
-    argument mask. Mask is a datacube [e.g. from cubex]
+    Pixels that are not finite in cubdata are excluded from all sums 
+    (equivalent to a 0/1 mask cube).
 
-    idsource -> if > 0, then only pixels in mask with that ID will be extracted
+    cubdata -> the data cube (wave,y,x); memory mapped arrays are fine
+    vardata -> the variance cube 
+    weights -> the weight of each slice along wavelength. If 2D (wave,band)
+               all the bands are computed in the same pass on the cube
+    maxmem  -> memory ceiling in MB for the slab buffers 
+    native  -> if True, slabs are kept and contracted in float32 [as MUSE cubes],
+               halving the buffers; only the 2D sums are accumulated in float64
 
-    helio passes an heliocentric correction in km/s [should be 0 with pipeline v1.2.1]
+    The slab buffers are allocated once and reused, so no cube-sized 
+    temporaries are created. 
 
-    twod -> also reconstruct a 2D spec
+    Return the weighted sum of data, of variance (with weights**2)
+    and of the valid weights, each as a 2D (y,x) image, or as 
+    (band,y,x) if weights are 2D.
 
-    tovac -> if true, return wavelengths in vacuum 
+    """
 
-    write -> output file 
+    import numpy as np
+
+    nwv,ny,nx=cubdata.shape
+    weights=np.asarray(weights,dtype=np.float64)
+    oned=(weights.ndim == 1)
+    if(oned):
+        weights=weights.reshape(nwv,1)
+    nband=weights.shape[1]
+
+    img=np.zeros((nband,ny*nx))
+    var=np.zeros((nband,ny*nx))
+    wgt=np.zeros((nband,ny*nx))
+
+    #slices with zero weight do not contribute - do not even read them
+    used=np.nonzero(np.any(weights != 0,axis=1))[0]
+    if(len(used) == 0):
+        used=[0,-1]
+
+    #data, variance and mask buffers, plus a boolean mask
+    if(native):
+        dtype=np.float32
+    else:
+        dtype=np.float64
+    itemsize=np.dtype(dtype).itemsize
+    nslab=slabsize(cubdata.shape,maxmem,nbuffers=3+1./itemsize,itemsize=itemsize)
+    dbuf=np.empty((nslab,ny*nx),dtype=dtype)
+    vbuf=np.empty((nslab,ny*nx),dtype=dtype)
+    mbuf=np.empty((nslab,ny*nx),dtype=dtype)
+    gbuf=np.empty((nslab,ny*nx),dtype=bool)
+
+    for w0 in range(used[0],used[-1]+1,nslab):
+        w1=min(w0+nslab,used[-1]+1)
+        nn=w1-w0
+        wslab=weights[w0:w1].astype(dtype)
+        if not np.any(wslab):
+            continue
+
+        #load the slab in the buffers and mask NaNs in place
+        dslab=dbuf[:nn]
+        dslab.reshape(nn,ny,nx)[...]=cubdata[w0:w1]
+        good=np.isfinite(dslab,out=gbuf[:nn])
+        dslab[~good]=0.
+        mslab=mbuf[:nn]
+        mslab[...]=good
+        vslab=vbuf[:nn]
+        vslab.reshape(nn,ny,nx)[...]=vardata[w0:w1]
+        vslab[~good]=0.
+        vslab[~np.isfinite(vslab)]=0.
+
+        #contract along wavelength
+        img+=np.dot(wslab.T,dslab)
+        var+=np.dot((wslab**2).T,vslab)
+        wgt+=np.dot(wslab.T,mslab)
+
+    img=img.reshape(nband,ny,nx)
+    var=var.reshape(nband,ny,nx)
+    wgt=wgt.reshape(nband,ny,nx)
+    if(oned):
+        return img[0], var[0], wgt[0]
+
+    return img, var, wgt
+
+def slabsize(shape,maxmem=512,nbuffers=1,itemsize=8):
 
     """
-    import matplotlib.pyplot as plt
+    Compute how many wavelength slices can be processed together 
+    without exceeding a memory ceiling 
+
+    shape    -> shape of the cube (wave,y,x)
+    maxmem   -> memory ceiling in MB
+    nbuffers -> number of slab-sized buffers needed at the same time
+    itemsize -> bytes per element in the buffers 
+
+    """
+
+    slicebytes=shape[1]*shape[2]*itemsize*nbuffers
+    nslab=int(maxmem*1024.**2/slicebytes)
+
+    return max(1,min(nslab,shape[0]))
+
+def makebigfits(filename,extensions,header=None):
+
+    """
+    Create on disk a fits file with empty (zero) image extensions of given 
+    size, without allocating them in memory. The file can then be opened 
+    in update mode and filled in slabs through the memory mapped data.
+
+    filename   -> output file 
+    extensions -> list of (name,shape,dtype) for each image extension,
+                  or (name,shape,dtype,header) to give also the extension header
+    header     -> optional primary header 
+
+    """
+
     import numpy as np
-    from astropy.io import fits 
+    from astropy.io import fits
 
-    #read the cube
-    cubdata,vardata,wcsc,wavec,regi=readcube(cube,helio=helio)
-    cubdata=np.nan_to_num(cubdata)
+    hdu=fits.PrimaryHDU(header=header)
+    hdu.writeto(filename,clobber=True)
 
-    #if mask extract all True pixels 
-    if('mask' in shape):
-        if(idsource):
-            goodpix=np.nonzero(mask == idsource)
+    fobj=open(filename,'r+b')
+    fobj.seek(0,2)
+    for ext in extensions:
+        name,shape,dtype=ext[0:3]
+        if(len(ext) > 3):
+            header=ext[3]
         else:
-            goodpix=np.nonzero(mask)
-        xpix=goodpix[1]
-        ypix=goodpix[2]
-    else:
-        #If user defined region, grab inner pixels
-        #cut region of interest according to shape
-        xpix=[]
-        ypix=[]
-        xside=np.arange(x-s-1,x+s+1,1)
-        yside=np.arange(y-s-1,y+s+1,1)
-        for xx in xside:
-            for yy in yside:
-                if('box' in shape):
-                    if((abs(xx-x) <= s) & (abs(yy-y) <= s)):
-                        xpix.append(xx)
-                        ypix.append(yy)
-                if('circ' in shape):
-                    dist=np.sqrt((xx-x)**2+(yy-y)**2)
-                    if(dist <= s):
-                        xpix.append(xx)
-                        ypix.append(yy)
-                        
-    #Some checks...
-    #cbmed=np.median(cubdata,axis=0)
-    #cbmed[xpix,ypix]=100000
-    #imgplot=plt.imshow(cbmed,origin='lower')
-    #imgplot.set_clim(-5,5)
-    #plt.show()
+            header=None
+        #header of a dummy extension, then resized 
+        exthdr=fits.ImageHDU(data=np.zeros((1,)*len(shape),dtype=dtype),header=header,name=name).header
+        for ii,nn in enumerate(shape[::-1]):
+            exthdr['NAXIS{}'.format(ii+1)]=nn
+        nbytes=int(np.prod(shape))*np.dtype(dtype).itemsize
+        padded=((nbytes+2879)//2880)*2880
+        fobj.write(exthdr.tostring().encode('ascii'))
+        #reserve the data block 
+        fobj.seek(padded-1,1)
+        fobj.write(b'\0')
+    fobj.close()
 
-    #now make space for the 1d spectrum 
-    spec_flx=np.zeros(len(wavec))
-    spec_var=np.zeros(len(wavec))
-    spec_med=np.zeros(len(wavec))
+def cumcubename(cube):
 
-    #if want 2d, prepapre space for it
-    #This simulates a slit in the x direction 
-    #adding up all the flux on the y
-    if(twod):
-        #find unique pixels (not all x,y) - need to sort for later
-        uxpix=np.sort(list(set(xpix)))
-        uypix=np.sort(list(set(ypix)))
-        npix=len(uxpix)
-        nwv=len(wavec)
-        twodspec=np.zeros((nwv,npix))
-        twoderr=np.zeros((nwv,npix))
-
-    #loop over all wavelength to fill in spectrum
-    for ii,ww in enumerate(wavec):
-        #get the total spec in the aperture, 
-        #summing over all the pixels 
-        spec_flx[ii]=np.sum(cubdata[ii,xpix,ypix])
-        spec_var[ii]=np.sum(vardata[ii,xpix,ypix])
-        spec_med[ii]=np.median(cubdata[ii,xpix,ypix])
-        
-        #fill in 2D spectrum in a box 
-        if(twod):
-            #sum only on the full x-extent
-            for jj in range(npix):
-                #add all the pixels in y
-                twodspec[ii,jj]=np.sum(cubdata[ii,uxpix[jj],uypix])
-                twoderr[ii,jj]=np.sum(vardata[ii,uxpix[jj],uypix])
-   
-    #extract the 2D image with a small buffer around
-    if(twod):
-        twodimg=np.median(cubdata[:,uxpix[0]-5:uxpix[-1]+6,uypix[0]-5:uypix[-1]+6],axis=0)
-        #from variance to error
-        twoderr=np.sqrt(twoderr)
+    """ Name of the cumulative sidecar of a cube """
 
-    #mean in aperture
-    totpix=len(xpix)
-    spec_flx=spec_flx/totpix
-    spec_err=np.sqrt(spec_var/totpix)
- 
-    
-    #if set, convert to vacuum using airtovac.pro conversion
-    if(tovac):
-        #save current wave
-        wavec=np.array(wavec,dtype=np.float64)
-        wave_air=wavec
-        
-        sigma2 = (1e4/wavec)**2.    
-        fact = 1.+5.792105e-2/(238.0185-sigma2)+1.67917e-3/(57.362-sigma2)
-        wavec = wavec*fact  
+    return cube.split('.fits')[0]+'_CUMSUM.fits'
 
-    #tested and working
-    #fl=open('test.txt','w') 
-    #for rr in range(len(wavec)):
-    #    fl.write("{} {}\n".format(wave_air[rr],wavec[rr]))
-    #fl.close()
+def makecumcube(cube,output=None,maxmem=512):
 
-    #if write, write
-    if(write):
-        hduflx  = fits.PrimaryHDU(spec_flx) #mean in region
-        hduerr  = fits.ImageHDU(spec_err) #associated errors
-        hduwav  = fits.ImageHDU(wavec)    #wave
-        hdumed  = fits.ImageHDU(spec_med) #median spectrum 
-        if(twod): #twod 
-            hdu2flx  = fits.ImageHDU(twodspec)
-            hdu2err  = fits.ImageHDU(twoderr)
-            hduimg   = fits.ImageHDU(twodimg)
-            hdulist = fits.HDUList([hduflx,hduerr,hduwav,hdumed,hdu2flx,hdu2err,hduimg])
-        else:
-            hdulist = fits.HDUList([hduflx,hduerr,hduwav,hdumed])
-        hdulist.writeto(write,clobber=True)
+    """
+    Build in a single streaming pass the cumulative sums along wavelength 
+    of DATA, STAT and of the number of valid (finite) pixels. With this,
+    any tophat image over slices w0:w1 is a difference of planes w1 and w0.
+
+    Non finite DATA are excluded from all the sums, as in cube2img. 
+    Sums are stored in float64 [count in int16] with an extra leading 
+    plane of zeros, so the sidecar is about 4.5 times the DATA size 
+    [e.g. ~7 GB next to a 1.5 GB DATA extension of a 1'x1' cube]. 
+    It pays off only when many tophat images are made from the same 
+    cube, so it is never built automatically and cube2img reads it 
+    only with cumsum=True 
+
+    cube   -> the cube file name 
+    output -> sidecar name, default cube_CUMSUM.fits [used by cube2img(cumsum=True)]
+    maxmem -> memory ceiling in MB for the slab buffers 
 
-    return wavec, spec_flx, spec_err, spec_med
+    """
+
+    import numpy as np
+    from astropy.io import fits
 
-def cubestat(cube,region=False,delta=10):
+    if(output is None):
+        output=cumcubename(cube)
+
+    with opencube(cube) as mcube:
+        nwv,ny,nx=mcube.shape
+
+        #record the cube this sidecar refers to
+        header=sidecarheader(cube)
+
+        makebigfits(output,[('CUMDATA',(nwv+1,ny,nx),np.float64),
+                            ('CUMSTAT',(nwv+1,ny,nx),np.float64),
+                            ('CUMCOUNT',(nwv+1,ny,nx),np.int16)],header=header)
+
+        cumfits=fits.open(output,mode='update',memmap=True)
+        cumdata=cumfits['CUMDATA'].data
+        cumstat=cumfits['CUMSTAT'].data
+        cumcount=cumfits['CUMCOUNT'].data
+
+        #running totals 
+        totdata=np.zeros((ny,nx))
+        totstat=np.zeros((ny,nx))
+        totcount=np.zeros((ny,nx),dtype=np.int16)
+        cumdata[0]=0.
+        cumstat[0]=0.
+        cumcount[0]=0
+
+        nslab=slabsize(mcube.shape,maxmem,nbuffers=5)
+        for w0 in range(0,nwv,nslab):
+            w1=min(w0+nslab,nwv)
+            dslab,vslab=mcube.slab(w0,w1,stat=True)
+            good=np.isfinite(dslab)
+            dslab[~good]=0.
+            vslab[~good]=0.
+            vslab[~np.isfinite(vslab)]=0.
+
+            #cumulative sums carried from the previous slab
+            cumdata[w0+1:w1+1]=np.cumsum(dslab,axis=0,dtype=np.float64)+totdata
+            cumstat[w0+1:w1+1]=np.cumsum(vslab,axis=0,dtype=np.float64)+totstat
+            cumcount[w0+1:w1+1]=np.cumsum(good,axis=0,dtype=np.int16)+totcount
+            totdata=np.array(cumdata[w1])
+            totstat=np.array(cumstat[w1])
+            totcount=np.array(cumcount[w1])
+
+        cumfits.close()
+
+def opencumcube(cube):
 
     """
-    Take the cube and measure the pixel rms in chunks of 10A
-    within a specified region 
+    Open the cumulative sidecar of a cube, if it exists and it is 
+    up to date with the cube. Return None otherwise 
 
-    region -> False, use the entire cube
-              or set to min x,y max x,y or region to be used
+    """
 
-    delta  -> wavelength window in A
+    return opensidecar(cube,cumcubename(cube))
+
+def sidecarheader(cube):
 
     """
+    Primary header for a sidecar file, recording the cube it is derived from 
 
-    import numpy as np
-    import matplotlib.pyplot as plt
+    """
 
-    #read the cube
-    cubdata,vardata,wcsc,wavec,reg=readcube(cube)
-    
-    #grab info on grid
-    lambdabin=wcsc.pixel_scale_matrix[2,2]*1e10 #in A
-    pixbin=wcsc.pixel_scale_matrix[1,1]*3600 #in as
+    import os
+    from astropy.io import fits
 
-    #find blocks of lambda within the cube 
-    nblocks=int(np.floor((np.max(wavec)-np.min(wavec))/delta))
+    fstat=os.stat(cube)
+    header=fits.Header()
+    header['SRCCUBE']=os.path.basename(cube)
+    #mtime to the ms, as header floats do not keep all the digits of a timestamp
+    header['SRCMTIME']=round(fstat.st_mtime,3)
+    header['SRCSIZE']=fstat.st_size
 
-    #carve out box if needed in spatial direction
-    if(region):
-        cubdata=cubdata[:,region[0]:region[2],region[1]:region[3]]
+    return header
 
-    #init arrays
-    rms=np.zeros(nblocks)
-    wrms=np.zeros(nblocks)
+def opensidecar(cube,sidecar):
 
-    #loop over the blocks 
-    for ii in range(nblocks):
+    """
+    Open a sidecar file of a cube, if it exists and it is up to date 
+    with the cube [same mtime and size as recorded in its header]. 
+    Return None otherwise, also for files that do not record the cube
 
-        #find pixels in this block
-        wmin=np.min(wavec)+ii*delta
-        wmax=wmin+delta
-        wcent=wmin+0.5*delta
-        wpix=np.where((wavec >= wmin) & (wavec < wmax))
+    """
 
-        rms[ii]=np.std(cubdata[wpix,:,:])
-        wrms[ii]=wcent
+    import os
+    from astropy.io import fits
 
-    #normalise units from pixel to as^2 and from pix to A
-    rms=rms*1e-20/lambdabin/pixbin**2
-   
-    return wrms,rms
+    if not os.path.isfile(sidecar):
+        return None
+
+    sidefits=fits.open(sidecar,memmap=True)
+    fstat=os.stat(cube)
+    if((sidefits[0].header.get('SRCMTIME') != round(fstat.st_mtime,3)) or 
+       (sidefits[0].header.get('SRCSIZE') != fstat.st_size)):
+        print 'Sidecar {} is out of date, ignoring it'.format(sidecar)
+        sidefits.close()
+        return None
 
-def readcube(cube, helio=0):
+    return sidefits
+
+def cumproject(cumfits,wmin,wmax,box=None):
 
     """
-    Read a cube, expanding wcs and wavelegth
+    Sum of DATA, STAT and valid pixels over slices wmin:wmax 
+    from a cumulative sidecar, reading only two planes of each 
 
-    If setting helio!=0 (in km/s), then helio corrections 
-    are applied to the data 
+    cumfits -> the opened sidecar (see opencumcube)
+    box     -> if set to (xmin,ymin,xmax,ymax), only this spatial box
 
-    Note that from v1.2, the ESO pipeline applies correction to 
-    data regarding baryocentric heliocentric correction, so helio should be left a 0
-  
-    MUSE wavelength solution is in air!!
+    """
+
+    import numpy as np
+
+    if(box is None):
+        box=(0,0,cumfits['CUMDATA'].header['NAXIS1'],cumfits['CUMDATA'].header['NAXIS2'])
+    xmin,ymin,xmax,ymax=box
+
+    sums=[]
+    for ext in ['CUMDATA','CUMSTAT','CUMCOUNT']:
+        top=cumfits[ext].section[wmax,ymin:ymax,xmin:xmax]
+        bottom=cumfits[ext].section[wmin,ymin:ymax,xmin:xmax]
+        sums.append(np.asarray(top,dtype=np.float64)-bottom)
+
+    return sums[0],sums[1],sums[2]
+
+def satcubename(cube):
+
+    """ Name of the summed-area table sidecar of a cube """
+
+    return cube.split('.fits')[0]+'_SAT.fits'
+
+def makesatcube(cube,output=None,maxmem=512):
+
+    """
+    Build in a single streaming pass the summed-area tables (2D cumulative sums)
+    of each slice of DATA and STAT. With these, the sum over any box at 
+    any wavelength costs four reads, independent of the box size. 
+
+    Non finite values are set to 0, as in cube2spec. Tables are stored 
+    in float64 with a leading row and column of zeros, so the sidecar is 
+    about 4 times the DATA size  
+
+    cube   -> the cube file name 
+    output -> sidecar name, default cube_SAT.fits [used by boxspec]
+    maxmem -> memory ceiling in MB for the slab buffers 
 
     """
 
+    import numpy as np
     from astropy.io import fits
-    import astropy as aspy
-    from astropy.wcs import WCS
+
+    if(output is None):
+        output=satcubename(cube)
+
+    with opencube(cube) as mcube:
+        nwv,ny,nx=mcube.shape
+
+        makebigfits(output,[('SATDATA',(nwv,ny+1,nx+1),np.float64),
+                            ('SATSTAT',(nwv,ny+1,nx+1),np.float64)],header=sidecarheader(cube))
+
+        satfits=fits.open(output,mode='update',memmap=True)
+        satdata=satfits['SATDATA'].data
+        satstat=satfits['SATSTAT'].data
+
+        nslab=slabsize(mcube.shape,maxmem,nbuffers=5)
+        for w0 in range(0,nwv,nslab):
+            w1=min(w0+nslab,nwv)
+            dslab,vslab=mcube.slab(w0,w1,stat=True)
+            dslab[~np.isfinite(dslab)]=0.
+            vslab[~np.isfinite(vslab)]=0.
+            satdata[w0:w1,0,:]=0.
+            satdata[w0:w1,:,0]=0.
+            satstat[w0:w1,0,:]=0.
+            satstat[w0:w1,:,0]=0.
+            satdata[w0:w1,1:,1:]=np.cumsum(np.cumsum(dslab,axis=1,dtype=np.float64),axis=2)
+            satstat[w0:w1,1:,1:]=np.cumsum(np.cumsum(vslab,axis=1,dtype=np.float64),axis=2)
+
+        satfits.close()
+
+def opensatcube(cube):
+
+    """
+    Open the summed-area table sidecar of a cube, if it exists and it is 
+    up to date with the cube. Return None otherwise 
+
+    """
+
+    return opensidecar(cube,satcubename(cube))
+
+def boxspec(cube,x,y,s,maxmem=512):
+
+    """
+    Extract box aperture spectra at many positions at once from the summed-area 
+    table sidecar of a cube (see makesatcube). The cost per position does not 
+    depend on the box size. 
+
+    cube -> the cube file name [the sidecar must exist]
+    x,y  -> arrays of box centres in pixels [0-index, x along NAXIS1]
+    s    -> half size of the boxes, scalar or array; each box spans 
+            x-s..x+s and y-s..y+s inclusive, clipped to the cube
+    maxmem -> memory ceiling in MB for the slabs of output 
+
+    Return wave, the mean and error spectra as (position,wave) arrays 
+    [with the same normalisation as cube2spec] and the number of pixels per box
+
+    """
+
     import numpy as np
 
-    #open file 
-    cfits=fits.open(cube)
-    
-    #grab the data
-    cubdata=cfits['DATA'].data
-    vardata=cfits['STAT'].data
-
-    #compute the helio correction on the fly
-    if(helio != 0):
-        hel_corr = np.sqrt( (1. + helio/299792.458) / (1. - helio/299792.458) )
-        print 'Helio centric correction of {} km/s and lambda {}'.format(helio,hel_corr) 
-    else:
-        hel_corr=1.0
-
-    #reconstruct wave array
-    #wave in air
-    sz=cubdata.shape
-    delta_lambda=cfits[1].header["CD3_3"]*hel_corr
-    zero_lambda=cfits[1].header["CRVAL3"]*hel_corr
-    wavec=np.arange(0,sz[0],1)*delta_lambda+zero_lambda
- 
-    #compute ds9 style regions
-    regions=np.arange(0,sz[0],1)+1
+    satfits=opensatcube(cube)
+    if(satfits is None):
+        raise IOError('No valid summed-area table for {}; run makesatcube first'.format(cube))
+
+    with opencube(cube) as mcube:
+        wavec=mcube.wave
+        nwv,ny,nx=mcube.shape
+
+    #corners of the boxes in the padded tables 
+    x=np.atleast_1d(np.asarray(x,dtype=int))
+    y=np.atleast_1d(np.asarray(y,dtype=int))
+    s=np.zeros(len(x),dtype=int)+np.asarray(s,dtype=int)
+    x0=np.clip(x-s,0,nx)
+    x1=np.clip(x+s+1,0,nx)
+    y0=np.clip(y-s,0,ny)
+    y1=np.clip(y+s+1,0,ny)
+    npix=(x1-x0)*(y1-y0)
+
+    satdata=satfits['SATDATA'].data
+    satstat=satfits['SATSTAT'].data
+    spec_flx=np.zeros((len(x),nwv))
+    spec_var=np.zeros((len(x),nwv))
+
+    #gather the four corners, a slab of wavelength at a time 
+    nslab=slabsize((nwv,len(x),4),maxmem,nbuffers=4)
+    for w0 in range(0,nwv,nslab):
+        w1=min(w0+nslab,nwv)
+        for table,spec in [(satdata,spec_flx),(satstat,spec_var)]:
+            slab=table[w0:w1]
+            spec[:,w0:w1]=(slab[:,y1,x1]-slab[:,y0,x1]-slab[:,y1,x0]+slab[:,y0,x0]).T
+
+    satfits.close()
 
-    #suck up the wcs 
-    wcsc=WCS(header=cfits[1].header)
-    #wcscube.printwcs()
-    
-    #close unit
-    cfits.close()
+    #mean in aperture
+    spec_err=np.sqrt(spec_var/np.maximum(npix,1)[:,None])
+    spec_flx=spec_flx/np.maximum(npix,1)[:,None]
+
+    return wavec, spec_flx, spec_err, npix
+
+def speccubename(cube):
+
+    """ Name of the spectrum-major sidecar of a cube """
+
+    return cube.split('.fits')[0]+'_SPEC.fits'
+
+def makespeccube(cube,output=None,maxmem=512):
+
+    """
+    Write a transposed copy of DATA and STAT with axes (y,x,wave), so that 
+    each spectrum is contiguous on disk and a row of spaxels is a single 
+    contiguous chunk. Once this sidecar exists and is up to date, MuseCube 
+    uses it for spaxel and narrow cutout reads [hence readcube with a box 
+    and cube2spec pick it up transparently].
+
+    The cube is transposed in blocks of rows, the sidecar has the 
+    same size as the cube 
+
+    cube   -> the cube file name 
+    output -> sidecar name, default cube_SPEC.fits 
+    maxmem -> memory ceiling in MB for the row buffers 
+
+    """
+
+    import numpy as np
+    from astropy.io import fits
+
+    if(output is None):
+        output=speccubename(cube)
+
+    #do not go through the cache or an existing sidecar, which is overwritten
+    with MuseCube(cube) as mcube:
+        if(mcube.specfits is not None):
+            mcube.specfits.close()
+            mcube.specfits=None
+        nwv,ny,nx=mcube.shape
+        dtype=np.dtype('f{}'.format(abs(mcube.header['BITPIX'])//8))
+
+        makebigfits(output,[('SPECDATA',(ny,nx,nwv),dtype),
+                            ('SPECSTAT',(ny,nx,nwv),dtype)],header=sidecarheader(cube))
+
+        specfits=fits.open(output,mode='update',memmap=True)
+        specdata=specfits['SPECDATA'].data
+        specstat=specfits['SPECSTAT'].data
+
+        #rows of spaxels per block [data, stat and their transposed copies]
+        nrows=slabsize((ny,nx,nwv),maxmem,nbuffers=4,itemsize=dtype.itemsize)
+        for y0 in range(0,ny,nrows):
+            y1=min(y0+nrows,ny)
+            dblock,vblock=mcube.cutout(0,nx,y0,y1,stat=True)
+            specdata[y0:y1]=dblock.transpose(1,2,0)
+            specstat[y0:y1]=vblock.transpose(1,2,0)
+
+        specfits.close()
+
+def pyramidname(cube,level):
 
+    """ Name of the pyramid level of a cube binned by a factor level """
+
+    return cube.split('.fits')[0]+'_BIN{}.fits'.format(level)
+
+def makepyramid(cube,levels=[2,4,8],specbin=None,maxmem=512):
+
+    """
+    Build binned versions of a cube [a pyramid for quick look and first-pass 
+    detection] in a single streaming pass over the cube. Each level is written 
+    to cube_BIN<level>.fits as a cube with DATA and STAT extensions and 
+    adjusted wcs, so that all the functions that take a cube can run on it.
+    
+    levels  -> spatial binning factors 
+    specbin -> spectral binning factor, the same for all the levels, or  
+               None to bin by the spatial factor also in wavelength 
+    maxmem  -> memory ceiling in MB for the slabs read at once 
+
+    Binned DATA are the sum over the spaxels and the mean over the slices 
+    of the finite pixels in each bin, rescaled to the full bin size 
+    [flux per binned spaxel]. STAT is propagated accordingly. Bins with no 
+    finite pixels are NaN. Edges are padded, so partial bins at the edges 
+    are extrapolated from the pixels available. 
+
+    """
+
+    import numpy as np
+    from astropy.io import fits
+
+    with opencube(cube) as mcube:
+        nwv,ny,nx=mcube.shape
+        header=mcube.header
+        primary=mcube.fits[0].header.copy()
+        primary.update(sidecarheader(cube))
+
+        #spatial and spectral factor of each level
+        factors=[]
+        for level in levels:
+            if(specbin is None):
+                factors.append((level,level))
+            else:
+                factors.append((level,specbin))
+
+        #create the outputs 
+        outfits=[]
+        for fs,fw in factors:
+            shape=(-(-nwv//fw),-(-ny//fs),-(-nx//fs))
+            lhead=header.copy()
+            lhead['CRPIX1']=(header['CRPIX1']-0.5)/fs+0.5
+            lhead['CRPIX2']=(header['CRPIX2']-0.5)/fs+0.5
+            for key in ['CD1_1','CD1_2','CD2_1','CD2_2']:
+                if(key in lhead):
+                    lhead[key]=header[key]*fs
+            #wavelength of the bin centres [MuseCube assumes CRPIX3=1]
+            lhead['CRVAL3']=header['CRVAL3']+0.5*(fw-1)*header['CD3_3']
+            lhead['CD3_3']=header['CD3_3']*fw
+            lhead['PYRBIN']=(fs,'Spatial binning factor')
+            lhead['PYRWBIN']=(fw,'Spectral binning factor')
+            output=pyramidname(cube,fs)
+            makebigfits(output,[('DATA',shape,np.float32,lhead),
+                                ('STAT',shape,np.float32,lhead)],header=primary)
+            outfits.append(fits.open(output,mode='update',memmap=True))
+
+        #slabs are a multiple of all the spectral factors
+        step=1
+        for fs,fw in factors:
+            step=step*fw//gcd(step,fw)
+        maxpad=max([fs for fs,fw in factors])
+        nslab=slabsize((nwv,ny+maxpad,nx+maxpad),maxmem,nbuffers=5)
+        nslab=max(step,nslab//step*step)
+
+        for w0 in range(0,nwv,nslab):
+            w1=min(w0+nslab,nwv)
+            dslab,vslab=mcube.slab(w0,w1,stat=True)
+            good=np.isfinite(dslab)
+            dslab[~good]=0.
+            vslab[~good]=0.
+            vslab[~np.isfinite(vslab)]=0.
+
+            for (fs,fw),lfits in zip(factors,outfits):
+                #sums and counts in each bin 
+                dbin=binblock(dslab,fw,fs)
+                vbin=binblock(vslab,fw,fs)
+                nbin=binblock(good,fw,fs)
+                empty=(nbin == 0)
+                nbin[empty]=1
+                #mean over finite pixels, times the spaxels in a bin
+                lfits['DATA'].data[w0//fw:w0//fw+dbin.shape[0]]=np.where(empty,np.nan,dbin/nbin*fs**2)
+                lfits['STAT'].data[w0//fw:w0//fw+dbin.shape[0]]=np.where(empty,np.nan,vbin/nbin**2*fs**4)
+
+        for lfits in outfits:
+            lfits.close()
+
+def binblock(values,fw,fs):
+
+    """
+    Sum a (wave,y,x) block in bins of fw slices and fs x fs spaxels, 
+    padding with zeros the incomplete bins at the upper edges 
+
+    """
+
+    import numpy as np
+
+    nw,ny,nx=values.shape
+    padded=np.zeros((-(-nw//fw)*fw,-(-ny//fs)*fs,-(-nx//fs)*fs))
+    padded[0:nw,0:ny,0:nx]=values
+    padded=padded.reshape(padded.shape[0]//fw,fw,padded.shape[1]//fs,fs,padded.shape[2]//fs,fs)
+
+    return padded.sum(axis=(1,3,5))
+
+def gcd(a,b):
+
+    """ Greatest common divisor """
+
+    while(b):
+        a,b=b,a%b
+    return a
+
+def pyramidcube(cube,level):
+
+    """
+    Return the file name of a pyramid level of a cube (see makepyramid),
+    checking that it exists and is up to date with the cube 
+
+    """
+
+    name=pyramidname(cube,level)
+    levfits=opensidecar(cube,name)
+    if(levfits is None):
+        raise IOError('No valid level {} for {}; run makepyramid first'.format(level,cube))
+    levfits.close()
+
+    return name
+
+def cube2spec(cube,x,y,s,write=None,shape='box',helio=0,mask=None,twod=True,tovac=False,idsource=None,
+              wrange=None):
+
+    """ 
+    Extract a 1D spectrum from a cube at position x,y in box or circle of radius s 
+
+    If shape = 'mask', then mask is a boolean mask and pixels within it will be extracted form 
+    argument mask. Mask is a datacube [e.g. from cubex]
+
+    Raise ValueError if shape is not 'box', 'circ' or 'mask', or if the 
+    aperture has no pixels inside the cube
+
+    idsource -> if > 0, then only pixels in mask with that ID will be extracted
+
+    helio passes an heliocentric correction in km/s [should be 0 with pipeline v1.2.1]
+
+    twod -> also reconstruct a 2D spec
+
+    tovac -> if true, return wavelengths in vacuum 
+
+    write -> output file 
+
+    wrange -> if set to (minl,maxl), extract only this part of the spectrum
+
+    """
+    import matplotlib.pyplot as plt
+    import numpy as np
+    from astropy.io import fits 
+
+    #check the aperture before touching the cube
+    if(not any(kind in shape for kind in ['box','circ','mask'])):
+        raise ValueError("Unknown shape {}: use 'box', 'circ' or 'mask'".format(shape))
+
+    #if mask extract all True pixels 
+    if('mask' in shape):
+        if(mask is None):
+            raise ValueError("shape='mask' needs a mask")
+        if(idsource):
+            goodpix=np.nonzero(mask == idsource)
+        else:
+            goodpix=np.nonzero(mask)
+        xpix=goodpix[1]
+        ypix=goodpix[2]
+    else:
+        #If user defined region, grab inner pixels
+        #cut region of interest according to shape
+        xside=np.arange(x-s-1,x+s+1,1)
+        yside=np.arange(y-s-1,y+s+1,1)
+        xx,yy=np.meshgrid(xside,yside,indexing='ij')
+        if('box' in shape):
+            inap=(abs(xx-x) <= s) & (abs(yy-y) <= s)
+        else:
+            inap=np.sqrt((xx-x)**2+(yy-y)**2) <= s
+        xpix=xx[inap]
+        ypix=yy[inap]
+    xpix=np.array(xpix,dtype=int)
+    ypix=np.array(ypix,dtype=int)
+    if(len(xpix) == 0):
+        raise ValueError('Empty aperture: no pixels selected by shape {}'.format(shape))
+
+    #open the cube [nothing is read yet]
+    with opencube(cube,helio=helio) as mcube:
+        wmin,wmax,xmin,xmax,ymin,ymax=mcube.window(wrange=wrange)
+        wavec=mcube.wave[wmin:wmax]
+
+        #drop pixels that fall outside the cube 
+        inside=np.where((xpix >= 0) & (xpix < mcube.shape[1]) & (ypix >= 0) & (ypix < mcube.shape[2]))
+        xpix=xpix[inside]
+        ypix=ypix[inside]
+        if(len(xpix) == 0):
+            raise ValueError('Empty aperture: all the pixels fall outside the cube {}'.format(cube))
+
+        #read only the part of the cube around the aperture, 
+        #with a buffer for the 2D image [xpix runs along NAXIS2]
+        x0=max(np.min(xpix)-5,0)
+        x1=min(np.max(xpix)+6,mcube.shape[1])
+        y0=max(np.min(ypix)-5,0)
+        y1=min(np.max(ypix)+6,mcube.shape[2])
+        cubdata,vardata=mcube.cutout(y0,y1,x0,x1,wmin=wmin,wmax=wmax,stat=True)
+        cubdata[~np.isfinite(cubdata)]=0.
+    xpix=xpix-x0
+    ypix=ypix-y0
+                        
+    #Some checks...
+    #cbmed=np.median(cubdata,axis=0)
+    #cbmed[xpix,ypix]=100000
+    #imgplot=plt.imshow(cbmed,origin='lower')
+    #imgplot.set_clim(-5,5)
+    #plt.show()
+
+    #gather all the aperture pixels at once in a (wave,pixel) block 
+    #and sum over the pixels to get the total spec in the aperture
+    apflx=cubdata[:,xpix,ypix]
+    spec_flx=np.sum(apflx,axis=1,dtype=np.float64)
+    spec_var=np.sum(vardata[:,xpix,ypix],axis=1,dtype=np.float64)
+    spec_med=np.median(apflx,axis=1)
+
+    #if want 2d, fill it in a box 
+    #This simulates a slit in the x direction 
+    #adding up all the flux on the y
+    if(twod):
+        #find unique pixels (not all x,y) - sorted 
+        uxpix=np.unique(xpix)
+        uypix=np.unique(ypix)
+        #sum only on the full x-extent, adding all the pixels in y
+        twodspec=np.sum(cubdata[:,uxpix[:,None],uypix[None,:]],axis=2,dtype=np.float64)
+        twoderr=np.sum(vardata[:,uxpix[:,None],uypix[None,:]],axis=2,dtype=np.float64)
+   
+    #extract the 2D image with a small buffer around
+    if(twod):
+        twodimg=np.median(cubdata[:,max(uxpix[0]-5,0):uxpix[-1]+6,max(uypix[0]-5,0):uypix[-1]+6],axis=0)
+        #from variance to error
+        twoderr=np.sqrt(twoderr)
+
+    #mean in aperture
+    totpix=len(xpix)
+    spec_flx=spec_flx/totpix
+    spec_err=np.sqrt(spec_var/totpix)
+ 
+    
+    #if set, convert to vacuum using airtovac.pro conversion
+    if(tovac):
+        wavec=airtovac(wavec)
+
+    #if write, write
+    if(write):
+        if(twod):
+            writespec(write,wavec,spec_flx,spec_err,spec_med,twodspec=twodspec,
+                      twoderr=twoderr,twodimg=twodimg)
+        else:
+            writespec(write,wavec,spec_flx,spec_err,spec_med)
+
+    return wavec, spec_flx, spec_err, spec_med
+
+def cube2slit(cube,x,y,pa,length,width=1.,write=None,step=1.,nsub=10,helio=0,tovac=False,
+              wrange=None,maxmem=512):
+
+    """
+    Extract a pseudo long-slit 2D spectrum from a cube, with the slit 
+    centred at x,y and oriented at an arbitrary position angle. 
+
+    The slit is described once by a sparse matrix of the fraction of each 
+    spaxel falling in each slit position [see slitmatrix], which is then 
+    applied to the cube as a matrix product, one wavelength slab at a time
+
+    x,y    -> slit centre in pixels [0-index, x along NAXIS1]
+    pa     -> position angle of the slit in degrees, east of north  
+    length -> slit length in pixels 
+    width  -> slit width in pixels 
+    step   -> size in pixels of the positions along the slit 
+    nsub   -> spaxels are split in nsub x nsub sub-pixels to compute the overlap 
+    helio  -> heliocentric correction in km/s 
+    tovac  -> if true, return wavelengths in vacuum 
+    wrange -> if set to (minl,maxl), extract only this part of the spectrum
+    maxmem -> memory ceiling in MB for the slabs processed at once 
+    write  -> output file, in the format of cube2spec [read by zfit]
+
+    Return wave, mean, error and median spectrum in the slit, the 2D 
+    spectrum and error as (wave,position) and the offset of the 
+    positions along the slit [pixels, positive towards pa]
+
+    """
+
+    import numpy as np
+
+    #open the cube [nothing is read yet]
+    with opencube(cube,helio=helio) as mcube:
+        wmin,wmax,xmin,xmax,ymin,ymax=mcube.window(wrange=wrange)
+        wavec=mcube.wave[wmin:wmax]
+
+        #slit direction in pixels, from the local north and east 
+        cwcs=mcube.wcs.celestial
+        ra,dec=cwcs.wcs_pix2world([[x,y]],0)[0]
+        offsets=cwcs.wcs_world2pix([[ra,dec+1./3600.],[ra+1./3600./np.cos(np.radians(dec)),dec]],0)
+        north=offsets[0]-[x,y]
+        east=offsets[1]-[x,y]
+        north=north/np.sqrt(np.sum(north**2))
+        east=east/np.sqrt(np.sum(east**2))
+        direction=np.cos(np.radians(pa))*north+np.sin(np.radians(pa))*east
+
+        #box that contains the slit 
+        halfl=0.5*length
+        halfw=0.5*width
+        corners=np.array([[x,y]])+np.array([[sl*halfl*direction[0]-sw*halfw*direction[1],
+                                             sl*halfl*direction[1]+sw*halfw*direction[0]]
+                                            for sl in [-1,1] for sw in [-1,1]])
+        box=(int(np.floor(np.min(corners[:,0])))-1,int(np.floor(np.min(corners[:,1])))-1,
+             int(np.ceil(np.max(corners[:,0])))+2,int(np.ceil(np.max(corners[:,1])))+2)
+        wmin,wmax,xmin,xmax,ymin,ymax=mcube.window(wrange=wrange,box=box)
+        if((xmax <= xmin) or (ymax <= ymin)):
+            raise ValueError('Slit outside cube')
+
+        weights,posc=slitmatrix(x-xmin,y-ymin,direction,length,width,(ymax-ymin,xmax-xmin),step=step,nsub=nsub)
+        weights2=weights.multiply(weights).tocsr()
+        rowweight=np.asarray(weights.sum(axis=1)).ravel()
+
+        #read the slit box [with a buffer for the image]
+        cubdata,vardata=mcube.cutout(max(xmin-5,0),min(xmax+5,mcube.shape[2]),max(ymin-5,0),
+                                     min(ymax+5,mcube.shape[1]),wmin=wmin,wmax=wmax,stat=True)
+    cubdata[~np.isfinite(cubdata)]=0.
+    vardata[~np.isfinite(vardata)]=0.
+    twodimg=np.median(cubdata,axis=0)
+    y0=ymin-max(ymin-5,0)
+    x0=xmin-max(xmin-5,0)
+    cubdata=cubdata[:,y0:y0+ymax-ymin,x0:x0+xmax-xmin]
+    vardata=vardata[:,y0:y0+ymax-ymin,x0:x0+xmax-xmin]
+
+    #apply the slit to slabs of wavelength 
+    nwv=wmax-wmin
+    npix=(ymax-ymin)*(xmax-xmin)
+    twodspec=np.zeros((nwv,len(posc)))
+    twoderr=np.zeros((nwv,len(posc)))
+    nslab=slabsize((nwv,ymax-ymin,xmax-xmin),maxmem,nbuffers=4)
+    for w0 in range(0,nwv,nslab):
+        w1=min(w0+nslab,nwv)
+        twodspec[w0:w1]=weights.dot(cubdata[w0:w1].reshape(w1-w0,npix).T.astype(np.float64)).T
+        twoderr[w0:w1]=weights2.dot(vardata[w0:w1].reshape(w1-w0,npix).T.astype(np.float64)).T
+
+    #mean in slit, as in cube2spec 
+    totpix=np.sum(rowweight)
+    spec_flx=np.sum(twodspec,axis=1)/totpix
+    spec_err=np.sqrt(np.sum(twoderr,axis=1)/totpix)
+    spec_med=np.median(twodspec[:,rowweight > 0]/rowweight[rowweight > 0],axis=1)
+    twoderr=np.sqrt(twoderr)
+
+    #if set, convert to vacuum using airtovac.pro conversion
+    if(tovac):
+        wavec=airtovac(wavec)
+
+    if(write):
+        writespec(write,wavec,spec_flx,spec_err,spec_med,twodspec=twodspec,
+                  twoderr=twoderr,twodimg=twodimg)
+
+    return wavec, spec_flx, spec_err, spec_med, twodspec, twoderr, posc
+
+def slitmatrix(x,y,direction,length,width,shape,step=1.,nsub=10):
+
+    """
+    Sparse matrix of the fraction of each spaxel of an image that falls 
+    in each position along a slit, computed on nsub x nsub sub-pixels 
+
+    x,y       -> slit centre in pixels [0-index, x along the second axis of shape]
+    direction -> unit vector (dx,dy) along the slit in pixels 
+    length    -> slit length in pixels 
+    width     -> slit width in pixels 
+    shape     -> (ny,nx) of the image 
+    step      -> size in pixels of the positions along the slit 
+
+    Return the (position, ny*nx) sparse matrix and the offset of the 
+    centre of each position along the slit 
+
+    """
+
+    import numpy as np
+    from scipy import sparse
+
+    ny,nx=shape
+    npos=int(np.ceil(length/step))
+    posc=(np.arange(npos)+0.5)*step-0.5*npos*step
+
+    #sub-pixel centres, relative to the slit centre
+    sub=(np.arange(nsub)+0.5)/nsub-0.5
+    yy,xx,sy,sx=np.meshgrid(np.arange(ny),np.arange(nx),sub,sub,indexing='ij')
+    dx=(xx+sx-x).ravel()
+    dy=(yy+sy-y).ravel()
+    pixel=(yy*nx+xx).ravel()
+
+    #coordinates along and across the slit 
+    along=dx*direction[0]+dy*direction[1]
+    across=-dx*direction[1]+dy*direction[0]
+    pos=np.floor((along+0.5*npos*step)/step).astype(int)
+    inslit=(np.abs(across) <= 0.5*width) & (pos >= 0) & (pos < npos)
+
+    weights=sparse.coo_matrix((np.zeros(np.sum(inslit))+1./nsub**2,(pos[inslit],pixel[inslit])),
+                              shape=(npos,ny*nx)).tocsr()
+
+    return weights, posc
+
+def airtovac(wave):
+
+    """
+    Convert air wavelengths to vacuum using the airtovac.pro conversion
+
+    """
+
+    import numpy as np
+
+    wave=np.array(wave,dtype=np.float64)
+    sigma2 = (1e4/wave)**2.    
+    fact = 1.+5.792105e-2/(238.0185-sigma2)+1.67917e-3/(57.362-sigma2)
+
+    return wave*fact  
+
+def writespec(write,wavec,spec_flx,spec_err,spec_med,twodspec=None,twoderr=None,twodimg=None):
+
+    """
+    Write a spectrum in the format produced by cube2spec [and read by zfit]
+
+    write -> output file 
+    wavec,spec_flx,spec_err,spec_med -> wave, mean, error and median spectrum 
+    twodspec,twoderr,twodimg -> if set, the 2D spectrum, its error and the image 
+
+    """
+
+    from astropy.io import fits 
+
+    hduflx  = fits.PrimaryHDU(spec_flx) #mean in region
+    hduerr  = fits.ImageHDU(spec_err) #associated errors
+    hduwav  = fits.ImageHDU(wavec)    #wave
+    hdumed  = fits.ImageHDU(spec_med) #median spectrum 
+    if(twodspec is not None): #twod 
+        hdu2flx  = fits.ImageHDU(twodspec)
+        hdu2err  = fits.ImageHDU(twoderr)
+        hduimg   = fits.ImageHDU(twodimg)
+        hdulist = fits.HDUList([hduflx,hduerr,hduwav,hdumed,hdu2flx,hdu2err,hduimg])
+    else:
+        hdulist = fits.HDUList([hduflx,hduerr,hduwav,hdumed])
+    hdulist.writeto(write,clobber=True)
+
+def ellipses2labels(objects,shape,r=2.,overlap='first'):
+
+    """
+    Rasterise a list of ellipses (e.g. the sep objects from findsources) 
+    into an integer label image in a single pass, touching only the 
+    bounding box of each ellipse. Source n in the list gets ID n+1. 
+    Pixels are inside when their centre is within r times the ellipse, 
+    as in sep.mask_ellipse 
+
+    objects -> array with x,y,a,b,theta fields
+    shape   -> the (y,x) size of the image
+    r       -> scale factor of the ellipses 
+    overlap -> which source gets the pixels shared by more ellipses:
+               'first' the first in the list, 'last' the last in the list, 
+               'nearest' the one with the smallest elliptical radius 
+               [in units of each ellipse]
+
+    """
+
+    import numpy as np
+
+    if(overlap not in ['first','last','nearest']):
+        raise ValueError('Unknown overlap policy {}'.format(overlap))
+
+    labels=np.zeros(shape,dtype=np.int32)
+    if(overlap == 'nearest'):
+        best=np.zeros(shape)+np.inf
+
+    for ii,obj in enumerate(objects):
+        cost=np.cos(obj['theta'])
+        sint=np.sin(obj['theta'])
+        a=obj['a']
+        b=obj['b']
+
+        #bounding box of the scaled ellipse
+        dx=r*np.sqrt((a*cost)**2+(b*sint)**2)
+        dy=r*np.sqrt((a*sint)**2+(b*cost)**2)
+        x0=max(int(np.floor(obj['x']-dx)),0)
+        x1=min(int(np.ceil(obj['x']+dx))+1,shape[1])
+        y0=max(int(np.floor(obj['y']-dy)),0)
+        y1=min(int(np.ceil(obj['y']+dy))+1,shape[0])
+        if((x1 <= x0) or (y1 <= y0)):
+            continue
+
+        #elliptical radius of the pixel centres in the box
+        cxx=cost**2/a**2+sint**2/b**2
+        cyy=sint**2/a**2+cost**2/b**2
+        cxy=2.*cost*sint*(1./a**2-1./b**2)
+        ddx=np.arange(x0,x1)[None,:]-obj['x']
+        ddy=np.arange(y0,y1)[:,None]-obj['y']
+        rad=cxx*ddx**2+cyy*ddy**2+cxy*ddx*ddy
+        inside=rad <= r**2
+
+        box=labels[y0:y1,x0:x1]
+        if(overlap == 'first'):
+            take=inside & (box == 0)
+        elif(overlap == 'last'):
+            take=inside
+        else:
+            boxbest=best[y0:y1,x0:x1]
+            take=inside & (rad < boxbest)
+            boxbest[take]=rad[take]
+        box[take]=ii+1
+
+    return labels
+
+def labelspec(cube,labels,outspec=None,ids=None,helio=0,twod=True,tovac=False,maxmem=512):
+
+    """
+    Extract the spectra of all the sources in a label image in a single pass on 
+    the cube. Each spectrum is the same as cube2spec(shape='mask',idsource=ID),
+    but the cube is streamed only once in wavelength slabs and the sums and 
+    medians for all the sources are computed together with grouped reductions
+
+    cube    -> the cube file name
+    labels  -> an integer segmentation image (y,x) [or (1,y,x) as from cubex]
+               with 0 for background, or a list of ellipses from sep 
+               (rasterised with ellipses2labels)
+    outspec -> if set, write each spectrum in outspec/id{ID}.fits 
+               in the format of cube2spec 
+    ids     -> list of IDs to extract; default all IDs in labels 
+    helio   -> heliocentric correction in km/s [should be 0 with pipeline v1.2.1]
+    twod    -> also reconstruct the 2D spectra and images. The image needs 
+               a median along wavelength, so this is done with an additional 
+               read of the rows that contain the sources 
+    tovac   -> if true, return wavelengths in vacuum 
+    maxmem  -> memory ceiling in MB for the slab buffers 
+
+    Return wave, IDs, and the mean, error and median spectra as (nsource,nwave) arrays
+    
+    """
+
+    import numpy as np
+    import os
+
+    #open the cube [slabs are read only when needed]
+    with opencube(cube,helio=helio) as mcube:
+        wavec=mcube.wave
+        nwv,ny,nx=mcube.shape
+
+        #build the label image 
+        if(hasattr(labels,'dtype') and (labels.dtype.names is not None)):
+            labels=ellipses2labels(labels,(ny,nx))
+        labels=np.asarray(labels)
+        if(labels.ndim == 3):
+            labels=labels[0]
+        flatlab=labels.ravel().astype(np.int64)
+
+        #sort the source pixels by label once
+        if(ids is None):
+            ids=np.unique(flatlab[flatlab > 0])
+        ids=np.asarray(ids,dtype=np.int64)
+        missing=np.setdiff1d(ids,flatlab)
+        if(len(missing) > 0):
+            print 'No pixels for IDs {}: spectra not extracted'.format(missing.tolist())
+        ids=np.intersect1d(ids,flatlab)
+        pix=np.nonzero(np.isin(flatlab,ids))[0]
+        pix=pix[np.argsort(flatlab[pix],kind='mergesort')]
+        starts=np.searchsorted(flatlab[pix],ids)
+        ends=np.append(starts[1:],len(pix))
+        totpix=ends-starts
+        nsrc=len(ids)
+
+        #if set, convert to vacuum using airtovac.pro conversion
+        if(tovac):
+            wavec=airtovac(wavec)
+
+        #nothing to extract
+        if(nsrc == 0):
+            print 'No sources in the label image'
+            return wavec, ids, np.zeros((0,nwv)), np.zeros((0,nwv)), np.zeros((0,nwv))
+
+        #space for spectra
+        spec_flx=np.zeros((nsrc,nwv))
+        spec_var=np.zeros((nsrc,nwv))
+        spec_med=np.zeros((nsrc,nwv))
+
+        #for 2D spectra, x runs along NAXIS2 as in cube2spec
+        if(twod):
+            uxpix=[]
+            uypix=[]
+            twodspec=[]
+            twoderr=[]
+            for ll in range(nsrc):
+                uxpix.append(np.unique(pix[starts[ll]:ends[ll]]//nx))
+                uypix.append(np.unique(pix[starts[ll]:ends[ll]]%nx))
+                twodspec.append(np.zeros((nwv,len(uxpix[ll]))))
+                twoderr.append(np.zeros((nwv,len(uxpix[ll]))))
+
+        #single pass on the cube in slabs 
+        nslab=slabsize(mcube.shape,maxmem,nbuffers=2,itemsize=4)
+        for w0 in range(0,nwv,nslab):
+            w1=min(w0+nslab,nwv)
+            dslab=np.array(mcube.data[w0:w1]).reshape(w1-w0,ny*nx)
+            dslab[~np.isfinite(dslab)]=0.
+            vslab=np.array(mcube.stat[w0:w1]).reshape(w1-w0,ny*nx)
+
+            #grouped sums over the sorted pixels
+            dpix=dslab[:,pix]
+            spec_flx[:,w0:w1]=np.add.reduceat(dpix,starts,axis=1,dtype=np.float64).T
+            spec_var[:,w0:w1]=np.add.reduceat(vslab[:,pix],starts,axis=1,dtype=np.float64).T
+            for ll in range(nsrc):
+                spec_med[ll,w0:w1]=np.median(dpix[:,starts[ll]:ends[ll]],axis=1)
+
+            if(twod):
+                dslab=dslab.reshape(w1-w0,ny,nx)
+                vslab=vslab.reshape(w1-w0,ny,nx)
+                for ll in range(nsrc):
+                    ux=uxpix[ll][:,None]
+                    uy=uypix[ll][None,:]
+                    twodspec[ll][w0:w1]=np.sum(dslab[:,ux,uy],axis=2,dtype=np.float64)
+                    twoderr[ll][w0:w1]=np.sum(vslab[:,ux,uy],axis=2,dtype=np.float64)
+
+        #mean in aperture
+        spec_flx=spec_flx/totpix[:,None]
+        spec_err=np.sqrt(spec_var/totpix[:,None])
+
+        #median images around sources, reading only the rows needed 
+        if(twod):
+            medimg=np.zeros((ny,nx))
+            rows=np.zeros(ny,dtype=bool)
+            for ll in range(nsrc):
+                rows[max(uxpix[ll][0]-5,0):uxpix[ll][-1]+6]=True
+            #contiguous runs of rows, read in blocks of at most nrow rows
+            edges=np.diff(np.concatenate([[0],rows.astype(int),[0]]))
+            runstarts=np.nonzero(edges == 1)[0]
+            runends=np.nonzero(edges == -1)[0]
+            nrow=max(1,int(maxmem*1024.**2/(nwv*nx*4*2)))
+            for rstart,rend in zip(runstarts,runends):
+                for r0 in range(rstart,rend,nrow):
+                    r1=min(r0+nrow,rend)
+                    block=np.array(mcube.data[:,r0:r1,:])
+                    block[~np.isfinite(block)]=0.
+                    medimg[r0:r1]=np.median(block,axis=0)
+            twodimg=[]
+            for ll in range(nsrc):
+                twodimg.append(medimg[max(uxpix[ll][0]-5,0):uxpix[ll][-1]+6,
+                                      max(uypix[ll][0]-5,0):uypix[ll][-1]+6])
+
+    #if write, write
+    if(outspec):
+        if not os.path.exists(outspec):
+            os.makedirs(outspec)
+        for ll in range(nsrc):
+            savename="{}/id{}.fits".format(outspec,ids[ll])
+            if(twod):
+                writespec(savename,wavec,spec_flx[ll],spec_err[ll],spec_med[ll],twodspec=twodspec[ll],
+                          twoderr=np.sqrt(twoderr[ll]),twodimg=twodimg[ll])
+            else:
+                writespec(savename,wavec,spec_flx[ll],spec_err[ll],spec_med[ll])
+
+    return wavec, ids, spec_flx, spec_err, spec_med
+
+def cubestat(cube,region=False,delta=10,wrange=None,estimator='std',nsig=3.,ifumask=None,maxmem=512,
+             level=None):
+
+    """
+    Take the cube and measure the pixel rms in chunks of 10A
+    within a specified region 
+
+    region -> False, use the entire cube
+              or set to min x,y max x,y or region to be used
+              [x,y in numpy order, i.e. along NAXIS2,NAXIS1]
+
+    delta  -> wavelength window in A
+
+    wrange -> if set to (minl,maxl), use only this part of the cube 
+
+    estimator -> 'std'  standard deviation of finite pixels, accumulated with 
+                        running moments so that a block is never held in memory
+                 'mad'  1.4826 x median absolute deviation 
+                 'clip' standard deviation after nsig sigma clipping 
+
+    nsig   -> clipping threshold for estimator='clip'
+
+    ifumask -> if set to an IFU mask image (file from make_ifumasks, or array 
+               aligned to the cube, with values IFU*100+stack) also return 
+               the rms in each of the 24 IFUs 
+
+    maxmem -> memory ceiling in MB for the slabs read at once ['std' only]
+
+    level  -> if set, measure on the pyramid level binned by this factor 
+              [see makepyramid]; region and ifumask are then in binned pixels 
+
+    The cube is walked one block at a time, reading only the region and wrange
+
+    Return the block central wavelength and the rms in physical units
+    [and the (block,IFU) rms if ifumask is set]
+
+    """
+
+    import numpy as np
+    from astropy.io import fits
+
+    #quick look on a binned version
+    if(level):
+        cube=pyramidcube(cube,level)
+
+    #open the cube [only DATA is used]
+    with opencube(cube) as mcube:
+        wcsc=mcube.wcs
+    
+        #carve out box if needed in spatial and wave direction
+        if(region):
+            box=[region[1],region[0],region[3],region[2]]
+        else:
+            box=None
+        pwmin,pwmax,xmin,xmax,ymin,ymax=mcube.window(wrange=wrange,box=box)
+        wavec=mcube.wave[pwmin:pwmax]
+    
+        #grab info on grid
+        lambdabin=wcsc.pixel_scale_matrix[2,2]*1e10 #in A
+        pixbin=wcsc.pixel_scale_matrix[1,1]*3600 #in as
+
+        #find blocks of lambda within the cube 
+        nblocks=int(np.floor((np.max(wavec)-np.min(wavec))/delta))
+
+        #group pixels by IFU [0 is outside the IFUs]
+        nifu=24
+        npix=(ymax-ymin)*(xmax-xmin)
+        allpix=np.zeros(npix,dtype=np.int64)
+        if(ifumask is not None):
+            if(isinstance(ifumask,basestring)):
+                with fits.open(ifumask,memmap=False) as ifufits:
+                    ifumask=ifufits[1].data
+            ifuid=np.nan_to_num(np.asarray(ifumask,dtype=np.float64)[ymin:ymax,xmin:xmax]/100.)
+            ifuid=np.clip(ifuid.astype(np.int64),0,nifu).ravel()
+            rmsifu=np.zeros((nblocks,nifu))
+
+        #init arrays
+        rms=np.zeros(nblocks)
+        wrms=np.zeros(nblocks)
+
+        #loop over the blocks 
+        for ii in range(nblocks):
+
+            #find pixels in this block
+            wmin=np.min(wavec)+ii*delta
+            wmax=wmin+delta
+            wcent=wmin+0.5*delta
+            wpix=np.where((wavec >= wmin) & (wavec < wmax))
+            b0=pwmin+wpix[0][0]
+            b1=pwmin+wpix[0][-1]+1
+            wrms[ii]=wcent
+
+            if('std' in estimator):
+                #stream the block in slabs with running moments
+                nslab=slabsize((b1-b0,ymax-ymin,xmax-xmin),maxmem,nbuffers=3)
+                mom=(0.,0.,0.)
+                if(ifumask is not None):
+                    momifu=(np.zeros(nifu+1),np.zeros(nifu+1),np.zeros(nifu+1))
+                for w0 in range(b0,b1,nslab):
+                    slab=mcube.cutout(xmin,xmax,ymin,ymax,wmin=w0,wmax=min(w0+nslab,b1))
+                    slab=slab.reshape(slab.shape[0],npix)
+                    mom=mergemoments(mom,groupmoments(slab,allpix,1))
+                    if(ifumask is not None):
+                        momifu=mergemoments(momifu,groupmoments(slab,ifuid,nifu+1))
+                rms[ii]=np.sqrt(mom[2]/np.maximum(mom[0],1))[0]
+                if(ifumask is not None):
+                    rmsifu[ii]=np.sqrt(momifu[2]/np.maximum(momifu[0],1))[1:]
+            else:
+                #robust estimators need the full block
+                block=mcube.cutout(xmin,xmax,ymin,ymax,wmin=b0,wmax=b1)
+                block=block.reshape(b1-b0,npix)
+                rms[ii]=robustrms(block,estimator=estimator,nsig=nsig)
+                if(ifumask is not None):
+                    for iff in range(nifu):
+                        rmsifu[ii,iff]=robustrms(block[:,ifuid == iff+1],estimator=estimator,nsig=nsig)
+
+
+    #normalise units from pixel to as^2 and from pix to A
+    rms=rms*1e-20/lambdabin/pixbin**2
+   
+    if(ifumask is not None):
+        rmsifu=rmsifu*1e-20/lambdabin/pixbin**2
+        return wrms,rms,rmsifu
+
+    return wrms,rms
+
+def groupmoments(values,groups,ngroups):
+
+    """
+    Compute count, mean and sum of squared deviations of the finite values 
+    of a (wave,pixel) block, grouping the pixels by an integer label 
+
+    values  -> (wave,pixel) array 
+    groups  -> label in 0..ngroups-1 of each pixel 
+    ngroups -> number of groups 
+
+    """
+
+    import numpy as np
+
+    good=np.isfinite(values)
+    gg=np.broadcast_to(groups,values.shape)[good]
+    vv=values[good].astype(np.float64)
+
+    nn=np.bincount(gg,minlength=ngroups).astype(np.float64)
+    mean=np.bincount(gg,weights=vv,minlength=ngroups)/np.maximum(nn,1)
+    m2=np.bincount(gg,weights=(vv-mean[gg])**2,minlength=ngroups)
+
+    return nn,mean,m2
+
+def mergemoments(moma,momb):
+
+    """
+    Combine two sets of (count, mean, sum of squared deviations), 
+    as in the parallel version of the Welford algorithm 
+
+    """
+
+    import numpy as np
+
+    na,meana,m2a=moma
+    nb,meanb,m2b=momb
+    nn=na+nb
+    delta=meanb-meana
+    frac=nb/np.maximum(nn,1)
+    mean=meana+delta*frac
+    m2=m2a+m2b+delta**2*na*frac
+
+    return nn,mean,m2
+
+def robustrms(values,estimator='mad',nsig=3.):
+
+    """
+    Robust rms of the finite values in an array 
+
+    estimator -> 'mad' for 1.4826 x median absolute deviation
+                 'clip' for std after nsig sigma clipping 
+                 'std' for plain std 
+
+    """
+
+    import numpy as np
+    from scipy.stats import sigmaclip
+
+    values=values[np.isfinite(values)]
+    if(len(values) == 0):
+        return 0.
+
+    if('mad' in estimator):
+        return 1.4826*np.median(np.abs(values-np.median(values)))
+    elif('clip' in estimator):
+        c,l,u=sigmaclip(values,nsig,nsig)
+        return np.std(c)
+    else:
+        return np.std(values)
+
+#bright sky lines in air [A], masked by contsub
+SKYLINES=[5577.34,5889.95,5895.92,6300.30,6363.78,6863.96,7316.28,7340.89,7750.64,7794.11,
+          7913.71,7993.33,8344.60,8399.17,8430.17,8827.10,8885.85,8919.61,8943.40,9375.98,9439.67]
+
+def contsub(cube,output=None,width=151,percentile=50.,skylines=SKYLINES,skywidth=5.,
+            nproc=4,maxmem=1024):
+
+    """
+    Subtract the continuum from a cube with a running median (or percentile) 
+    along wavelength, filtering all the spaxels of a tile at once. Tiles are 
+    blocks of rows, distributed to nproc processes that write directly in the 
+    memory mapped output cube 
+
+    cube       -> the cube file name 
+    output     -> output cube, default cube_CONTSUB.fits, with the same 
+                  headers as the input 
+    width      -> width of the running filter in slices 
+    percentile -> percentile of the running filter [50 is the median]
+    skylines   -> wavelengths [A, air] of sky lines to mask, or None
+    skywidth   -> half width in A of the sky line masks 
+    nproc      -> number of processes 
+    maxmem     -> memory ceiling in MB shared by all the processes 
+
+    Sky lines and NaNs are masked and linearly interpolated along wavelength 
+    before filtering; NaNs stay NaN in the output. STAT is copied as is, 
+    i.e. the error of the continuum is neglected 
+
+    Raise RuntimeError, with the rows of the failed tiles, if a process fails
+
+    """
+
+    import numpy as np
+    import multiprocessing
+
+    if(output is None):
+        output=cube.split('.fits')[0]+'_CONTSUB.fits'
+
+    with opencube(cube) as mcube:
+        nwv,ny,nx=mcube.shape
+
+        #slices to mask 
+        skymask=np.zeros(nwv,dtype=bool)
+        if(skylines is not None):
+            for line in skylines:
+                skymask[np.abs(mcube.wave-line) <= skywidth]=True
+
+        #output with the same headers, filled by the workers
+        makebigfits(output,[('DATA',mcube.shape,np.float32,mcube.header),
+                            ('STAT',mcube.shape,np.float32,mcube.fits['STAT'].header)],
+                    header=mcube.fits[0].header)
+
+    #blocks of rows [data, stat and the filter buffers]
+    nrows=slabsize((ny,nx,nwv),maxmem/float(nproc),nbuffers=8)
+    tiles=[(y0,min(y0+nrows,ny)) for y0 in range(0,ny,nrows)]
+
+    print 'Continuum subtraction on {} tiles'.format(len(tiles))
+    workers=[]
+    for pp in range(nproc):
+        p = multiprocessing.Process(target=contsubtiles,args=(cube,output,tiles[pp::nproc],
+                                                              width,percentile,skymask))
+        workers.append(p)
+        p.start()
+
+    #wait for completion of all of them, and check that none failed
+    failed=[]
+    for pp,p in enumerate(workers):
+        p.join()
+        if(p.exitcode != 0):
+            failed.extend(tiles[pp::nproc])
+    if(len(failed) > 0):
+        raise RuntimeError('Continuum subtraction failed for rows {} of {}'.format(sorted(failed),output))
+
+    return output
+
+def contsubtiles(cube,output,tiles,width,percentile,skymask):
+
+    """ Worker of contsub, processing a list of (y0,y1) tiles """
+
+    import numpy as np
+    from astropy.io import fits
+    from scipy import ndimage
+
+    with MuseCube(cube) as mcube:
+        nwv,ny,nx=mcube.shape
+        outfits=fits.open(output,mode='update',memmap=True)
+        index=np.arange(nwv)[:,None]
+
+        for y0,y1 in tiles:
+            data,stat=mcube.cutout(0,nx,y0,y1,stat=True)
+            data=data.reshape(nwv,-1)
+            bad=~np.isfinite(data)
+            masked=bad | skymask[:,None]
+
+            #fill masked slices by linear interpolation along wavelength 
+            prev=np.maximum.accumulate(np.where(masked,-1,index),axis=0)
+            post=np.minimum.accumulate(np.where(masked,nwv,index)[::-1],axis=0)[::-1]
+            filled=np.array(data,dtype=np.float64)
+            filled[bad]=0.
+            cols=np.arange(data.shape[1])[None,:]+np.zeros((nwv,1),dtype=int)
+            fix=masked & (prev >= 0) & (post < nwv)
+            frac=(index-prev)[fix]/np.maximum(post-prev,1)[fix].astype(float)
+            filled[fix]=(1-frac)*filled[prev[fix],cols[fix]]+frac*filled[post[fix],cols[fix]]
+            fix=masked & (prev < 0) & (post < nwv)
+            filled[fix]=filled[post[fix],cols[fix]]
+            fix=masked & (prev >= 0) & (post >= nwv)
+            filled[fix]=filled[prev[fix],cols[fix]]
+
+            #running filter of all the spaxels at once 
+            if(percentile == 50.):
+                continuum=ndimage.median_filter(filled,size=(width,1),mode='nearest')
+            else:
+                continuum=ndimage.percentile_filter(filled,percentile,size=(width,1),mode='nearest')
+
+            outfits['DATA'].data[:,y0:y1,:]=(data-continuum).reshape(nwv,y1-y0,nx)
+            outfits['STAT'].data[:,y0:y1,:]=stat
+
+        outfits.close()
+
+def writecube(hdulist,output,compress=False,quantize=16.,verify=True):
+
+    """
+    Write a cube (or any list of image hdus) to disk, optionally as 
+    tile-compressed fits with one tile per slice, so that the file is 
+    smaller and can be decompressed in parallel by slices (see readcompressed)
+
+    hdulist  -> the HDUList to write [primary hdu is left uncompressed]
+    output   -> output file 
+    compress -> if True, tile-compress the image extensions 
+    quantize -> quantisation level for float data [noise/quantize is 
+                the quantisation step, larger is more accurate]; 
+                if 0 or None float data are compressed losslessly. 
+                Integer data are always compressed losslessly 
+    verify   -> if True, read back the compressed extensions (see readcompressed) 
+                and raise IOError unless lossless ones are identical to the 
+                input [NaN included], and quantised ones have the same NaN pixels 
+
+    Masks should be written with quantize=0
+
+    """
+
+    import numpy as np
+    from astropy.io import fits
+
+    if not (compress):
+        hdulist.writeto(output,clobber=True)
+        return
+
+    outlist=[fits.PrimaryHDU(data=hdulist[0].data,header=hdulist[0].header)]
+    for hdu in hdulist[1:]:
+        if((hdu.data is None) or not isinstance(hdu,fits.ImageHDU)):
+            outlist.append(hdu)
+            continue
+        #one tile per slice [fits order]
+        tile=list(hdu.data.shape[::-1])
+        if(len(tile) > 2):
+            tile[2:]=[1]*(len(tile)-2)
+        if(np.issubdtype(hdu.data.dtype,np.integer)):
+            comp=fits.CompImageHDU(hdu.data,header=hdu.header,name=hdu.name,
+                                   compression_type='RICE_1',tile_size=tile)
+        elif(quantize):
+            comp=fits.CompImageHDU(hdu.data,header=hdu.header,name=hdu.name,
+                                   compression_type='RICE_1',tile_size=tile,quantize_level=quantize)
+        else:
+            comp=fits.CompImageHDU(hdu.data,header=hdu.header,name=hdu.name,
+                                   compression_type='GZIP_2',tile_size=tile,quantize_level=0.)
+        outlist.append(comp)
+
+    fits.HDUList(outlist).writeto(output,clobber=True)
+
+    #round trip check 
+    if(verify):
+        exts=[ii for ii in range(1,len(outlist)) if isinstance(outlist[ii],fits.CompImageHDU)]
+        readback=readcompressed(output,exts)
+        for ii,data in zip(exts,readback):
+            original=hdulist[ii].data
+            if((np.issubdtype(original.dtype,np.integer)) or not (quantize)):
+                same=(data.shape == original.shape) and np.all((data == original) | 
+                                                                 ((data != data) & (original != original)))
+            else:
+                same=(data.shape == original.shape) and np.array_equal(np.isnan(data),np.isnan(original))
+            if not (same):
+                raise IOError('Extension {} of {} does not read back as written'.format(ii,output))
+
+def readcompressed(filename,extnames,nthreads=4):
+
+    """
+    Read tile-compressed image extensions, decompressing them in 
+    parallel threads: in chunks of slices when the installed astropy 
+    supports sections of compressed hdus, otherwise one extension per thread 
+
+    filename -> the fits file 
+    extnames -> names (or indexes) of the extensions to read 
+    nthreads -> number of threads 
+
+    Return the list of arrays, in the order of extnames 
+
+    """
+
+    import numpy as np
+    from astropy.io import fits
+    from multiprocessing.pool import ThreadPool
+
+    hdul=fits.open(filename)
+    outputs=[]
+    chunks=[]
+    for ext in extnames:
+        hdu=hdul[ext]
+        shape=tuple([hdu.header['NAXIS{}'.format(ii)] for ii in range(hdu.header['NAXIS'],0,-1)])
+        bitpix={8:np.uint8,16:np.int16,32:np.int32,64:np.int64,-32:np.float32,-64:np.float64}
+        out=np.empty(shape,dtype=bitpix[hdu.header['BITPIX']])
+        outputs.append(out)
+        if(hasattr(hdu,'section') and (len(shape) > 2)):
+            step=-(-shape[0]//nthreads)
+            for w0 in range(0,shape[0],step):
+                chunks.append((filename,ext,out,w0,min(w0+step,shape[0])))
+        else:
+            chunks.append((filename,ext,out,None,None))
+    hdul.close()
+
+    pool=ThreadPool(processes=nthreads)
+    pool.map(decompresschunk,chunks)
+    pool.close()
+    pool.join()
+
+    return outputs
+
+def decompresschunk(args):
+
+    """ Worker of readcompressed, filling its part of the output in place """
+
+    from astropy.io import fits
+
+    filename,ext,out,w0,w1=args
+    hdul=fits.open(filename)
+    if(w0 is None):
+        out[...]=hdul[ext].data
+    else:
+        out[w0:w1]=hdul[ext].section[w0:w1]
+    hdul.close()
+
+#threads used to decompress tile-compressed cubes 
+DECOMPTHREADS=4
+
+class MuseCube(object):
+
+    """
+    Lazy access to a MUSE cube. The fits file is kept open and memory mapped
+    so that only the bytes that are actually used are read from disk.
+    WCS and wavelength are computed once on opening; DATA and STAT are 
+    read only when (and where) they are accessed. If an up to date 
+    spectrum-major copy exists (see makespeccube), spaxels and narrow 
+    cutouts are read from it instead. Tile-compressed cubes (see writecube) 
+    cannot be memory mapped, and are decompressed in parallel threads 
+    [DECOMPTHREADS] and held in memory on first access. 
+
+    cube  -> the cube file name 
+    helio -> heliocentric correction in km/s applied to the wavelength
+             [should be 0 with pipeline v1.2.1 and later]
+
+    MUSE wavelength solution is in air!!
+
+    """
+
+    def __init__(self,cube,helio=0):
+
+        """ Open the file and parse the header """
+
+        from astropy.io import fits
+        from astropy.wcs import WCS
+        import numpy as np
+
+        self.filename=cube
+        self.helio=helio
+        self.fits=fits.open(cube,memmap=True)
+        self.header=self.fits['DATA'].header
+
+        #set by the cube cache to keep the file open across calls 
+        self.keepopen=False
+        #cache holding the cube, number of callers using it and 
+        #whether it has been dropped from the cache while in use 
+        self.cache=None
+        self.users=0
+        self.dropped=False
+        #in-memory copies of DATA and STAT, if loaded
+        self.memdata=None
+        self.memstat=None
+        #tile-compressed cubes are decompressed in memory when used
+        self.compressed=isinstance(self.fits['DATA'],fits.CompImageHDU)
+        #spectrum-major copy of the cube, if available (see makespeccube)
+        self.specfits=opensidecar(cube,speccubename(cube))
+
+        #size of cube in numpy order 
+        self.shape=(self.header['NAXIS3'],self.header['NAXIS2'],self.header['NAXIS1'])
+
+        #compute the helio correction on the fly
+        if(helio != 0):
+            hel_corr = np.sqrt( (1. + helio/299792.458) / (1. - helio/299792.458) )
+            print 'Helio centric correction of {} km/s and lambda {}'.format(helio,hel_corr) 
+        else:
+            hel_corr=1.0
+
+        #reconstruct wave array
+        #wave in air
+        delta_lambda=self.header["CD3_3"]*hel_corr
+        zero_lambda=self.header["CRVAL3"]*hel_corr
+        self.wave=np.arange(0,self.shape[0],1)*delta_lambda+zero_lambda
+ 
+        #compute ds9 style regions
+        self.regions=np.arange(0,self.shape[0],1)+1
+
+        #suck up the wcs 
+        self.wcs=WCS(header=self.header)
+
+    @property
+    def data(self):
+
+        """ 
+        The memory mapped DATA extension [or a read-only view of its copy 
+        in memory if loaded, as this is shared by all the users of a cached cube]
+
+        """
+
+        if((self.memdata is None) and (self.compressed)):
+            self.load()
+        if(self.memdata is not None):
+            return readonly(self.memdata)
+        return self.fits['DATA'].data
+
+    @property
+    def stat(self):
+
+        """ The memory mapped STAT extension, touched only when asked """
+
+        if((self.memstat is None) and (self.compressed)):
+            self.load()
+        if(self.memstat is not None):
+            return readonly(self.memstat)
+        return self.fits['STAT'].data
+
+    @property
+    def nbytes(self):
+
+        """ Size in bytes of DATA plus STAT """
+
+        return 2*self.shape[0]*self.shape[1]*self.shape[2]*abs(self.header['BITPIX'])//8
+
+    def load(self):
+
+        """ Read DATA and STAT in memory, so that later access does not touch the disk """
+
+        import numpy as np
+
+        if(self.compressed):
+            self.memdata,self.memstat=readcompressed(self.filename,['DATA','STAT'],nthreads=DECOMPTHREADS)
+            return
+
+        self.memdata=np.array(self.fits['DATA'].data)
+        self.memstat=np.array(self.fits['STAT'].data)
+
+    def slab(self,wmin,wmax,stat=False):
+
+        """ 
+        Read slices wmin:wmax along wavelength 
+
+        stat -> if True, return also the variance 
+
+        """
+        
+        import numpy as np
+
+        data=np.array(self.data[wmin:wmax])
+        if(stat):
+            return data, np.array(self.stat[wmin:wmax])
+        return data
+
+    def spaxel(self,x,y,stat=False):
+
+        """ 
+        Read the spectrum at pixel x,y [0-index, x along NAXIS1]
+        
+        stat -> if True, return also the variance 
+
+        """
+
+        import numpy as np
+
+        #contiguous read from the spectrum-major copy 
+        if((self.memdata is None) and (self.specfits is not None)):
+            data=np.array(self.specfits['SPECDATA'].data[y,x])
+            if(stat):
+                return data, np.array(self.specfits['SPECSTAT'].data[y,x])
+            return data
+
+        data=np.array(self.data[:,y,x])
+        if(stat):
+            return data, np.array(self.stat[:,y,x])
+        return data
+
+    def cutout(self,xmin,xmax,ymin,ymax,wmin=0,wmax=None,stat=False):
+
+        """ 
+        Read a sub-cube [0-index, x along NAXIS1, upper edges excluded]
+
+        wmin,wmax -> range of slices to read, default all
+        stat -> if True, return also the variance 
+
+        """
+
+        import numpy as np
+
+        if(wmax is None):
+            wmax=self.shape[0]
+
+        #compressed cubes are decompressed in full
+        if((self.memdata is None) and (self.compressed)):
+            self.load()
+
+        #in memory already 
+        if(self.memdata is not None):
+            data=np.array(self.memdata[wmin:wmax,ymin:ymax,xmin:xmax])
+            if(stat):
+                return data, np.array(self.memstat[wmin:wmax,ymin:ymax,xmin:xmax])
+            return data
+
+        #a cutout narrower than its wavelength range needs fewer 
+        #and longer contiguous reads from the spectrum-major copy 
+        if((self.specfits is not None) and (xmax-xmin < wmax-wmin)):
+            data=np.ascontiguousarray(self.specfits['SPECDATA'].data[ymin:ymax,xmin:xmax,wmin:wmax].transpose(2,0,1))
+            if(stat):
+                return data, np.ascontiguousarray(self.specfits['SPECSTAT'].data[ymin:ymax,xmin:xmax,wmin:wmax].transpose(2,0,1))
+            return data
+
+        #sections read from disk only the requested part
+        data=self.fits['DATA'].section[wmin:wmax,ymin:ymax,xmin:xmax]
+        if(stat):
+            return data, self.fits['STAT'].section[wmin:wmax,ymin:ymax,xmin:xmax]
+        return data
+
+    def window(self,wrange=None,box=None):
+
+        """ 
+        Convert a wavelength interval and/or a spatial box in pixel limits
+
+        wrange -> (minl,maxl) in A, slices with minl <= wave <= maxl are used
+        box    -> (xmin,ymin,xmax,ymax) in pixels [0-index, x along NAXIS1,
+                  upper edges excluded]
+
+        Return wmin,wmax,xmin,xmax,ymin,ymax clipped to the cube 
+
+        """
+
+        import numpy as np
+
+        wmin,wmax=0,self.shape[0]
+        xmin,xmax=0,self.shape[2]
+        ymin,ymax=0,self.shape[1]
+
+        if(wrange is not None):
+            inwin=np.nonzero((self.wave >= wrange[0]) & (self.wave <= wrange[1]))[0]
+            if(len(inwin) == 0):
+                raise ValueError('Wavelength range {} outside cube'.format(wrange))
+            wmin,wmax=inwin[0],inwin[-1]+1
+
+        if(box is not None):
+            xmin,xmax=max(int(box[0]),0),min(int(box[2]),self.shape[2])
+            ymin,ymax=max(int(box[1]),0),min(int(box[3]),self.shape[1])
+
+        return wmin,wmax,xmin,xmax,ymin,ymax
+
+    def subheader(self,wmin,wmax,xmin,xmax,ymin,ymax):
+
+        """ 
+        Return a copy of the DATA header describing the sub-cube  
+        [wmin:wmax,ymin:ymax,xmin:xmax], with NAXIS, CRPIX1/2 and 
+        CRVAL3 adjusted to the new grid 
+
+        """
+
+        header=self.header.copy()
+        header['NAXIS1']=xmax-xmin
+        header['NAXIS2']=ymax-ymin
+        header['NAXIS3']=wmax-wmin
+        header['CRPIX1']=header['CRPIX1']-xmin
+        header['CRPIX2']=header['CRPIX2']-ymin
+        header['CRVAL3']=header['CRVAL3']+wmin*header['CD3_3']
+
+        return header
+
+    def close(self,force=False):
+
+        """ 
+        Release the file handle, unless the cube is held by the cube cache. 
+        For cached cubes, release this user: the cube is closed when dropped 
+        from the cache and no longer in use 
+
+        force -> if True, close also cached cubes 
+
+        """
+
+        if((self.keepopen) and not (force)):
+            with self.cache.lock:
+                self.users=max(self.users-1,0)
+                if(self.users > 0):
+                    return
+                if not (self.dropped):
+                    #now free to go, if the cache is over budget
+                    self.cache.evict()
+                    return
+        self.memdata=None
+        self.memstat=None
+        if(self.specfits is not None):
+            self.specfits.close()
+        self.fits.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+def readonly(array):
+
+    """ Return a read-only view of an array """
+
+    view=array.view()
+    view.flags.writeable=False
+
+    return view
+
+class CubeCache(object):
+
+    """
+    A least-recently-used cache of opened cubes, so that repeated calls on 
+    the same file (e.g. many cube2spec in a notebook) do not re-open the file, 
+    re-parse the header and rebuild wcs and wavelength. 
+    
+    Entries are keyed by path and helio correction, and are re-opened when 
+    the file modification time or size change. When the cubes held exceed 
+    maxmem, the least recently used ones are closed. Each get counts a user 
+    of the cube until the matching close(), and cubes in use are never closed 
+    [e.g. by other threads in muse_server]: cubes dropped while in use are 
+    closed by their last user. 
+
+    maxmem  -> budget in MB for the cubes held [DATA+STAT size]
+    preload -> if True, DATA and STAT are read in memory on first use, 
+               otherwise they stay memory mapped 
+
+    Arrays handed out from cached cubes are shared: do not modify them in place 
+
+    """
+
+    def __init__(self,maxmem=4096,preload=False):
+
+        """ Set up an empty cache """
+
+        from collections import OrderedDict
+        import threading
+
+        self.maxbytes=maxmem*1024**2
+        self.preload=preload
+        self.cubes=OrderedDict()
+        #the cache can be shared by threads [e.g. in muse_server]
+        self.lock=threading.RLock()
+        self.hits=0
+        self.misses=0
+
+    def get(self,cube,helio=0):
+
+        """ Return the MuseCube for this file, opening it if needed """
+
+        import os
+
+        key=(os.path.abspath(cube),helio)
+        fstat=os.stat(cube)
+        signature=(fstat.st_mtime,fstat.st_size)
+
+        with self.lock:
+            if(key in self.cubes):
+                mcube,oldsignature=self.cubes.pop(key)
+                if(oldsignature == signature):
+                    #move to the most recently used end
+                    self.cubes[key]=(mcube,signature)
+                    self.hits+=1
+                    mcube.users+=1
+                    return mcube
+                #file has changed on disk
+                self.drop(mcube)
+
+            self.misses+=1
+            mcube=MuseCube(cube,helio=helio)
+            mcube.keepopen=True
+            mcube.cache=self
+            mcube.users=1
+            if(self.preload):
+                mcube.load()
+            self.cubes[key]=(mcube,signature)
+            self.evict()
+
+        return mcube
+
+    def nbytes(self):
+
+        """ Total size of the cubes held """
+
+        return sum([mcube.nbytes for mcube,signature in self.cubes.values()])
+
+    def evict(self):
+
+        """ 
+        Close least recently used cubes until within budget [keep at least one]. 
+        Cubes in use are skipped, and evicted when released if still over budget
+
+        """
+
+        with self.lock:
+            for key in list(self.cubes.keys()):
+                if((len(self.cubes) <= 1) or (self.nbytes() <= self.maxbytes)):
+                    break
+                mcube,signature=self.cubes[key]
+                if(mcube.users == 0):
+                    del self.cubes[key]
+                    self.drop(mcube)
+
+    def drop(self,mcube):
+
+        """ Close a cube removed from the cache, or leave it to its last user """
+
+        with self.lock:
+            mcube.dropped=True
+            if(mcube.users == 0):
+                mcube.close(force=True)
+
+    def clear(self):
+
+        """ Close all the cubes [cubes in use are closed by their last user] """
+
+        with self.lock:
+            for mcube,signature in self.cubes.values():
+                self.drop(mcube)
+            self.cubes.clear()
+
+#the cube cache in use, if any [see usecache]
+CUBECACHE=None
+
+def usecache(maxmem=4096,preload=False):
+
+    """
+    Enable the cube cache for all the functions in this module that read cubes.
+    Calling it again replaces the cache in use.
+
+    maxmem  -> budget in MB for the cubes held 
+    preload -> if True, DATA and STAT are kept in memory rather than mapped
+
+    """
+
+    global CUBECACHE
+
+    if(CUBECACHE is not None):
+        CUBECACHE.clear()
+    CUBECACHE=CubeCache(maxmem=maxmem,preload=preload)
+
+    return CUBECACHE
+
+def clearcache():
+
+    """
+    Close all cached cubes and disable the cube cache
+    
+    """
+
+    global CUBECACHE
+
+    if(CUBECACHE is not None):
+        CUBECACHE.clear()
+    CUBECACHE=None
+
+def opencube(cube,helio=0):
+
+    """
+    Return a MuseCube for this file, from the cube cache if enabled (see usecache)
+    Call close() on it when done, as for any MuseCube; cached cubes stay open
+
+    """
+
+    if(CUBECACHE is not None):
+        return CUBECACHE.get(cube,helio=helio)
+
+    return MuseCube(cube,helio=helio)
+
+def readcube(cube, helio=0, wrange=None, box=None):
+
+    """
+    Read a cube, expanding wcs and wavelegth
+
+    If setting helio!=0 (in km/s), then helio corrections 
+    are applied to the data 
+
+    Note that from v1.2, the ESO pipeline applies correction to 
+    data regarding baryocentric heliocentric correction, so helio should be left a 0
+  
+    MUSE wavelength solution is in air!!
+
+    wrange -> if set to (minl,maxl) read only slices in this range 
+    box    -> if set to (xmin,ymin,xmax,ymax) read only this spatial box 
+              [pixels, 0-index, x along NAXIS1, upper edges excluded]
+
+    When wrange or box are set, only the corresponding sections are read 
+    from disk and the wcs is adjusted to the sub-cube. Otherwise, data 
+    and variance are returned as memory mapped arrays [read-only views of 
+    the shared copy in memory for cubes preloaded by the cube cache]; 
+    for finer control on what is read, use a MuseCube directly
+
+    """
+
+    from astropy.wcs import WCS
+
+    #open file [closed also on errors]
+    with opencube(cube,helio=helio) as mcube:
+
+        if((wrange is None) and (box is None)):
+            #grab the data
+            cubdata=mcube.data
+            vardata=mcube.stat
+            wcsc=mcube.wcs
+            wavec=mcube.wave
+            regions=mcube.regions
+        else:
+            #read only the sections needed 
+            wmin,wmax,xmin,xmax,ymin,ymax=mcube.window(wrange=wrange,box=box)
+            cubdata,vardata=mcube.cutout(xmin,xmax,ymin,ymax,wmin=wmin,wmax=wmax,stat=True)
+            wcsc=WCS(header=mcube.subheader(wmin,wmax,xmin,xmax,ymin,ymax))
+            wavec=mcube.wave[wmin:wmax]
+            #keep ds9 numbering of the parent cube
+            regions=mcube.regions[wmin:wmax]
+
+    #mapped arrays stay valid after the cube is closed
     return cubdata,vardata,wcsc,wavec,regions
 
 
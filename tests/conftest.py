@@ -0,0 +1,15 @@
+"""
+Make the repository importable as mypython, whatever the name of the
+folder it has been cloned in
+
+"""
+
+import os
+import sys
+import imp
+
+try:
+    import mypython
+except ImportError:
+    root=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.modules['mypython']=imp.load_module('mypython',None,root,('','',imp.PKG_DIRECTORY))
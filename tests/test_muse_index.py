@@ -0,0 +1,32 @@
+"""
+Tests of the index of a reduction tree in ifu/muse_index
+
+"""
+
+import shutil
+import numpy as np
+
+def maketree(tmpdir,folders):
+
+    """ One exposure in each folder of a reduction tree """
+
+    from astropy.io import fits
+
+    for folder in folders:
+        tmpdir.join(folder).ensure(dir=True)
+        fits.PrimaryHDU(np.zeros((3,3))).writeto(str(tmpdir.join(folder,'OBJECT_RED_0001.fits')))
+
+def test_scan_drops_removed_obs(tmpdir):
+
+    """ A full scan removes the files of OB folders deleted from the tree """
+
+    from mypython.ifu import muse_index as idx
+
+    topdir=str(tmpdir)
+    maketree(tmpdir,['OB1/Proc','OB2/Proc','all_combine'])
+    assert idx.scan(topdir,verbose=False) == (3,0)
+
+    shutil.rmtree(str(tmpdir.join('OB2')))
+    assert idx.scan(topdir,verbose=False) == (0,1)
+    assert sorted(set(row['ob'] for row in idx.getfiles(topdir))) == ['OB1','all_combine']
+    assert idx.nexposures('OB2',topdir=topdir) == 0
@@ -0,0 +1,205 @@
+"""
+Regression tests for the photometry in ifu/muse_source
+
+"""
+
+import numpy as np
+import pytest
+
+sep=pytest.importorskip('sep')
+
+def onebyone(x,y,extent,segid):
+
+    """ Reference batching, one source per batch """
+
+    return [np.array([ii]) for ii in range(len(x))]
+
+def writefield(tmpdir,img,segmap,cat):
+
+    """ Write catalogue, segmap, detection and MUSE image on a common wcs """
+
+    from astropy.io import fits
+    from astropy import wcs
+
+    w=wcs.WCS(naxis=2)
+    w.wcs.ctype=['RA---TAN','DEC--TAN']
+    w.wcs.crval=[150.,2.]
+    w.wcs.crpix=[100,100]
+    w.wcs.cd=np.array([[-0.2,0],[0,0.2]])/3600.
+    header=w.to_header()
+
+    fits.BinTableHDU(cat).writeto(str(tmpdir.join('cat.fits')))
+    fits.PrimaryHDU(segmap[None,:,:].astype(np.float32),header=header).writeto(str(tmpdir.join('seg.fits')))
+    fits.PrimaryHDU(img,header=header).writeto(str(tmpdir.join('det.fits')))
+    hdulist=fits.HDUList([fits.PrimaryHDU(img,header=header),
+                          fits.ImageHDU(np.ones(img.shape,dtype=np.float32),header=header)])
+    hdulist[0].header['ZPAB']=25.
+    hdulist.writeto(str(tmpdir.join('img.fits')))
+
+def makefield(tmpdir):
+
+    """
+    Write catalogue, segmap, detection and MUSE image of two elongated
+    neighbours whose Kron ellipses overlap along the major axis
+
+    """
+
+    from astropy.table import Table
+
+    ny,nx=200,240
+    yy,xx=np.mgrid[0:ny,0:nx]
+    img=np.zeros((ny,nx))
+    for x0 in [100.,140.]:
+        img+=100.*np.exp(-((xx-x0)**2/2./8.**2+(yy-100.)**2/2./1.3**2))
+    img+=np.random.RandomState(1).normal(0,0.1,(ny,nx))
+    img=img.astype(np.float32)
+
+    objects,segmap=sep.extract(img,1.,segmentation_map=True,minarea=5)
+    assert len(objects) == 2
+
+    cat=Table(objects)['x','y','a','b','theta']
+    writefield(tmpdir,img,segmap,cat.as_array())
+
+def test_sourcephot_overlapping_ellipses(tmpdir,monkeypatch):
+
+    """ Batched photometry equals one source at a time for overlapping elongated apertures """
+
+    from mypython.ifu import muse_source as ms
+
+    makefield(tmpdir)
+    monkeypatch.chdir(str(tmpdir))
+
+    apertures=ms.kronapertures('cat.fits','seg.fits','det.fits')
+    #the test is meaningful only if the ellipses overlap but their mean radii do not
+    dist=abs(apertures['x'][1]-apertures['x'][0])
+    major=2.5*apertures['kronrad']*apertures['a']
+    mean=2.5*apertures['kronrad']*np.sqrt(apertures['a']*apertures['b'])
+    assert (major.sum() > dist) and (mean.sum() < dist)
+
+    phot=ms.aperturephot(apertures,'img.fits')
+
+    #reference: every source in its own batch
+    monkeypatch.setattr(ms,'apbatches',onebyone)
+    reference=ms.aperturephot(apertures,'img.fits')
+
+    for col in ['FXAP','FXAP_ERR','MAGAP','FXSEG']:
+        assert np.allclose(phot[col],reference[col],rtol=1e-5)
+
+def test_sourcephot_large_segment(tmpdir,monkeypatch):
+
+    """ Pixels of a segment larger than its aperture are masked in the apertures of neighbours """
+
+    from mypython.ifu import muse_source as ms
+
+    ny,nx=120,160
+    img=np.random.RandomState(2).normal(0,0.1,(ny,nx)).astype(np.float32)
+    segmap=np.zeros((ny,nx),dtype=np.int32)
+    #a compact source and a bright extended one, whose segment reaches 
+    #into the circular aperture of the first
+    img[58:63,78:83]+=10.
+    segmap[57:64,77:84]=1
+    img[50:70,92:130]+=5.
+    segmap[50:70,83:130]=2
+    cat=np.zeros(2,dtype=[('x','f8'),('y','f8'),('a','f8'),('b','f8'),('theta','f8')])
+    cat[0]=(80.,60.,1.5,1.5,0.)
+    cat[1]=(94.,60.,1.5,1.5,0.)
+    writefield(tmpdir,img,segmap,cat)
+    monkeypatch.chdir(str(tmpdir))
+
+    #circular apertures, smaller than the segment of the second source
+    apertures=ms.kronapertures('cat.fits','seg.fits','det.fits',circap=1.0)
+    apertures['use_circle'][:]=True
+    assert apertures['rcircap']*2+2 < cat['x'][1]-cat['x'][0]
+
+    phot=ms.aperturephot(apertures,'img.fits')
+    monkeypatch.setattr(ms,'apbatches',onebyone)
+    reference=ms.aperturephot(apertures,'img.fits')
+
+    for col in ['FXAP','FXAP_ERR','MAGAP','FXSEG']:
+        assert np.allclose(phot[col],reference[col],rtol=1e-5)
+
+def test_multiphot_no_images():
+
+    """ An empty list of images is rejected before any file is read """
+
+    from mypython.ifu import muse_source as ms
+
+    with pytest.raises(ValueError):
+        ms.multiphot('cat.fits',[],'seg.fits','det.fits')
+
+def test_findlines_injected(tmpdir):
+
+    """ Lines injected in a noise cube are found at their position, and their footprints extract their spectra """
+
+    from astropy.io import fits
+    from mypython.ifu import muse_source as ms
+    from mypython.ifu import muse_utils as utl
+
+    nwv,ny,nx=60,30,30
+    header=fits.Header()
+    for key,value in [('CTYPE1','RA---TAN'),('CTYPE2','DEC--TAN'),('CTYPE3','AWAV'),
+                      ('CRVAL1',150.),('CRVAL2',2.),('CRVAL3',5000.),
+                      ('CRPIX1',1.),('CRPIX2',1.),('CRPIX3',1.),
+                      ('CD1_1',-0.2/3600.),('CD1_2',0.),('CD2_1',0.),('CD2_2',0.2/3600.),('CD3_3',1.25)]:
+        header[key]=value
+
+    yy,xx=np.mgrid[0:ny,0:nx]
+    data=np.random.RandomState(5).normal(0,1,(nwv,ny,nx))
+    lines=[(8.,8.,20),(20.,22.,40)]
+    for x0,y0,z0 in lines:
+        data[z0-2:z0+3]+=20*np.exp(-((xx-x0)**2+(yy-y0)**2)/2./1.5**2)
+    cube=str(tmpdir.join('cube.fits'))
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.ImageHDU(data.astype(np.float32),header=header,name='DATA'),
+                  fits.ImageHDU(np.ones((nwv,ny,nx),dtype=np.float32),header=header,name='STAT')]).writeto(cube)
+
+    #small memory, so that lines are split across chunks 
+    catalogue=ms.findlines(cube,output=str(tmpdir),maxmem=0.2,nthreads=2)
+    assert len(catalogue) == len(lines)
+    for (x0,y0,z0),line in zip(lines,catalogue):
+        assert abs(line['x']-x0) < 0.5 and abs(line['y']-y0) < 0.5 and abs(line['z']-z0) < 0.5
+
+    footprints=fits.getdata(str(tmpdir.join('lines_footprints.fits')))
+    assert footprints.shape == (1,ny,nx)
+    wave,ids,flux,err,med=utl.labelspec(cube,footprints,twod=False)
+    for ii,srcid in enumerate(ids):
+        rwave,rflux,rerr,rmed=utl.cube2spec(cube,0,0,0,shape='mask',mask=footprints,idsource=srcid,twod=False)
+        assert np.allclose(flux[ii],rflux,rtol=1e-5,atol=1e-6)
+
+def test_forcephot_arrays(tmpdir):
+
+    """ Forced photometry of arrays of positions equals one position at a time """
+
+    from astropy.io import fits
+    from mypython.ifu import muse_source as ms
+
+    rs=np.random.RandomState(6)
+    yy,xx=np.mgrid[0:80,0:100]
+    img=rs.normal(0,1,(80,100))+50.*np.exp(-((xx-30.)**2+(yy-40.)**2)/2./2.**2)
+    hdulist=fits.HDUList([fits.PrimaryHDU(),fits.ImageHDU(img.astype(np.float32)),
+                          fits.ImageHDU(np.ones((80,100),dtype=np.float32))])
+    hdulist[0].header['ZPAB']=25.
+    image=str(tmpdir.join('img.fits'))
+    hdulist.writeto(image)
+
+    #a detection and a limit
+    x=np.array([30.,70.])
+    y=np.array([40.,40.])
+    phot=ms.forcephot(image,x,y,4.)
+    assert list(phot['LIMIT']) == [False,True]
+
+    for ii in range(len(x)):
+        mag,errmag=ms.forcephot(image,x[ii],y[ii],4.)
+        assert np.isclose(phot['MAG'][ii],mag) and np.isclose(phot['MAG_ERR'][ii],errmag)
+
+    #as the original scalar code
+    data=fits.getdata(image,1).astype(np.float64)
+    var=fits.getdata(image,2).astype(np.float64)
+    flux,err,flg=sep.sum_circle(data,x[0],y[0],4.,var=var,bkgann=[10,20])
+    assert np.isclose(phot['MAG'][0],-2.5*np.log10(flux)+25.)
+    flux,err,flg=sep.sum_circle(data,x[1],y[1],4.,var=var,bkgann=[10,20])
+    assert np.isclose(phot['MAG'][1],-2.5*np.log10(2*err)+25.)
+    assert phot['MAG_ERR'][1] == 99.
+
+    table=ms.forcephotimages([image,image],x,y,4.,names=['a','b'])
+    assert np.allclose(table['MAG_a'],phot['MAG']) and np.allclose(table['MAG_b'],phot['MAG'])
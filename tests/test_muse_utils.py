@@ -0,0 +1,212 @@
+"""
+Tests of the cube engines in ifu/muse_utils against the baseline math,
+on small synthetic cubes
+
+"""
+
+import numpy as np
+import pytest
+
+NWV,NY,NX=80,24,30
+
+def makeheader():
+
+    """ A MUSE-like cube header, 0.2 arcsec spaxels and 1.25 A slices """
+
+    from astropy.io import fits
+
+    header=fits.Header()
+    header['CTYPE1']='RA---TAN'
+    header['CTYPE2']='DEC--TAN'
+    header['CTYPE3']='AWAV'
+    header['CUNIT3']='Angstrom'
+    header['CRVAL1']=150.
+    header['CRVAL2']=2.
+    header['CRVAL3']=5000.
+    header['CRPIX1']=1.
+    header['CRPIX2']=1.
+    header['CRPIX3']=1.
+    header['CD1_1']=-0.2/3600.
+    header['CD1_2']=0.
+    header['CD2_1']=0.
+    header['CD2_2']=0.2/3600.
+    header['CD3_3']=1.25
+
+    return header
+
+def writecube(filename,data,stat):
+
+    """ Write DATA and STAT in the MUSE format """
+
+    from astropy.io import fits
+
+    header=makeheader()
+    hdulist=fits.HDUList([fits.PrimaryHDU(),
+                          fits.ImageHDU(data.astype(np.float32),header=header,name='DATA'),
+                          fits.ImageHDU(stat.astype(np.float32),header=header,name='STAT')])
+    hdulist.writeto(filename)
+
+@pytest.fixture
+def cube(tmpdir):
+
+    """ Noise, a continuum gradient, two sources and some NaN spaxels and slices """
+
+    rs=np.random.RandomState(3)
+    yy,xx=np.mgrid[0:NY,0:NX]
+    data=rs.normal(0,1,(NWV,NY,NX))+0.05*xx[None,:,:]
+    for x0,y0 in [(8.,7.),(20.,15.)]:
+        data+=10*np.exp(-((xx-x0)**2+(yy-y0)**2)/2./1.5**2)[None,:,:]
+    stat=rs.uniform(0.5,1.5,(NWV,NY,NX))
+    data[:,3,4]=np.nan
+    data[30:33,10,:]=np.nan
+    stat[~np.isfinite(data)]=np.nan
+
+    filename=str(tmpdir.join('cube.fits'))
+    writecube(filename,data,stat)
+
+    return filename
+
+def refimg(cube,wrange):
+
+    """ Projection with the math of the original cube2img [tophat only] """
+
+    from astropy.io import fits
+
+    data=fits.getdata(cube,'DATA').astype(np.float64)
+    stat=fits.getdata(cube,'STAT').astype(np.float64)
+    wavec=5000.+1.25*np.arange(NWV)
+    delta_lambda=wavec-np.roll(wavec,1)
+    delta_lambda[0]=wavec[1]-wavec[0]
+
+    mask=np.isfinite(data).astype(int)
+    mask[(wavec < wrange[0]) | (wavec > wrange[1])]=0
+    trans=np.zeros(NWV)+1
+    trans[0:5]=0
+    trans[-5:]=0
+    trans=(trans*delta_lambda)[:,None,None]
+    data=np.nan_to_num(data)
+    stat=np.nan_to_num(stat)
+
+    img=np.sum(data*trans*mask,axis=0)
+    var=np.sum(stat*mask*trans**2,axis=0)
+    wgt=np.sum(mask*trans,axis=0)
+    wgt[wgt <= 0]=1e-20
+
+    return img/wgt, var/wgt**2
+
+@pytest.mark.parametrize('native',[False,True])
+def test_cube2img_matches_reference(cube,native):
+
+    """ Projection in slabs equals the original per-spaxel loop """
+
+    from mypython.ifu import muse_utils as utl
+
+    wrange=(5010.,5070.)
+    img,var,wcsimg=utl.cube2img(cube,wrange=wrange,maxmem=0.01,native=native)
+    rimg,rvar=refimg(cube,wrange)
+
+    assert np.allclose(img,rimg,rtol=1e-5,atol=1e-6)
+    assert np.allclose(var,rvar,rtol=1e-5,atol=1e-8)
+
+def test_cube2imgs_matches_cube2img(cube):
+
+    """ Many bands in one pass equal one cube2img call per band """
+
+    from mypython.ifu import muse_utils as utl
+
+    bands=[(5010.,5040.),(5030.,5080.),(5000.,5099.)]
+    imgs,variances,zps,names,wcsimg=utl.cube2imgs(cube,bands,maxmem=0.01)
+
+    for band,img,var,zp in zip(bands,imgs,variances,zps):
+        rimg,rvar,rwcs=utl.cube2img(cube,wrange=band)
+        assert np.allclose(img,rimg,rtol=1e-6,atol=1e-8)
+        assert np.allclose(var,rvar,rtol=1e-6,atol=1e-10)
+
+def test_labelspec_matches_cube2spec(cube):
+
+    """ Spectra of all the labels in one pass equal cube2spec with a mask """
+
+    from mypython.ifu import muse_utils as utl
+
+    labels=np.zeros((NY,NX),dtype=int)
+    labels[5:10,6:11]=1
+    labels[13:18,17:23]=2
+    labels[9:12,2:6]=3
+
+    wave,ids,flux,err,med=utl.labelspec(cube,labels,twod=False,maxmem=0.01)
+    assert list(ids) == [1,2,3]
+
+    for ii,srcid in enumerate(ids):
+        rwave,rflux,rerr,rmed=utl.cube2spec(cube,0,0,0,shape='mask',mask=labels[None,:,:],
+                                            idsource=srcid,twod=False)
+        assert np.allclose(wave,rwave)
+        assert np.allclose(flux[ii],rflux,rtol=1e-5,atol=1e-6)
+        #NaN STAT propagates to the error, as in cube2spec
+        assert np.allclose(err[ii],rerr,rtol=1e-5,atol=1e-6,equal_nan=True)
+        assert np.allclose(med[ii],rmed,rtol=1e-5,atol=1e-6)
+
+def test_boxspec_matches_cube2spec(cube):
+
+    """ Box spectra from the summed-area tables equal cube2spec boxes """
+
+    from mypython.ifu import muse_utils as utl
+
+    utl.makesatcube(cube,maxmem=0.01)
+    x=np.array([8,20,1,28])
+    y=np.array([7,15,12,22])
+    wave,flux,err,npix=utl.boxspec(cube,x,y,2)
+
+    for ii in range(len(x)):
+        #cube2spec takes the NAXIS2 coordinate first
+        rwave,rflux,rerr,rmed=utl.cube2spec(cube,y[ii],x[ii],2,shape='box',twod=False)
+        assert np.allclose(flux[ii],rflux,rtol=1e-5,atol=1e-6)
+        #the tables hold NaN STAT as 0, cube2spec propagates it
+        good=np.isfinite(rerr)
+        assert np.allclose(err[ii][good],rerr[good],rtol=1e-5,atol=1e-6)
+
+def test_makepyramid_block_mean(tmpdir):
+
+    """ Pyramid levels are block means of the cube, times the spaxels per bin """
+
+    from astropy.io import fits
+    from mypython.ifu import muse_utils as utl
+
+    rs=np.random.RandomState(4)
+    data=rs.normal(0,1,(NWV,NY,NX))
+    stat=rs.uniform(0.5,1.5,(NWV,NY,NX))
+    cube=str(tmpdir.join('cube.fits'))
+    writecube(cube,data,stat)
+    data=fits.getdata(cube,'DATA').astype(np.float64)
+    stat=fits.getdata(cube,'STAT').astype(np.float64)
+
+    utl.makepyramid(cube,levels=[2],specbin=4,maxmem=0.01)
+    level=utl.pyramidcube(cube,2)
+
+    blocks=data.reshape(NWV//4,4,NY//2,2,NX//2,2)
+    vblocks=stat.reshape(NWV//4,4,NY//2,2,NX//2,2)
+    assert np.allclose(fits.getdata(level,'DATA'),blocks.mean(axis=(1,3,5))*4,rtol=1e-5,atol=1e-6)
+    assert np.allclose(fits.getdata(level,'STAT'),vblocks.sum(axis=(1,3,5))/16.,rtol=1e-5)
+
+    #the level is a cube as any other
+    img,var,wcsimg=utl.cube2img(cube,level=2)
+    assert img.shape == (NY//2,NX//2)
+
+def test_contsub_matches_median_filter(cube,tmpdir):
+
+    """ Continuum subtraction equals a running median along each spaxel """
+
+    from astropy.io import fits
+    from scipy import ndimage
+    from mypython.ifu import muse_utils as utl
+
+    output=str(tmpdir.join('contsub.fits'))
+    utl.contsub(cube,output=output,width=15,skylines=None,nproc=2,maxmem=0.01)
+
+    data=fits.getdata(cube,'DATA').astype(np.float64)
+    sub=fits.getdata(output,'DATA')
+    good=np.all(np.isfinite(data),axis=0)
+    continuum=ndimage.median_filter(data[:,good],size=(15,1),mode='nearest')
+
+    assert np.allclose(sub[:,good],data[:,good]-continuum,rtol=1e-5,atol=1e-5)
+    assert np.array_equal(np.isfinite(sub),np.isfinite(data))
+    np.testing.assert_array_equal(fits.getdata(output,'STAT'),fits.getdata(cube,'STAT'))